@@ -0,0 +1,158 @@
+import datetime
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+class ActivityCache(object):
+    """Caches the billing state which decides whether a subscription is active.
+
+    The state (payment deadline, gratis, blocked) is cached rather than the answer,
+    because the answer changes at midnight without any DB change.
+
+    Two levels: an in-process LRU with `ttl` seconds time to live and
+    (if `alias` is not `None`) Django cache `alias` with `shared_ttl` seconds.
+    :meth:`invalidate` deletes the state at both levels, but the LRU of other processes
+    keeps it for up to `ttl` seconds.
+
+    A state loaded before an invalidation must not be cached after it (a concurrent reader could
+    store it after the invalidating transaction commits). So the Django cache keeps a generation token
+    for every purchase, replaced by :meth:`invalidate`, and a state is cached with the token read before
+    loading it: a state with an old token is ignored.
+
+    Use :func:`activity_cache` instead of creating this object."""
+
+    def __init__(self, size=10000, ttl=60, alias='default', shared_ttl=3600):
+        self.size = size
+        self.ttl = ttl
+        self.alias = alias
+        self.shared_ttl = shared_ttl
+        self._entries = OrderedDict()  # pk -> (state, expiry)
+        self._lock = threading.Lock()
+        self._invalidations = 0  # in this process, so that a state loaded before an invalidation is not kept
+        self.hits = 0
+        """Found in the in-process LRU."""
+        self.shared_hits = 0
+        """Found in the Django cache."""
+        self.misses = 0
+        """Loaded from the DB."""
+
+    @staticmethod
+    def key(pk):
+        return 'debits:activity:%d' % pk
+
+    @staticmethod
+    def generation_key(pk):
+        return 'debits:activity-generation:%d' % pk
+
+    def generation(self, pk, cached=None):
+        """Internal.
+
+        The generation token of the purchase `pk` (created if there is none).
+
+        Args:
+            cached: the token if already read from the Django cache."""
+        if cached is not None:
+            return cached
+        cache = caches[self.alias]
+        cache.add(self.generation_key(pk), uuid.uuid4().hex, None)
+        return cache.get(self.generation_key(pk))
+
+    def get(self, pk, load):
+        """The state of the purchase `pk`.
+
+        Args:
+            load: a function which loads the state from the DB by `pk`."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(pk)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(pk)
+                self.hits += 1
+                return entry[0]
+            invalidations = self._invalidations
+        state = generation = None
+        if self.alias is not None:
+            key, generation_key = self.key(pk), self.generation_key(pk)
+            found = caches[self.alias].get_many([key, generation_key])
+            generation = self.generation(pk, found.get(generation_key))
+            entry = found.get(key)
+            if entry is not None and entry[0] == generation:
+                state = entry[1]
+        if state is not None:
+            with self._lock:
+                self.shared_hits += 1
+        else:
+            state = load(pk)
+            with self._lock:
+                self.misses += 1
+            if self.alias is not None:
+                caches[self.alias].set(self.key(pk), (generation, state), self.shared_ttl)
+        with self._lock:
+            if self._invalidations != invalidations:
+                return state  # possibly loaded before an invalidation
+            self._entries[pk] = (state, now + self.ttl)
+            self._entries.move_to_end(pk)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return state
+
+    def invalidate(self, pk):
+        """Forget the state of the purchase `pk`."""
+        with self._lock:
+            self._entries.pop(pk, None)
+            self._invalidations += 1
+        if self.alias is not None:
+            caches[self.alias].set(self.generation_key(pk), uuid.uuid4().hex, None)
+            caches[self.alias].delete(self.key(pk))
+
+    def clear(self):
+        """Forget everything in this process (the Django cache is not cleared)."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Returns:
+            A dict with `hits`, `shared_hits`, `misses`, `hit_ratio` and `size`."""
+        with self._lock:
+            total = self.hits + self.shared_hits + self.misses
+            return {'hits': self.hits,
+                    'shared_hits': self.shared_hits,
+                    'misses': self.misses,
+                    'hit_ratio': (self.hits + self.shared_hits) / total if total else 0.0,
+                    'size': len(self._entries)}
+
+
+def is_active_state(state, today=None):
+    """Is a subscription active.
+
+    Args:
+        state: a tuple (payment deadline, gratis, blocked)."""
+    payment_deadline, gratis, blocked = state
+    prior = payment_deadline is not None and (today or datetime.date.today()) <= payment_deadline
+    return (prior or gratis) and not blocked
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def activity_cache():
+    """The process-wide :class:`ActivityCache`.
+
+    Configured by settings ``PAYMENTS_ACTIVITY_CACHE_SIZE`` (default 10000), ``PAYMENTS_ACTIVITY_CACHE_TTL``
+    (seconds in the process, default 60), ``PAYMENTS_ACTIVITY_CACHE_ALIAS`` (Django cache, default ``'default'``,
+    `None` for no shared cache) and ``PAYMENTS_ACTIVITY_SHARED_TTL`` (seconds in Django cache, default 3600)."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ActivityCache(size=getattr(settings, 'PAYMENTS_ACTIVITY_CACHE_SIZE', 10000),
+                                       ttl=getattr(settings, 'PAYMENTS_ACTIVITY_CACHE_TTL', 60),
+                                       alias=getattr(settings, 'PAYMENTS_ACTIVITY_CACHE_ALIAS', 'default'),
+                                       shared_ttl=getattr(settings, 'PAYMENTS_ACTIVITY_SHARED_TTL', 3600))
+    return _cache
@@ -0,0 +1,115 @@
+import hashlib
+import hmac
+import threading
+
+from django.conf import settings
+
+
+class InvalidCustom(ValueError):
+    """A transaction secret ("custom") is malformed or forged."""
+    pass
+
+
+class HMACSigner(object):
+    """HMAC with the keyed state computed once: every signature copies it instead of hashing the key again."""
+
+    def __init__(self, key, digestmod=hashlib.sha256):
+        self._base = hmac.new(key, digestmod=digestmod)
+
+    def digest(self, message):
+        h = self._base.copy()
+        h.update(message)
+        return h.digest()
+
+    def hexdigest(self, message):
+        h = self._base.copy()
+        h.update(message)
+        return h.hexdigest()
+
+
+class TransactionCodec(object):
+    """Encodes a :class:`~debits.debits_base.models.BaseTransaction` PK into a secret string ("custom")
+    sent to the payment processor and decodes it back.
+
+    The format is ``<realm> <pk> <key id>-<HMAC-SHA256 hex>``. Several keys may be active:
+    the first one encodes, all decode. Secrets of the older format ``<realm> <pk> <HMAC-MD5 hex>``
+    (for transactions started before upgrading) are accepted if `legacy` is true.
+
+    Use :func:`transaction_codec` instead of creating this object."""
+
+    def __init__(self, keys, realm, legacy=True):
+        self.realm = realm
+        self.kid = keys[0][0]
+        self.signers = {kid: HMACSigner(secret.encode()) for kid, secret in keys}
+        self.legacy_signers = [HMACSigner(secret.encode(), hashlib.md5) for kid, secret in keys] if legacy else []
+
+    @staticmethod
+    def message(pk):
+        return ('payid ' + str(pk)).encode()
+
+    def encode(self, pk):
+        """Returns:
+            The secret string for the transaction PK."""
+        pk = str(int(pk))
+        return self.realm + ' ' + pk + ' ' + self.kid + '-' + self.signers[self.kid].hexdigest(b'payid ' + pk.encode())
+
+    def decode(self, custom):
+        """Raises :class:`InvalidCustom` if `custom` is wrong.
+
+        Returns:
+            The transaction PK."""
+        r = custom.split(' ', 2)
+        if len(r) != 3 or r[0] != self.realm:
+            raise InvalidCustom("Wrong realm")
+        try:
+            pk = int(r[1])
+        except ValueError:
+            raise InvalidCustom("Wrong PK")
+        message = self.message(pk)
+        kid, sep, secret = r[2].rpartition('-')
+        secret = secret.encode()  # compare_digest() raises TypeError for non-ASCII str
+        if sep:
+            signer = self.signers.get(kid)
+            if signer is not None and hmac.compare_digest(signer.hexdigest(message).encode(), secret):
+                return pk
+        else:
+            for signer in self.legacy_signers:
+                if hmac.compare_digest(signer.hexdigest(message).encode(), secret):
+                    return pk
+        raise InvalidCustom("Wrong secret")
+
+    def encode_many(self, pks):
+        """Returns:
+            A list of secret strings."""
+        return [self.encode(pk) for pk in pks]
+
+    def decode_many(self, customs):
+        """Returns:
+            A list of PKs (`None` for wrong secrets)."""
+        result = []
+        for custom in customs:
+            try:
+                result.append(self.decode(custom))
+            except InvalidCustom:
+                result.append(None)
+        return result
+
+
+_codec = None
+_codec_lock = threading.Lock()
+
+
+def transaction_codec():
+    """The process-wide :class:`TransactionCodec`.
+
+    Configured by settings ``PAYMENTS_TRANSACTION_KEYS`` (a list of pairs (key id, secret),
+    the first one encodes; key ids must not contain spaces; default: ``SECRET_KEY`` with id ``'1'``),
+    ``PAYMENTS_REALM`` and ``PAYMENTS_LEGACY_CUSTOM`` (accept MD5 secrets, default `True`)."""
+    global _codec
+    if _codec is None:
+        with _codec_lock:
+            if _codec is None:
+                keys = getattr(settings, 'PAYMENTS_TRANSACTION_KEYS', None) or [('1', settings.SECRET_KEY)]
+                _codec = TransactionCodec(keys, settings.PAYMENTS_REALM,
+                                          legacy=getattr(settings, 'PAYMENTS_LEGACY_CUSTOM', True))
+    return _codec
@@ -0,0 +1,153 @@
+import base64
+import datetime
+import hashlib
+import hmac
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from debits.debits_base.activity import is_active_state
+from debits.debits_base.codec import HMACSigner
+
+
+# Token: 1.<key id>.<purchase pk>.<payment deadline or empty>.<gratis>.<blocked>.<expiry>.<signature>
+VERSION = '1'
+
+
+class InvalidEntitlement(Exception):
+    """The entitlement token is malformed, forged, signed by an unknown key or expired."""
+    pass
+
+
+class Entitlement(object):
+    """The billing state of a subscription purchase as stated by a verified token."""
+
+    def __init__(self, pk, payment_deadline, gratis, blocked, expires):
+        self.pk = pk
+        """:class:`~debits.debits_base.models.SubscriptionPurchase` PK."""
+
+        self.payment_deadline = payment_deadline
+        """A date or `None`."""
+
+        self.gratis = gratis
+
+        self.blocked = blocked
+
+        self.expires = expires
+        """Unix time after which the token must be refreshed."""
+
+    def __repr__(self):
+        return "<Entitlement pk=%d>" % self.pk
+
+    def is_active(self, today=None):
+        """Is the subscription active (see :meth:`~debits.debits_base.models.SubscriptionPurchase.is_active`)."""
+        return is_active_state((self.payment_deadline, self.gratis, self.blocked), today)
+
+
+def entitlement_keys():
+    """Signing keys from ``PAYMENTS_ENTITLEMENT_KEYS`` setting: a list of pairs (key id, secret).
+
+    The first key signs new tokens, all keys verify. To rotate keys, prepend a new key
+    and remove the old one after :func:`entitlement_ttl` seconds.
+    By default the only key is derived from ``SECRET_KEY``."""
+    return getattr(settings, 'PAYMENTS_ENTITLEMENT_KEYS', None) or [('0', settings.SECRET_KEY)]
+
+
+def entitlement_ttl():
+    """Lifetime of a token in seconds (``PAYMENTS_ENTITLEMENT_TTL`` setting, default 300)."""
+    return getattr(settings, 'PAYMENTS_ENTITLEMENT_TTL', 300)
+
+
+def check_key_id(kid):
+    """Internal.
+
+    Raises :class:`~django.core.exceptions.ImproperlyConfigured` if `kid` cannot be a part of a token."""
+    if not kid or '.' in kid:
+        raise ImproperlyConfigured("Entitlement key id must be nonempty and without '.': %r" % kid)
+    return kid
+
+
+def derive_key(secret):
+    """Internal.
+
+    Use a dedicated key, so that tokens cannot be confused with other HMACs of the same secret."""
+    return hashlib.sha256(b'debits entitlement ' + secret.encode()).digest()
+
+
+def sign(signer, message):
+    """Internal."""
+    return base64.urlsafe_b64encode(signer.digest(message.encode())).rstrip(b'=').decode()
+
+
+class EntitlementIssuer(object):
+    """Issues signed entitlement tokens (needs the DB)."""
+
+    def __init__(self, keys=None, ttl=None):
+        keys = keys or entitlement_keys()
+        kid, secret = keys[0]
+        self.kid = check_key_id(kid)
+        self.signer = HMACSigner(derive_key(secret))
+        self.ttl = ttl or entitlement_ttl()
+
+    def issue_state(self, pk, payment_deadline, gratis, blocked, now=None):
+        """Token for the given state."""
+        expires = int(now or time.time()) + self.ttl
+        message = '.'.join((VERSION, self.kid, str(pk),
+                            payment_deadline.isoformat() if payment_deadline else '',
+                            '1' if gratis else '0', '1' if blocked else '0', str(expires)))
+        return message + '.' + sign(self.signer, message)
+
+    def issue(self, purchase):
+        """Token for a :class:`~debits.debits_base.models.SubscriptionPurchase`."""
+        return self.issue_state(purchase.pk, purchase.payment_deadline, purchase.gratis, purchase.blocked)
+
+    def issue_many(self, pks):
+        """Tokens for many purchases by one query.
+
+        Returns:
+            A dict from PK to token (PKs of nonexisting purchases are absent)."""
+        # imported here, so that verifiers can use this module without the DB
+        from debits.debits_base.models import SubscriptionPurchase
+        now = int(time.time())
+        rows = SubscriptionPurchase.objects.filter(pk__in=pks).\
+            values_list('pk', 'payment_deadline', 'gratis', 'blocked')
+        return {row[0]: self.issue_state(*row, now=now) for row in rows}
+
+
+class EntitlementVerifier(object):
+    """Verifies entitlement tokens without DB or network access (only CPU)."""
+
+    def __init__(self, keys=None):
+        self.signers = {check_key_id(kid): HMACSigner(derive_key(secret))
+                        for kid, secret in (keys or entitlement_keys())}
+
+    def verify(self, token, now=None):
+        """Check the token.
+
+        Raises :class:`InvalidEntitlement` if the token is wrong or expired.
+
+        Returns:
+            :class:`Entitlement`."""
+        parts = token.split('.')
+        if len(parts) != 8 or parts[0] != VERSION:
+            raise InvalidEntitlement("Malformed token")
+        signer = self.signers.get(parts[1])
+        if signer is None:
+            raise InvalidEntitlement("Unknown key")
+        message, signature = token.rsplit('.', 1)
+        # bytes, as compare_digest() raises TypeError for non-ASCII str
+        if not hmac.compare_digest(sign(signer, message).encode(), signature.encode()):
+            raise InvalidEntitlement("Wrong signature")
+        try:
+            expires = int(parts[6])
+            entitlement = Entitlement(int(parts[2]),
+                                      datetime.date(*map(int, parts[3].split('-'))) if parts[3] else None,
+                                      parts[4] == '1',
+                                      parts[5] == '1',
+                                      expires)
+        except (ValueError, TypeError):
+            raise InvalidEntitlement("Malformed token")
+        if expires <= (now or time.time()):
+            raise InvalidEntitlement("Token expired")
+        return entitlement
@@ -0,0 +1,166 @@
+import smtplib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+
+from debits.debits_base.base import logger
+from debits.debits_base.models import OutgoingEmail
+
+
+class MailDispatcher(object):
+    """Sends many emails over a few kept-open connections.
+
+    Messages are collected and sent in batches by `connections` parallel connections.
+    A connection is reopened after `messages_per_connection` messages (mail servers usually limit
+    the number of messages per session) or if the server disconnects.
+    A failed message is logged and counted, the rest of the batch is still sent.
+
+    Use it as a context manager, so that the remaining messages are sent and the connections closed::
+
+        with MailDispatcher() as dispatcher:
+            for purchase in purchases:
+                purchase.send_rendered_email(template, subject, data, dispatcher=dispatcher)
+
+    Configured by settings ``PAYMENTS_MAIL_MESSAGES_PER_CONNECTION`` (default 100) and
+    ``PAYMENTS_MAIL_CONNECTIONS`` (default 1)."""
+
+    def __init__(self, messages_per_connection=None, connections=None, backend=None):
+        self.messages_per_connection = messages_per_connection or \
+            getattr(settings, 'PAYMENTS_MAIL_MESSAGES_PER_CONNECTION', 100)
+        self.connections = connections or getattr(settings, 'PAYMENTS_MAIL_CONNECTIONS', 1)
+        self.backend = backend
+        self.sent = 0
+        """The number of sent messages."""
+        self.failed = []
+        """Pairs (message, exception) of messages which were not sent."""
+        self._pending = []
+        self._open = [None] * self.connections  # connection objects
+        self._used = [0] * self.connections  # messages sent by every connection since it was opened
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def send(self, subject, text, to, html_message=None, from_email=None):
+        """Queue an email (the arguments are like of :func:`django.core.mail.send_mail`)."""
+        message = EmailMultiAlternatives(subject, text, from_email or settings.FROM_EMAIL, to)
+        if html_message:
+            message.attach_alternative(html_message, 'text/html')
+        self.add(message)
+
+    def add(self, message):
+        """Queue an :class:`django.core.mail.EmailMessage`."""
+        self._pending.append(message)
+        if len(self._pending) >= self.messages_per_connection * self.connections:
+            self.flush()
+
+    def flush(self):
+        """Send all queued messages."""
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        if self.connections == 1:
+            self._send_batch(0, pending)
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.connections)
+        # every connection is used by exactly one thread at a time
+        futures = [self._executor.submit(self._send_batch, i, pending[i::self.connections])
+                   for i in range(self.connections)]
+        for future in futures:
+            future.result()
+
+    def close(self):
+        """Send the remaining messages and close the connections."""
+        try:
+            self.flush()
+        finally:
+            for i in range(self.connections):
+                self._close_connection(i)
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def _connection(self, i):
+        """Internal."""
+        if self._open[i] is not None and self._used[i] >= self.messages_per_connection:
+            self._close_connection(i)
+        if self._open[i] is None:
+            connection = get_connection(self.backend)
+            connection.open()
+            self._open[i] = connection
+            self._used[i] = 0
+        return self._open[i]
+
+    def _close_connection(self, i):
+        """Internal."""
+        connection = self._open[i]
+        self._open[i] = None
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    def _send_batch(self, i, messages):
+        """Internal."""
+        for message in messages:
+            try:
+                try:
+                    self._connection(i).send_messages([message])
+                except smtplib.SMTPServerDisconnected:  # try once again with a new connection
+                    self._close_connection(i)
+                    self._connection(i).send_messages([message])
+            except Exception as e:
+                logger.warning("Cannot send email to %s: %s" % (', '.join(message.to), e))
+                with self._lock:
+                    self.failed.append((message, e))
+                if isinstance(e, smtplib.SMTPException) and \
+                        not isinstance(e, (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused)):
+                    self._close_connection(i)  # the session state is unknown
+                continue
+            self._used[i] += 1
+            with self._lock:
+                self.sent += 1
+
+
+class OutboxWriter(object):
+    """Has the interface of :class:`MailDispatcher` but queues emails in :class:`~debits.debits_base.models.OutgoingEmail`.
+
+    Call :meth:`flush` inside the DB transaction of the state change, so that the emails are
+    written by one INSERT in the same transaction."""
+
+    def __init__(self):
+        self.sent = 0
+        """The number of queued messages."""
+        self.failed = []
+        self._pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def send(self, subject, text, to, html_message=None, from_email=None):
+        """Queue an email (the arguments are like of :func:`django.core.mail.send_mail`)."""
+        from_email = from_email or settings.FROM_EMAIL
+        for address in to:
+            self._pending.append(OutgoingEmail(subject=subject, from_email=from_email, to=address,
+                                               text=text, html=html_message))
+
+    def flush(self):
+        """Write the queued emails."""
+        pending, self._pending = self._pending, []
+        if pending:
+            OutgoingEmail.objects.bulk_create(pending)
+            self.sent += len(pending)
+
+    def close(self):
+        self.flush()
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from debits.debits_base.models import CancellationJob
+from debits.debits_base.queue import run_workers
+
+
+class Command(BaseCommand):
+    help = "Cancel subscriptions at payment processors as queued by SubscriptionPurchase.schedule_cancel()."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4,
+                            help="The number of worker threads (they mostly wait for the payment processor).")
+        parser.add_argument('--batch', type=int, default=1, help="How many jobs a worker claims at once.")
+        parser.add_argument('--once', action='store_true', help="Exit when the queue is drained.")
+        parser.add_argument('--idle-sleep', type=float, default=1.0,
+                            help="Seconds to wait when the queue is empty.")
+        parser.add_argument('--report-interval', type=float, default=60.0,
+                            help="Log throughput of every worker each this number of seconds.")
+
+    def handle(self, *args, **options):
+        stats = run_workers(CancellationJob,
+                            workers=options['workers'],
+                            batch=options['batch'],
+                            once=options['once'],
+                            idle_sleep=options['idle_sleep'],
+                            report_interval=options['report_interval'])
+        for s in stats:
+            self.stdout.write(str(s))
@@ -0,0 +1,38 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from debits.debits_base.models import OutgoingEmail
+from debits.debits_base.queue import run_workers
+
+
+class Command(BaseCommand):
+    help = "Send emails queued in the outbox (see PAYMENTS_EMAIL_OUTBOX setting)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1,
+                            help="The number of worker threads (each with its own SMTP connection).")
+        parser.add_argument('--batch', type=int, default=50, help="How many emails a worker claims at once.")
+        parser.add_argument('--once', action='store_true', help="Exit when the outbox is drained.")
+        parser.add_argument('--idle-sleep', type=float, default=5.0,
+                            help="Seconds to wait when the outbox is empty.")
+        parser.add_argument('--report-interval', type=float, default=60.0,
+                            help="Log throughput of every worker each this number of seconds.")
+        parser.add_argument('--prune-days', type=int, default=None,
+                            help="Before sending, delete emails sent (or dead) more than this number of days ago.")
+        parser.add_argument('--prune-batch', type=int, default=1000, help="Delete this number of emails per query.")
+
+    def handle(self, *args, **options):
+        if options['prune_days'] is not None:
+            before = timezone.now() - datetime.timedelta(days=options['prune_days'])
+            deleted = OutgoingEmail.prune(before, batch_size=options['prune_batch'])
+            self.stdout.write("%d old emails deleted" % deleted)
+        stats = run_workers(OutgoingEmail,
+                            workers=options['workers'],
+                            batch=options['batch'],
+                            once=options['once'],
+                            idle_sleep=options['idle_sleep'],
+                            report_interval=options['report_interval'])
+        for s in stats:
+            self.stdout.write(str(s))
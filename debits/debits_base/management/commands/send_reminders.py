@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from debits.debits_base.reminders import ReminderEngine
+
+
+class Command(BaseCommand):
+    help = "Send email reminders about due payments."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1, help="The number of worker threads.")
+        parser.add_argument('--partition', type=int, default=0,
+                            help="The number of this process (from 0), when running on several processes or hosts.")
+        parser.add_argument('--partitions', type=int, default=1,
+                            help="The number of processes (all with the same --workers).")
+        parser.add_argument('--chunk-size', type=int, default=None,
+                            help="Purchases claimed at once (default PAYMENTS_REMINDERS_CHUNK_SIZE or 1000).")
+        parser.add_argument('--report-interval', type=float, default=60.0,
+                            help="Log progress of every worker each this number of seconds.")
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1 or not 0 <= options['partition'] < options['partitions']:
+            raise CommandError("Wrong --workers, --partition or --partitions.")
+        engine = ReminderEngine(chunk_size=options['chunk_size'],
+                                workers=options['workers'],
+                                partition=options['partition'],
+                                partitions=options['partitions'],
+                                report_interval=options['report_interval'])
+        counts = engine.run()
+        self.stdout.write("%d purchases reminded" % sum(counts))
+        for stats in engine.stats:
+            self.stdout.write(str(stats))
@@ -0,0 +1,21 @@
+# Generated by Django 2.2.28 on 2026-10-17 18:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('debits_base', '0002_auto_20200504_0400'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='subscriptionpurchase',
+            index=models.Index(fields=['trial', 'due_payment_date'], name='debits_base_trial_77edc8_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='subscriptionpurchase',
+            index=models.Index(fields=['trial', 'payment_deadline'], name='debits_base_trial_741d2a_idx'),
+        ),
+    ]
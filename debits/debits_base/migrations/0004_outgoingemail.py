@@ -0,0 +1,36 @@
+# Generated by Django 2.2.28 on 2026-10-17 18:59
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('debits_base', '0003_reminder_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutgoingEmail',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.SmallIntegerField(db_index=True, default=1, verbose_name='Queue status')),
+                ('creation_date', models.DateTimeField(auto_now_add=True)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('next_attempt', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('claim', models.CharField(db_index=True, max_length=32, null=True)),
+                ('claimed_at', models.DateTimeField(null=True)),
+                ('finished', models.DateTimeField(null=True)),
+                ('last_error', models.TextField(null=True)),
+                ('subject', models.CharField(max_length=255)),
+                ('from_email', models.CharField(max_length=255)),
+                ('to', models.EmailField(max_length=254)),
+                ('text', models.TextField()),
+                ('html', models.TextField(null=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
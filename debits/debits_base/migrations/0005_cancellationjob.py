@@ -0,0 +1,37 @@
+# Generated by Django 2.2.28 on 2026-10-17 19:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('debits_base', '0004_outgoingemail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CancellationJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.SmallIntegerField(db_index=True, default=1, verbose_name='Queue status')),
+                ('creation_date', models.DateTimeField(auto_now_add=True)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('next_attempt', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('claim', models.CharField(db_index=True, max_length=32, null=True)),
+                ('claimed_at', models.DateTimeField(null=True)),
+                ('finished', models.DateTimeField(null=True)),
+                ('last_error', models.TextField(null=True)),
+                ('subscription_reference', models.CharField(max_length=255, unique=True)),
+                ('is_upgrade', models.BooleanField(default=False)),
+                ('error', models.TextField(null=True)),
+                ('processor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='debits_base.PaymentProcessor')),
+                ('purchase', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cancellations', to='debits_base.SubscriptionPurchase')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
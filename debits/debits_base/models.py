@@ -1,22 +1,27 @@
 import abc
-import hmac
 import datetime
+import decimal
+import threading
 
-import html2text
 from django.apps import apps
 from django.urls import reverse
 from django.db import models
-from django.db.models import F
+from django.db.models import F, Sum, Value
+from django.db.models.functions import Coalesce
 import django.db
 from django.db import transaction
 from django.core.exceptions import ObjectDoesNotExist
-from django.core.mail import send_mail
-from django.template.loader import render_to_string
+from django.core.mail import send_mail, get_connection, EmailMultiAlternatives
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from composite_field import CompositeField
 from django.conf import settings
 
+from debits.debits_base.activity import activity_cache, is_active_state
 from debits.debits_base.base import logger, Period, period_to_delta
+from debits.debits_base.codec import transaction_codec, InvalidCustom
+from debits.debits_base.queue import QueueItem, QueueStatus
+from debits.debits_base.rendering import email_renderer
 
 
 class ModelRef(CompositeField):
@@ -99,9 +104,8 @@ class BaseTransaction(models.Model):
             pk: the serial primary key (of :class:`BaseTransaction`) used to calculate the secret transaction code.
 
         Returns:
-            A secret string."""
-        secret = hmac.new(settings.SECRET_KEY.encode(), ('payid ' + str(pk)).encode()).hexdigest()
-        return settings.PAYMENTS_REALM + ' ' + str(pk) + ' ' + secret
+            A secret string (see :class:`~debits.debits_base.codec.TransactionCodec`)."""
+        return transaction_codec().encode(pk)
 
     @staticmethod
     def pk_from_custom(custom):
@@ -114,16 +118,9 @@ class BaseTransaction(models.Model):
 
         Returns:
             The primary key for :class:`BaseTransaction`."""
-        r = custom.split(' ', 2)
-        if len(r) != 3 or r[0] != settings.PAYMENTS_REALM:
-            raise BaseTransaction.DoesNotExist
         try:
-            pk = int(r[1])
-            secret = hmac.new(settings.SECRET_KEY.encode(), ('payid ' + str(pk)).encode()).hexdigest()
-            if r[2] != secret:
-                raise BaseTransaction.DoesNotExist
-            return pk
-        except ValueError:
+            return transaction_codec().decode(custom)
+        except InvalidCustom:
             raise BaseTransaction.DoesNotExist
 
     @abc.abstractmethod
@@ -309,7 +306,7 @@ class Purchase(models.Model):
     * 0 - no reminder sent
     * 1 - before due payment sent
     * 2 - at due payment sent
-    * 3 - day before deadline sent
+    * 3 - at deadline sent
 
     TODO: Move to :class:`SubscriptionPurchase`?"""
 
@@ -323,6 +320,31 @@ class Purchase(models.Model):
     def __repr__(self):
         return "<Purchase pk=%d, %s>" % (self.pk, self.item.product.name)
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self.invalidate_activity()
+
+    def invalidate_activity(self):
+        """Internal.
+
+        Forget the cached activity state (see :meth:`SubscriptionPurchase.quick_is_active`)
+        when the current DB transaction is committed."""
+        pk = self.pk
+        if pk is not None:
+            django.db.transaction.on_commit(lambda: activity_cache().invalidate(pk))
+
+    def set_blocked(self, blocked=True):
+        """Set :attr:`blocked` in the DB."""
+        Purchase.objects.filter(pk=self.pk).update(blocked=blocked)
+        self.blocked = blocked
+        self.invalidate_activity()
+
+    def set_gratis(self, gratis=True):
+        """Set :attr:`gratis` in the DB."""
+        Purchase.objects.filter(pk=self.pk).update(gratis=gratis)
+        self.gratis = gratis
+        self.invalidate_activity()
+
     @property
     def is_aggregate(self):
         return False
@@ -342,15 +364,22 @@ class Purchase(models.Model):
 
         TODO: Remove ALL old subscriptions as in payment_system2."""
         try:
-            self.old_subscription.subscriptionpurchase.force_cancel(is_upgrade=True)
+            self.old_subscription.subscriptionpurchase.cancel_at_processor(is_upgrade=True)
         except CannotCancelSubscription:
             pass
         # self.on_upgrade_subscription(transaction, item.old_subscription)  # TODO: Needed?
         Purchase.objects.filter(pk=self.pk).update(old_subscription=None)
 
     # TODO: Move to Payment class?
-    def send_rendered_email(self, template_name, subject, data):
-        """Internal."""
+    def send_rendered_email(self, template_name, subject, data, dispatcher=None, recipient_data=None):
+        """Internal.
+
+        Args:
+            dispatcher: :class:`~debits.debits_base.mail.MailDispatcher` to send many emails through
+                the same connection or `None` to send immediately (or to queue in :class:`OutgoingEmail`
+                if ``PAYMENTS_EMAIL_OUTBOX`` setting is true).
+            recipient_data: if not `None`, `data` is common for many emails and `recipient_data`
+                is specific for this one (see :meth:`~debits.debits_base.rendering.EmailRenderer.render_skeleton`)."""
         email = None
         try:
             email = self.payment.email
@@ -358,36 +387,173 @@ class Purchase(models.Model):
         except AttributeError:  # no .payment
             return
         if email is not None:
-            html = render_to_string(template_name, data, request=None, using=None)
-            text = html2text.html2text(html)
-            send_mail(subject, text, settings.FROM_EMAIL, [email], html_message=html)
+            if recipient_data is None:
+                html, text = email_renderer().render(template_name, data)
+            else:
+                html, text = email_renderer().render_skeleton(template_name, data, recipient_data)
+            if dispatcher is not None:
+                dispatcher.send(subject, text, [email], html_message=html)
+            elif getattr(settings, 'PAYMENTS_EMAIL_OUTBOX', False):
+                # sent after the current DB transaction is committed
+                OutgoingEmail.objects.create(subject=subject, from_email=settings.FROM_EMAIL, to=email,
+                                             text=text, html=html)
+            else:
+                send_mail(subject, text, settings.FROM_EMAIL, [email], html_message=html)
+
+
+def supports_recursive_cte(connection):
+    """Internal.
+
+    Does the DB support ``WITH RECURSIVE``."""
+    if connection.vendor == 'postgresql':
+        return True
+    if connection.vendor == 'sqlite':
+        return connection.Database.sqlite_version_info >= (3, 8, 3)
+    if connection.vendor == 'mysql':
+        return connection.mysql_is_mariadb and connection.mysql_version >= (10, 2, 2) or \
+               not connection.mysql_is_mariadb and connection.mysql_version >= (8, 0, 1)
+    return False
 
 
 class SimplePurchase(Purchase):
     status = models.SmallIntegerField(_('Payment status'), default=SimplePaymentStatus.NOT_PAID)  # SimplePaymentStatus
 
+    MAX_DEPTH = 100
+    """Maximum depth of :class:`AggregatePurchase` trees (protects against cycles)."""
+
     @property
     def paid(self):
-        """It was paid by the user (and not refunded)."""
-        cur = self
-        while True:
-            if cur._paid:
-                return True
-            cur = cur.parent.only('status', 'parent')
-            if not cur:
-                return False
+        """It was paid by the user (and not refunded), itself or as a part of an aggregate purchase."""
+        if self._paid:
+            return True
+        if self.parent_id is None:
+            return False
+        return SimplePurchase.paid_many([self.parent_id])[self.parent_id]
 
     @property
     def _paid(self):
         """Internal."""
         return self.status == SimplePaymentStatus.PAID
 
+    @staticmethod
+    def paid_many(pks):
+        """Paid status (see :attr:`paid`) of many purchases.
+
+        Uses one query with a recursive CTE over :attr:`~Purchase.parent` or,
+        if the DB does not support it, one query per level of the trees.
+
+        Returns:
+            A dict from PK to `True` or `False` (PKs of nonexisting purchases are absent)."""
+        pks = list(pks)
+        if not pks:
+            return {}
+        connection = django.db.connections[Purchase.objects.db]
+        if supports_recursive_cte(connection):
+            return SimplePurchase.paid_many_cte(pks, connection)
+        return SimplePurchase.paid_many_levels(pks)
+
+    @staticmethod
+    def paid_many_cte(pks, connection):
+        """Internal."""
+        qn = connection.ops.quote_name
+        purchase = qn(Purchase._meta.db_table)
+        id = qn(Purchase._meta.pk.column)
+        simple = qn(SimplePurchase._meta.db_table)
+        ptr = qn(SimplePurchase._meta.pk.column)
+        parent = qn(Purchase._meta.get_field('parent').column)
+        sql = ("WITH RECURSIVE chain (start_id, purchase_id, depth) AS ("
+               " SELECT {id}, {id}, 0 FROM {purchase} WHERE {id} IN ({placeholders})"
+               " UNION ALL"
+               " SELECT chain.start_id, p.{parent}, chain.depth + 1 FROM chain"
+               " JOIN {purchase} p ON p.{id} = chain.purchase_id"
+               " WHERE p.{parent} IS NOT NULL AND chain.depth < %s)"
+               " SELECT chain.start_id, MAX(CASE WHEN s.status = %s THEN 1 ELSE 0 END) FROM chain"
+               " LEFT JOIN {simple} s ON s.{ptr} = chain.purchase_id"
+               " GROUP BY chain.start_id").format(purchase=purchase, id=id, simple=simple, ptr=ptr, parent=parent,
+                                                  placeholders=', '.join(['%s'] * len(pks)))
+        with connection.cursor() as cursor:
+            cursor.execute(sql, pks + [SimplePurchase.MAX_DEPTH, SimplePaymentStatus.PAID])
+            return {start: bool(paid) for start, paid in cursor.fetchall()}
+
+    @staticmethod
+    def paid_many_levels(pks):
+        """Internal.
+
+        Walks all trees together, one query per level."""
+        result = {}
+        current = {pk: pk for pk in pks}  # start PK -> ancestor to check
+        for depth in range(SimplePurchase.MAX_DEPTH + 1):
+            if not current:
+                break
+            rows = Purchase.objects.filter(pk__in=set(current.values())).\
+                values_list('pk', 'parent_id', 'simplepurchase__status')
+            nodes = {pk: (parent, status) for pk, parent, status in rows}
+            upper = {}
+            for start, node in current.items():
+                if node not in nodes:
+                    if start == node:
+                        continue  # no such purchase
+                    result[start] = False
+                    continue
+                parent, status = nodes[node]
+                if status == SimplePaymentStatus.PAID:
+                    result[start] = True
+                elif parent is None or depth == SimplePurchase.MAX_DEPTH:
+                    result[start] = False
+                else:
+                    upper[start] = parent
+            current = upper
+        return result
+
     def is_paid(self):
         return (self.paid or self.gratis) and not self.blocked
     """If to consider the item paid (or gratis) but not blocked."""
 
 
+class SubscriptionPurchaseQuerySet(models.QuerySet):
+    """Subscriptions by activity state, computed in SQL (compare :meth:`SubscriptionPurchase.is_active`).
+
+    Access it as `SubscriptionPurchase.objects`."""
+
+    @staticmethod
+    def active_q(today=None):
+        """The condition of :meth:`SubscriptionPurchase.is_active` (a :class:`django.db.models.Q`)."""
+        today = today or datetime.date.today()
+        return (models.Q(payment_deadline__gte=today) | models.Q(gratis=True)) & models.Q(blocked=False)
+
+    def active(self, today=None):
+        """Paid on time (or gratis) and not blocked."""
+        return self.filter(self.active_q(today))
+
+    def in_grace(self, today=None):
+        """Active only because of the grace period: the due payment date passed, the deadline did not."""
+        today = today or datetime.date.today()
+        return self.filter(due_payment_date__lt=today, payment_deadline__gte=today, gratis=False, blocked=False)
+
+    def expired(self, today=None):
+        """The payment deadline passed (or there is no deadline) and not gratis."""
+        today = today or datetime.date.today()
+        return self.filter(models.Q(payment_deadline__lt=today) | models.Q(payment_deadline__isnull=True),
+                           gratis=False)
+
+    def trialing(self, today=None):
+        """Active in the trial period."""
+        return self.active(today).filter(trial=True)
+
+    def is_active_many(self, pks, today=None):
+        """Activity of many subscriptions by one query.
+
+        Returns:
+            A dict from PK to `True` or `False` (PKs of nonexisting purchases are absent)."""
+        active = models.Case(models.When(self.active_q(today), then=models.Value(True)),
+                             default=models.Value(False),
+                             output_field=models.BooleanField())
+        return dict(self.filter(pk__in=pks).annotate(is_active=active).values_list('pk', 'is_active'))
+
+
 class SubscriptionPurchase(Purchase):
+    objects = SubscriptionPurchaseQuerySet.as_manager()
+
     due_payment_date = models.DateField(default=datetime.date.today, db_index=True)
     """The reference payment date."""
 
@@ -416,6 +582,13 @@ class SubscriptionPurchase(Purchase):
 
     DalPay requires to notify the customer 10 days before every payment."""
 
+    class Meta:
+        indexes = [
+            # for reminders (`reminders_sent` is in the parent table, so it cannot be indexed together)
+            models.Index(fields=['trial', 'due_payment_date']),
+            models.Index(fields=['trial', 'payment_deadline']),
+        ]
+
     def __init__(self, *args, **kwargs):
         try:
             settings.PROLONG_PAYMENT_VIEW
@@ -432,21 +605,26 @@ class SubscriptionPurchase(Purchase):
         """Is the item active (paid on time and not blocked).
 
         Usually you should use quick_is_active() instead because that is faster."""
-        prior = self.payment_deadline is not None and \
-                datetime.date.today() <= self.payment_deadline
-        return (prior or self.gratis) and not self.blocked
+        return is_active_state((self.payment_deadline, self.gratis, self.blocked))
 
     @staticmethod
     def quick_is_active(item_id):
-        """Is the item with given PK active (paid on time and not blocked).
+        """Is the purchase with given PK active (paid on time and not blocked).
 
-        Usually you should use quick_is_active() instead because that is faster."""
-        item = SubscriptionItem.objects.filter(pk=item_id).\
-            only('payment_deadline', 'gratis', 'blocked').get()
-        return item.is_active()
+        The state is cached (see :class:`~debits.debits_base.activity.ActivityCache`).
+
+        Raises :class:`SubscriptionPurchase.DoesNotExist` if there is no such purchase."""
+        return is_active_state(activity_cache().get(int(item_id), SubscriptionPurchase.load_activity_state))
+
+    @staticmethod
+    def load_activity_state(pk):
+        """Internal."""
+        return tuple(SubscriptionPurchase.objects.filter(pk=pk).
+                     values_list('payment_deadline', 'gratis', 'blocked').get())
 
     def set_payment_date(self, date):
         """Sets both :attr:`due_payment_date` and :attr:`payment_deadline`."""
+        self.invalidate_activity()
         self.due_payment_date = date
         # klass = model_from_ref(self.payment.transaction.processor.klass)
         # self.payment_deadline = klass.offset_date(self.due_payment_date, self.grace_period)
@@ -462,15 +640,35 @@ class SubscriptionPurchase(Purchase):
             # self.set_payment_date(klass.offset_date(datetime.date.today(), self.trial_period))
             self.set_payment_date(datetime.date.today() + period_to_delta(self.item.subscriptionitem.trial_period))
 
-    # TODO: The same as in do_upgrade_subscription()
-    #@shared_task  # PayPal tormoz, so run in a separate thread # TODO: celery (with `TypeError: force_cancel() missing 1 required positional argument: 'self'`)
+    def cancel_at_processor(self, is_upgrade=False):
+        """Cancel the subscription at the payment processor: queue it by :meth:`schedule_cancel` if
+        ``PAYMENTS_CANCEL_QUEUE`` setting is true, otherwise wait for it by :meth:`force_cancel`.
+
+        Raises :class:`CannotCancelSubscription` if the processor refuses (only when waiting).
+
+        Returns:
+            :class:`CancellationJob` if canceling was queued, `None` if it is done."""
+        if getattr(settings, 'PAYMENTS_CANCEL_QUEUE', False):
+            return self.schedule_cancel(is_upgrade=is_upgrade)
+        return self.force_cancel(is_upgrade=is_upgrade)
+
     def force_cancel(self, is_upgrade=False):
-        """Cancels the :attr:`transaction`."""
+        """Cancels the :attr:`transaction`.
+
+        It waits for the payment processor. Use :meth:`schedule_cancel` not to block a request.
+        If the processor is temporarily unavailable, canceling is queued by :meth:`schedule_cancel`
+        (so that, for example, an upgrade is not rolled back).
+
+        Returns:
+            :class:`CancellationJob` if canceling was queued, otherwise `None`."""
         if self.subscription_reference:
             klass = model_from_ref(self.processor.klass)
             api = klass().api()
             try:
                 api.cancel_agreement(self.subscription_reference, is_upgrade=is_upgrade)  # may raise an exception
+            except ProcessorUnavailable as e:
+                logger.warning("Cannot cancel subscription %s now, queued: %s" % (self.subscription_reference, e))
+                return self.schedule_cancel(is_upgrade=is_upgrade)
             except CannotCancelSubscription:
                 logger.warn("Cannot cancel subscription " + self.subscription_reference)
                 # fallback
@@ -482,18 +680,32 @@ class SubscriptionPurchase(Purchase):
             # SubscriptionItem.objects.filter(payment=self.pk).update(payment=None, subinvoice=F('subinvoice') + 1)  # called in cancel_subscription()
             pass
 
+    def schedule_cancel(self, is_upgrade=False):
+        """Queue canceling the subscription at the payment processor (see :class:`CancellationJob`).
+
+        Calling it again for the same :attr:`subscription_reference` returns the same job
+        (put back to the queue if it was dead).
+
+        Returns:
+            :class:`CancellationJob` or `None` if not :attr:`subscribed`."""
+        if not self.subscription_reference:
+            return None
+        return CancellationJob.enqueue(self, is_upgrade=is_upgrade)
+
     @django.db.transaction.atomic
     def activate_subscription(self, ref, email, processor):
         """Internal.
 
         "Competes" with :meth:`on_accept_regular_payment`."""
         SubscriptionPurchase.objects.filter(pk=self.pk).update(subscription_reference=ref, email=email, processor=processor)
+        self.invalidate_activity()
 
     def cancel_subscription(self):
         """Called when we detect that the subscription was canceled."""
         # atomic operation
         SubscriptionPurchase.objects.filter(pk=self.pk).update(
             payment=None, subscription_reference=None, processor=None, subinvoice=F('subinvoice') + 1)
+        self.invalidate_activity()
         if not self.old_subscription:  # don't send this email on plan upgrade
             self.cancel_subscription_email()
 
@@ -512,113 +724,11 @@ class SubscriptionPurchase(Purchase):
 
     @staticmethod
     def send_reminders():
-        """Send all email reminders."""
-        SubscriptionPurchase.send_regular_reminders()
-        SubscriptionPurchase.send_trial_reminders()
-
-    @staticmethod
-    def send_regular_reminders():
-        """Internal."""
-        # start with the last
-        SubscriptionPurchase.send_regular_before_due_reminders()
-        SubscriptionPurchase.send_regular_due_reminders()
-        SubscriptionPurchase.send_regular_deadline_reminders()
-
-    @staticmethod
-    def send_regular_before_due_reminders():
-        """Internal."""
-        days_before = settings.PAYMENTS_DAYS_BEFORE_DUE_REMIND
-        reminder_date = datetime.date.today() + datetime.timedelta(days=days_before)
-        q = SubscriptionPurchase.objects.filter(reminders_sent__lt=3, due_payment_date__lte=reminder_date, trial=False)
-        for purchase in q:
-            Item.objects.filter(pk=purchase.pk).update(reminders_sent=3)
-            url = reverse(settings.PROLONG_PAYMENT_VIEW, args=[purchase.pk])
-            purchase.send_rendered_email('debits/email/before-due-remind.html',
-                                     _("You need to pay for %s") % purchase.product.name,
-                                     {'transaction': purchase,
-                                      'product': purchase.product.name,
-                                      'url': url,
-                                      'days_before': days_before})
-
-    @staticmethod
-    def send_regular_due_reminders():
-        """Internal."""
-        reminder_date = datetime.date.today()
-        q = SubscriptionPurchase.objects.filter(reminders_sent__lt=2, due_payment_date__lte=reminder_date, trial=False)
-        for purchase in q:
-            Item.objects.filter(pk=purchase.pk).update(reminders_sent=2)
-            url = reverse(settings.PROLONG_PAYMENT_VIEW, args=[purchase.pk])
-            purchase.send_rendered_email('debits/email/due-remind.html',
-                                     _("You need to pay for %s") % purchase.product.name,
-                                     {'transaction': purchase,
-                                      'product': purchase.product.name,
-                                      'url': url})
-
-    @staticmethod
-    def send_regular_deadline_reminders():
-        """Internal."""
-        reminder_date = datetime.date.today()
-        q = SubscriptionPurchase.objects.filter(reminders_sent__lt=1, payment_deadline__lte=reminder_date, trial=False)
-        for purchase in q:
-            Item.objects.filter(pk=purchase.pk).update(reminders_sent=1)
-            url = reverse(settings.PROLONG_PAYMENT_VIEW, args=[purchase.pk])
-            purchase.send_rendered_email('debits/email/deadline-remind.html',
-                                     _("You need to pay for %s") % purchase.product.name,
-                                     {'transaction': purchase,
-                                      'product': purchase.product.name,
-                                      'url': url})
-
-    @staticmethod
-    def send_trial_reminders():
-        """Internal."""
-        # start with the last
-        SubscriptionPurchase.send_trial_before_due_reminders()
-        SubscriptionPurchase.send_trial_due_reminders()
-        SubscriptionPurchase.send_trial_deadline_reminders()
-
-    @staticmethod
-    def send_trial_before_due_reminders():
-        """Internal."""
-        days_before = settings.PAYMENTS_DAYS_BEFORE_TRIAL_END_REMIND
-        reminder_date = datetime.date.today() + datetime.timedelta(days=days_before)
-        q = SubscriptionPurchase.objects.filter(reminders_sent__lt=3, due_payment_date__lte=reminder_date, trial=True)
-        for purchase in q:
-            Item.objects.filter(pk=purchase.pk).update(reminders_sent=3)
-            url = reverse(settings.PROLONG_PAYMENT_VIEW, args=[purchase.pk])
-            purchase.send_rendered_email('debits/email/before-due-remind.html',
-                                     _("You need to pay for %s") % purchase.product.name,
-                                     {'transaction': purchase,
-                                      'product': purchase.product.name,
-                                      'url': url,
-                                      'days_before': days_before})
-
-    @staticmethod
-    def send_trial_due_reminders():
-        """Internal."""
-        reminder_date = datetime.date.today()
-        q = SubscriptionPurchase.objects.filter(reminders_sent__lt=2, due_payment_date__lte=reminder_date, trial=True)
-        for purchase in q:
-            Item.objects.filter(pk=purchase.pk).update(reminders_sent=2)
-            url = reverse(settings.PROLONG_PAYMENT_VIEW, args=[purchase.pk])
-            purchase.send_rendered_email('debits/email/due-remind.html',
-                                     _("You need to pay for %s") % purchase.product.name,
-                                     {'transaction': purchase,
-                                      'product': purchase.product.name,
-                                      'url': url})
+        """Send all email reminders.
 
-    @staticmethod
-    def send_trial_deadline_reminders():
-        """Internal."""
-        reminder_date = datetime.date.today()
-        q = SubscriptionPurchase.objects.filter(reminders_sent__lt=1, payment_deadline__lte=reminder_date, trial=True)
-        for purchase in q:
-            Item.objects.filter(pk=purchase.pk).update(reminders_sent=1)
-            url = reverse(settings.PROLONG_PAYMENT_VIEW, args=[purchase.pk])
-            purchase.send_rendered_email('debits/email/deadline-remind.html',
-                                     _("You need to pay for %s") % purchase.product.name,
-                                     {'transaction': purchase,
-                                      'product': purchase.product.name,
-                                      'url': url})
+        See :class:`~debits.debits_base.reminders.ReminderEngine`."""
+        from debits.debits_base.reminders import ReminderEngine
+        ReminderEngine().run()
 
     # TODO
     # def get_email(self):
@@ -631,6 +741,47 @@ class SubscriptionPurchase(Purchase):
     #         return None
 
 
+class BillingContext(object):
+    """Everything needed to process a notification about a subscription transaction.
+
+    :meth:`load` fetches the transaction, its :class:`SubscriptionPurchase`, :class:`SubscriptionItem`,
+    product and payment processor with one query, so that handlers don't walk
+    `transaction.purchase.item.subscriptionitem` query by query."""
+
+    def __init__(self, transaction):
+        self.transaction = transaction
+        """:class:`SubscriptionTransaction`."""
+
+        self.purchase = transaction.purchase
+        """:class:`SubscriptionPurchase`."""
+
+        self.item = self.purchase.item.subscriptionitem
+        """:class:`SubscriptionItem`."""
+
+    @classmethod
+    def load(cls, transaction_id, for_update=False):
+        """Load the context of a :class:`SubscriptionTransaction`.
+
+        Raises :class:`SubscriptionTransaction.DoesNotExist` if there is no such transaction.
+
+        Args:
+            for_update: lock the purchase until the end of the current DB transaction,
+                so that notifications about the same subscription are processed one by one."""
+        if for_update:
+            # Lock before reading. (Locking the select_related() query below is not possible,
+            # as some databases don't lock the nullable side of an outer join.)
+            list(SubscriptionPurchase.objects.select_for_update().filter(transactions=transaction_id).
+                 values_list('pk', flat=True))
+        transaction = SubscriptionTransaction.objects.select_related(
+            'processor',
+            'purchase__subscriptionpurchase__item__subscriptionitem',
+            'purchase__subscriptionpurchase__item__product',
+            'purchase__subscriptionpurchase__payment').get(pk=transaction_id)
+        # Use the fetched subclass instance, so that `transaction.purchase.item` etc. need no more queries
+        transaction.purchase = transaction.purchase.subscriptionpurchase
+        return cls(transaction)
+
+
 class ProlongPurchase(SimplePurchase):
     """Prolong :attr:`prolonged` item.
 
@@ -706,49 +857,291 @@ class AutomaticPayment(Payment):
     # code = models.CharField(max_length=255)
 
 
+def money_sum(field):
+    """Internal.
+
+    Sum of a money field (zero if no rows)."""
+    output_field = models.DecimalField(max_digits=10, decimal_places=2)
+    return Coalesce(Sum(field, output_field=output_field), Value(0), output_field=output_field)
+
+
+def money(value):
+    """Internal.
+
+    Round to cents (SQLite sums decimals as floats)."""
+    return decimal.Decimal(value).quantize(decimal.Decimal('0.01'))
+
+
 class AggregateItem(SimpleItem):
     """Several payments in one.
 
+    Its :attr:`price` is the sum of prices of the children of the :class:`AggregatePurchase`
+    (normally one) of this item.
+
     TODO: Not tested!"""
 
     def calc(self):
-        """Update price to be the sum of all children."""
-        price = 0.0
-        for child in self.childs.all():
-            price += child.price
+        """Update price to be the sum of all children (by one aggregate query)."""
+        price = money(Item.objects.filter(purchase__parent__item=self).aggregate(price=money_sum('price'))['price'])
+        Item.objects.filter(pk=self.pk).update(price=price)
         self.price = price
-        self.save()
 
 
 class AggregatePurchase(SimplePurchase):
     """Several payments in one.
 
+    Its :attr:`~Purchase.shipping` and :attr:`~Purchase.tax` (and the price of its :class:`AggregateItem`)
+    are the sums of these of the children. Use :meth:`add_child`, :meth:`remove_child` and :meth:`reprice_child`
+    to keep them up to date in constant time or :meth:`calc` to recalculate.
+
     TODO: Not tested!"""
 
     def calc(self):
-        """Update shipping and tax to be the sum of all children.
-
-        TODO: Also tax."""
-        self.item.simpleitem.aggregateitem.calc()
-        shipping = 0.0
-        tax = 0.0
-        for child in self.childs.all():
-            shipping += child.shipping
-            tax += child.tax
-        self.shipping = shipping
-        self.tax = tax
-        self.save()
+        """Recalculate shipping, tax and the item price to be the sums of all children.
+
+        One aggregate query and targeted updates, whatever the number of children."""
+        totals = Purchase.objects.filter(parent=self).aggregate(shipping=money_sum('shipping'),
+                                                                tax=money_sum('tax'),
+                                                                price=money_sum('item__price'))
+        totals = {name: money(value) for name, value in totals.items()}
+        Purchase.objects.filter(pk=self.pk).update(shipping=totals['shipping'], tax=totals['tax'])
+        Item.objects.filter(pk=self.item_id).update(price=totals['price'])
+        self.shipping = totals['shipping']
+        self.tax = totals['tax']
+
+    @staticmethod
+    def lock_child(purchase):
+        """Internal.
+
+        Lock the row of `purchase` (and its item) and read its current values, so that the deltas
+        are computed from what is in the DB rather than from a possibly stale `purchase`."""
+        return Purchase.objects.select_for_update().select_related('item').get(pk=purchase.pk)
+
+    @transaction.atomic
+    def add_child(self, purchase):
+        """Make `purchase` a part of this one and add its price, shipping and tax to the totals.
+
+        If `purchase` is a child of another aggregate, it is removed from that one first.
+        Does nothing if it is already a child of this one."""
+        locked = self.lock_child(purchase)
+        if locked.parent_id == self.pk:
+            purchase.parent = self
+            return
+        if Purchase.objects.filter(pk=purchase.pk, parent_id=locked.parent_id).update(parent=self) != 1:
+            return
+        purchase.parent = self
+        if locked.parent_id is not None:
+            previous = AggregatePurchase.objects.get(pk=locked.parent_id)
+            previous.add_to_totals(-locked.item.price, -locked.shipping, -locked.tax)
+        self.add_to_totals(locked.item.price, locked.shipping, locked.tax)
+
+    @transaction.atomic
+    def remove_child(self, purchase):
+        """Remove `purchase` from this one and subtract its price, shipping and tax from the totals.
+
+        Does nothing if it is not a child of this one."""
+        locked = self.lock_child(purchase)
+        if Purchase.objects.filter(pk=purchase.pk, parent=self).update(parent=None) != 1:
+            return
+        purchase.parent = None
+        self.add_to_totals(-locked.item.price, -locked.shipping, -locked.tax)
+
+    @transaction.atomic
+    def reprice_child(self, purchase, price=None, shipping=None, tax=None):
+        """Change price (of its item), shipping or tax of the child `purchase` and update the totals.
+
+        Raises `ValueError` if `purchase` is not a child of this one."""
+        locked = self.lock_child(purchase)
+        if locked.parent_id != self.pk:
+            raise ValueError("Purchase %d is not a child of %d" % (purchase.pk, self.pk))
+        zero = decimal.Decimal(0)
+        deltas = [zero, zero, zero]
+        if price is not None:
+            deltas[0] = decimal.Decimal(price) - locked.item.price
+            Item.objects.filter(pk=locked.item_id).update(price=price)
+            purchase.item.price = decimal.Decimal(price)
+        fields = {}
+        if shipping is not None:
+            deltas[1] = decimal.Decimal(shipping) - locked.shipping
+            fields['shipping'] = purchase.shipping = decimal.Decimal(shipping)
+        if tax is not None:
+            deltas[2] = decimal.Decimal(tax) - locked.tax
+            fields['tax'] = purchase.tax = decimal.Decimal(tax)
+        if fields:
+            Purchase.objects.filter(pk=purchase.pk).update(**fields)
+        self.add_to_totals(*deltas)
+
+    def add_to_totals(self, price, shipping, tax):
+        """Internal.
+
+        Apply deltas by updates with :class:`~django.db.models.F` expressions, so that concurrent changes
+        of other children are not lost (the callers lock the changed child)."""
+        if shipping or tax:
+            Purchase.objects.filter(pk=self.pk).update(shipping=F('shipping') + shipping, tax=F('tax') + tax)
+            self.shipping += shipping
+            self.tax += tax
+        if price:
+            Item.objects.filter(pk=self.item_id).update(price=F('price') + price)
 
     @property
     def is_aggregate(self):
         return True
 
 
+class OutgoingEmail(QueueItem):
+    """An email in the outbox, sent by ``manage.py send_outbox``.
+
+    It is created in the same DB transaction as the state change it notifies about,
+    so an email is never lost or sent for a rolled back change, and no request waits for SMTP.
+    Used if ``PAYMENTS_EMAIL_OUTBOX`` setting is true."""
+
+    subject = models.CharField(max_length=255)
+
+    from_email = models.CharField(max_length=255)
+
+    to = models.EmailField()
+
+    text = models.TextField()
+    """Plain text body."""
+
+    html = models.TextField(null=True)
+    """HTML body."""
+
+    max_attempts_setting = 'PAYMENTS_EMAIL_MAX_ATTEMPTS'
+
+    def __repr__(self):
+        return "<OutgoingEmail: %s>" % (("pk=%d" % self.pk) if self.pk else "no pk")
+
+    def message(self):
+        """:class:`django.core.mail.EmailMultiAlternatives` to send."""
+        message = EmailMultiAlternatives(self.subject, self.text, self.from_email, [self.to])
+        if self.html:
+            message.attach_alternative(self.html, 'text/html')
+        return message
+
+    def process(self):
+        # keep the connection of this worker thread open between emails
+        connection = getattr(_outbox_connections, 'connection', None)
+        if connection is None:
+            connection = get_connection()
+            connection.open()
+            _outbox_connections.connection = connection
+        try:
+            connection.send_messages([self.message()])
+        except Exception:
+            _outbox_connections.connection = None
+            try:
+                connection.close()
+            except Exception:
+                pass
+            raise
+
+    @classmethod
+    def prune(cls, before, batch_size=1000):
+        """Delete sent and dead emails finished before `before` datetime, `batch_size` rows per query.
+
+        Returns:
+            The number of deleted emails."""
+        deleted = 0
+        while True:
+            pks = list(cls.objects.filter(status__in=(QueueStatus.DONE, QueueStatus.DEAD), finished__lt=before).
+                       order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                return deleted
+            deleted += cls.objects.filter(pk__in=pks).delete()[0]
+
+
+_outbox_connections = threading.local()
+
+
+class CancellationJob(QueueItem):
+    """Canceling a subscription at the payment processor, done by ``manage.py process_cancellations``.
+
+    Created by :meth:`SubscriptionPurchase.schedule_cancel` (if ``PAYMENTS_CANCEL_QUEUE`` setting is true,
+    or when :meth:`SubscriptionPurchase.force_cancel` finds the processor temporarily unavailable),
+    so that neither a user request nor an IPN waits for the payment processor.
+    There is at most one job per :attr:`subscription_reference`,
+    so repeated requests (such as a double click or an IPN delivered twice) cancel once.
+
+    Temporary failures are retried (see :class:`~debits.debits_base.queue.QueueItem`). If the processor refuses
+    to cancel, the purchase is detached from the subscription as in :meth:`SubscriptionPurchase.force_cancel`
+    and the job is finished with :attr:`error`."""
+
+    purchase = models.ForeignKey(SubscriptionPurchase, on_delete=models.CASCADE, related_name='cancellations')
+
+    subscription_reference = models.CharField(max_length=255, unique=True)
+    """The subscription to cancel (the purchase may get another one later)."""
+
+    processor = models.ForeignKey(PaymentProcessor, on_delete=models.CASCADE)
+
+    is_upgrade = models.BooleanField(default=False)
+    """Canceled because of a plan upgrade."""
+
+    error = models.TextField(null=True)
+    """The message of the payment processor which refused to cancel."""
+
+    max_attempts_setting = 'PAYMENTS_CANCEL_MAX_ATTEMPTS'
+
+    def __repr__(self):
+        return "<CancellationJob: %s>" % (("pk=%d" % self.pk) if self.pk else "no pk")
+
+    @classmethod
+    def enqueue(cls, purchase, is_upgrade=False):
+        """Internal.
+
+        Use :meth:`SubscriptionPurchase.schedule_cancel`."""
+        job, created = cls.objects.get_or_create(subscription_reference=purchase.subscription_reference,
+                                                 defaults={'purchase': purchase,
+                                                           'processor_id': purchase.processor_id,
+                                                           'is_upgrade': is_upgrade})
+        if not created and job.status == QueueStatus.DEAD:
+            # the user asks again, so try again (conditionally, in case it was already put back)
+            if cls.objects.filter(pk=job.pk, status=QueueStatus.DEAD).\
+                    update(status=QueueStatus.PENDING, attempts=0, next_attempt=timezone.now()):
+                job.refresh_from_db()
+        return job
+
+    process_in_transaction = False  # not to keep a transaction open while waiting for the processor
+
+    def process(self):
+        klass = model_from_ref(self.processor.klass)
+        try:
+            klass().api().cancel_agreement(self.subscription_reference, is_upgrade=self.is_upgrade)
+        except CannotCancelSubscription as e:
+            logger.warn("Cannot cancel subscription " + self.subscription_reference)
+            with transaction.atomic(using=CancellationJob.objects.db):
+                # fallback (unless the purchase has already got another subscription)
+                SubscriptionPurchase.objects.\
+                    filter(pk=self.purchase_id, subscription_reference=self.subscription_reference).\
+                    update(payment=None, processor=None, subscription_reference=None, subinvoice=F('subinvoice') + 1)
+                CancellationJob.objects.filter(pk=self.pk).update(error=str(e))
+            activity_cache().invalidate(self.purchase_id)
+
+    def state(self):
+        """The progress to show to the user.
+
+        Returns:
+            A dict with `status` (``'pending'``, ``'done'`` or ``'failed'``) and `message` (for failures)."""
+        if self.status in (QueueStatus.PENDING, QueueStatus.PROCESSING):
+            return {'status': 'pending', 'message': None}
+        if self.status == QueueStatus.DEAD:
+            return {'status': 'failed',
+                    'message': _("Cannot cancel the subscription now. Please contact support.")}
+        if self.error is not None:
+            return {'status': 'failed', 'message': self.error}
+        return {'status': 'done', 'message': None}
+
+
 class CannotCancelSubscription(Exception):
     """Canceling subscription failed."""
     pass
 
 
+class ProcessorUnavailable(Exception):
+    """The payment processor failed temporarily (network or server error, rate limiting): try again later."""
+    pass
+
+
 class CannotRefund(Exception):
     """Refunding payment failed."""
     pass
@@ -0,0 +1,260 @@
+import datetime
+import threading
+import time
+import traceback
+import uuid
+
+import django.db
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.translation import ugettext_lazy as _
+
+from debits.debits_base.base import logger
+
+
+class QueueStatus(object):
+    """States of a :class:`QueueItem`."""
+    PENDING = 1
+    PROCESSING = 2
+    DONE = 3
+    DEAD = 4
+    """Failed :meth:`QueueItem.get_max_attempts` times, not retried anymore."""
+
+
+class QueueItem(models.Model):
+    """A unit of work stored in the DB and processed by :func:`run_workers`.
+
+    Items are claimed with ``SELECT ... FOR UPDATE SKIP LOCKED`` (where the DB supports it)
+    followed by a conditional UPDATE, so any number of worker threads, processes or hosts
+    may drain the same table without processing an item twice.
+
+    Derived models implement :meth:`process`."""
+
+    class Meta:
+        abstract = True
+
+    status = models.SmallIntegerField(_('Queue status'), default=QueueStatus.PENDING, db_index=True)  # QueueStatus
+    """See :class:`QueueStatus`."""
+
+    creation_date = models.DateTimeField(auto_now_add=True)
+    """When the item was queued."""
+
+    attempts = models.PositiveSmallIntegerField(default=0)
+    """How many times the item was claimed."""
+
+    next_attempt = models.DateTimeField(default=timezone.now, db_index=True)
+    """Don't process the item before this time (backoff after failures)."""
+
+    claim = models.CharField(max_length=32, null=True, db_index=True)
+    """Internal.
+
+    The token of the worker batch which processes the item."""
+
+    claimed_at = models.DateTimeField(null=True)
+    """When the item was claimed by a worker."""
+
+    finished = models.DateTimeField(null=True)
+    """When the item was processed (or declared dead)."""
+
+    last_error = models.TextField(null=True)
+    """The traceback of the last failure."""
+
+    max_attempts = 8
+    """After this number of failures the item becomes :attr:`QueueStatus.DEAD`
+    (unless overridden by :attr:`max_attempts_setting`)."""
+
+    max_attempts_setting = None
+    """The name of the setting which overrides :attr:`max_attempts` (or `None`)."""
+
+    backoff = 60
+    """Seconds before the first retry. It doubles after every failure."""
+
+    max_backoff = 6 * 3600
+    """Upper bound (in seconds) for the delay between retries."""
+
+    lease = 15 * 60
+    """Seconds after which an item claimed by a crashed worker is claimed again."""
+
+    process_in_transaction = True
+    """Run :meth:`process` in a DB transaction, so that a failure rolls back its partial writes.
+    Set it to `False` if it waits for the network: then :meth:`process` keeps its own transactions short."""
+
+    def process(self):
+        """Do the work. Raise an exception to retry later."""
+        raise NotImplementedError()
+
+    @classmethod
+    def get_max_attempts(cls):
+        """:attr:`max_attempts` or the value of :attr:`max_attempts_setting` (read on every call)."""
+        if cls.max_attempts_setting is None:
+            return cls.max_attempts
+        return getattr(settings, cls.max_attempts_setting, cls.max_attempts)
+
+    @classmethod
+    def claimable(cls, now):
+        """Items which are not done, not waiting for a retry and not being processed by a live worker."""
+        return cls.objects.filter(Q(status=QueueStatus.PENDING, next_attempt__lte=now) |
+                                  Q(status=QueueStatus.PROCESSING, claimed_at__lt=now - datetime.timedelta(seconds=cls.lease)))
+
+    @classmethod
+    def ready(cls, now):
+        """Items which may be claimed now.
+
+        Override it to restrict :meth:`claimable` items further (for example, to keep an order)."""
+        return cls.claimable(now)
+
+    @classmethod
+    def claim_batch(cls, limit):
+        """Atomically take up to `limit` ready items for processing.
+
+        Returns:
+            A list of claimed items."""
+        now = timezone.now()
+        token = uuid.uuid4().hex
+        connection = django.db.connections[cls.objects.db]
+        with transaction.atomic(using=cls.objects.db):
+            qs = cls.ready(now).order_by('pk')
+            if connection.features.has_select_for_update_skip_locked:
+                qs = qs.select_for_update(skip_locked=True)
+            pks = list(qs.values_list('pk', flat=True)[:limit])
+            if not pks:
+                return []
+            # the condition is repeated for DBs without row locks (such as SQLite)
+            cls.claimable(now).filter(pk__in=pks).update(status=QueueStatus.PROCESSING,
+                                                         claim=token,
+                                                         claimed_at=now,
+                                                         attempts=F('attempts') + 1)
+        return list(cls.objects.filter(claim=token, status=QueueStatus.PROCESSING).order_by('pk'))
+
+    def mark_done(self):
+        """Internal."""
+        type(self).objects.filter(pk=self.pk, claim=self.claim).update(status=QueueStatus.DONE,
+                                                                       finished=timezone.now())
+
+    def mark_failed(self, error):
+        """Internal.
+
+        Schedules a retry with exponential backoff or declares the item dead."""
+        now = timezone.now()
+        if self.attempts >= self.get_max_attempts():
+            type(self).objects.filter(pk=self.pk, claim=self.claim).update(status=QueueStatus.DEAD,
+                                                                           finished=now,
+                                                                           last_error=error)
+            logger.error("%s pk=%d is dead after %d attempts" % (type(self).__name__, self.pk, self.attempts))
+        else:
+            delay = min(self.backoff * 2 ** (self.attempts - 1), self.max_backoff)
+            type(self).objects.filter(pk=self.pk, claim=self.claim).update(
+                status=QueueStatus.PENDING,
+                next_attempt=now + datetime.timedelta(seconds=delay),
+                last_error=error)
+
+    def retry(self):
+        """Return a dead (or finished) item back to the queue."""
+        type(self).objects.filter(pk=self.pk).update(status=QueueStatus.PENDING,
+                                                     attempts=0,
+                                                     next_attempt=timezone.now())
+
+
+class WorkerStats(object):
+    """Throughput of one worker of :func:`run_workers`."""
+
+    def __init__(self, name):
+        self.name = name
+        self.processed = 0
+        self.failed = 0
+        self.started = time.monotonic()
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    @property
+    def throughput(self):
+        """Items per second."""
+        elapsed = self.elapsed
+        return (self.processed + self.failed) / elapsed if elapsed > 0 else 0.0
+
+    def __str__(self):
+        return "%s: %d processed, %d failed in %.1fs (%.2f/s)" % \
+               (self.name, self.processed, self.failed, self.elapsed, self.throughput)
+
+
+def process_batch(model, stats, limit):
+    """Claim and process one batch.
+
+    Returns:
+        The number of claimed items."""
+    items = model.claim_batch(limit)
+    for item in items:
+        if item.attempts > item.get_max_attempts():  # reclaimed after a crash too many times
+            item.mark_failed(item.last_error or "Lease expired")
+            stats.failed += 1
+            continue
+        try:
+            if item.process_in_transaction:
+                # a failure rolls back partial writes, so that a retry starts from scratch
+                with transaction.atomic(using=model.objects.db):
+                    item.process()
+            else:
+                item.process()
+        except Exception:
+            logger.exception("Processing %s pk=%d failed" % (model.__name__, item.pk))
+            item.mark_failed(traceback.format_exc())
+            stats.failed += 1
+        else:
+            item.mark_done()
+            stats.processed += 1
+    return len(items)
+
+
+def run_workers(model, workers=1, batch=10, once=False, idle_sleep=1.0, report_interval=None, stop=None):
+    """Process items of the :class:`QueueItem` subclass `model` in `workers` threads.
+
+    Start this in several processes (or hosts) to use more CPUs.
+
+    Args:
+        once: exit when no more items can be claimed (instead of waiting for new items).
+        report_interval: log the throughput of every worker each this number of seconds.
+        stop: :class:`threading.Event` to stop the workers.
+
+    Returns:
+        A list of :class:`WorkerStats`."""
+    stop = stop or threading.Event()
+    all_stats = [WorkerStats("%s worker %d" % (model.__name__, i)) for i in range(workers)]
+
+    def work(stats):
+        try:
+            while not stop.is_set():
+                try:
+                    claimed = process_batch(model, stats, batch)
+                except django.db.Error:  # such as a deadlock or "database is locked"
+                    logger.exception("Claiming %s failed" % model.__name__)
+                    stop.wait(idle_sleep)
+                    continue
+                if not claimed:
+                    # items may be not ready only because they wait for other items
+                    if once and not model.claimable(timezone.now()).exists():
+                        break
+                    stop.wait(idle_sleep)
+        finally:
+            django.db.connection.close()
+
+    threads = [threading.Thread(target=work, args=(stats,), name=stats.name) for stats in all_stats]
+    for thread in threads:
+        thread.start()
+    last_report = time.monotonic()
+    try:
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(timeout=1.0)
+            if report_interval and time.monotonic() - last_report >= report_interval:
+                for stats in all_stats:
+                    logger.info(str(stats))
+                last_report = time.monotonic()
+    except KeyboardInterrupt:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    return all_stats
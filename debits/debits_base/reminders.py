@@ -0,0 +1,253 @@
+import datetime
+import threading
+import time
+
+import django.db
+from django.conf import settings
+from django.db import transaction
+from django.db.models.functions import Mod
+from django.urls import reverse
+from django.utils.translation import ugettext_noop
+
+from debits.debits_base.base import logger
+from debits.debits_base.mail import MailDispatcher, OutboxWriter
+from debits.debits_base.models import Purchase, SubscriptionPurchase
+from debits.debits_base.queue import WorkerStats
+from debits.debits_base.rendering import email_renderer
+
+
+REMINDER_SUBJECT = ugettext_noop("You need to pay for %s")
+
+
+class ReminderPhase(object):
+    """One kind of payment reminders (such as "today is the due payment date" for trial subscriptions).
+
+    A reminder is sent to every :class:`~debits.debits_base.models.SubscriptionPurchase` with
+    `date_field` before or at the reminder date, which was not yet sent this or a later reminder
+    (:attr:`~debits.debits_base.models.Purchase.reminders_sent` is less than `level`)."""
+
+    def __init__(self, level, trial, date_field, template, days_before_setting=None):
+        self.level = level
+        """The value of :attr:`~debits.debits_base.models.Purchase.reminders_sent` after sending this reminder."""
+
+        self.trial = trial
+        """For trial or for regular subscriptions."""
+
+        self.date_field = date_field
+        """`'due_payment_date'` or `'payment_deadline'`."""
+
+        self.template = template
+        """Email template."""
+
+        self.days_before_setting = days_before_setting
+        """The name of the setting with the number of days before the date to remind (or `None`)."""
+
+    def __str__(self):
+        return "%s %s reminders" % ("trial" if self.trial else "regular", self.template)
+
+    def days_before(self):
+        return getattr(settings, self.days_before_setting) if self.days_before_setting else 0
+
+    def due(self, today):
+        """Purchases to remind."""
+        reminder_date = today + datetime.timedelta(days=self.days_before())
+        return SubscriptionPurchase.objects.filter(trial=self.trial,
+                                                   reminders_sent__lt=self.level,
+                                                   **{self.date_field + '__lte': reminder_date})
+
+    def shared_data(self, purchase):
+        """Template variables which are the same for all purchases of a product."""
+        data = {'product': purchase.item.product.name}
+        if self.days_before_setting:
+            data['days_before'] = self.days_before()
+        return data
+
+    def data(self, purchase, url):
+        """Template variables."""
+        return dict(self.shared_data(purchase), transaction=purchase, url=url)
+
+
+# Start with the last, so that an overdue purchase receives only the latest reminder.
+PHASES = [
+    ReminderPhase(3, False, 'payment_deadline', 'debits/email/deadline-remind.html'),
+    ReminderPhase(2, False, 'due_payment_date', 'debits/email/due-remind.html'),
+    ReminderPhase(1, False, 'due_payment_date', 'debits/email/before-due-remind.html',
+                  'PAYMENTS_DAYS_BEFORE_DUE_REMIND'),
+    ReminderPhase(3, True, 'payment_deadline', 'debits/email/deadline-remind.html'),
+    ReminderPhase(2, True, 'due_payment_date', 'debits/email/due-remind.html'),
+    ReminderPhase(1, True, 'due_payment_date', 'debits/email/before-due-remind.html',
+                  'PAYMENTS_DAYS_BEFORE_TRIAL_END_REMIND'),
+]
+"""All reminders, in the order of sending."""
+
+
+class ReminderEngine(object):
+    """Sends payment reminders in chunks of `chunk_size` purchases.
+
+    Every chunk costs a constant number of queries: select the due primary keys, claim them by
+    one bulk UPDATE of :attr:`~debits.debits_base.models.Purchase.reminders_sent`, load the data
+    for emails. Memory use is bounded by the chunk size.
+
+    The purchases are split among `workers` threads by primary key modulo the number of workers.
+    To run on several processes or hosts, give each of them the same `workers` and `partitions`
+    and a different `partition` (from 0 to `partitions - 1`). Claims use ``SELECT ... FOR UPDATE SKIP LOCKED``
+    where the DB supports it, so even overlapping runs don't remind a purchase twice.
+
+    The claimed :attr:`~debits.debits_base.models.Purchase.reminders_sent` is the checkpoint: a run which
+    died halfway is resumed by starting it again.
+
+    If ``PAYMENTS_EMAIL_SKELETONS`` setting is true, emails are rendered from memoized skeletons
+    (see :class:`~debits.debits_base.rendering.EmailRenderer`), which is much faster, but templates
+    get only `product`, `url` and `days_before` variables (not `transaction`). It is off by default,
+    so that overridden templates which use `transaction` keep working.
+
+    If ``PAYMENTS_EMAIL_OUTBOX`` setting is true, emails are queued in
+    :class:`~debits.debits_base.models.OutgoingEmail` in the transaction which claims the chunk
+    (so that no email is lost if the run dies). Otherwise the emails of a chunk are sent before
+    the next chunk is claimed, so a run which dies loses the emails of at most one chunk.
+
+    Configured by setting ``PAYMENTS_REMINDERS_CHUNK_SIZE`` (default 1000)."""
+
+    def __init__(self, chunk_size=None, today=None, workers=1, partition=0, partitions=1, report_interval=None):
+        self.chunk_size = chunk_size or getattr(settings, 'PAYMENTS_REMINDERS_CHUNK_SIZE', 1000)
+        self.today = today or datetime.date.today()
+        self.workers = workers
+        self.partition = partition
+        self.partitions = partitions
+        self.report_interval = report_interval
+        self.skeletons = getattr(settings, 'PAYMENTS_EMAIL_SKELETONS', False)
+        self.outbox = getattr(settings, 'PAYMENTS_EMAIL_OUTBOX', False)
+        self.stats = [WorkerStats("Reminder worker %d" % i) for i in range(workers)]
+        """:class:`~debits.debits_base.queue.WorkerStats` of every worker (`processed` are reminded purchases)."""
+        self._last_report = time.monotonic()
+        self._report_lock = threading.Lock()
+
+    def run(self, phases=PHASES):
+        """Send all reminders.
+
+        Returns:
+            The number of purchases reminded by every phase (a list)."""
+        dispatchers = [OutboxWriter() if self.outbox else MailDispatcher() for i in range(self.workers)]
+        try:
+            # a phase is finished before the next one, so that an overdue purchase receives only the latest reminder
+            counts = [self.run_phase(phase, dispatchers) for phase in phases]
+        finally:
+            for dispatcher in dispatchers:
+                dispatcher.close()
+        for stats, dispatcher in zip(self.stats, dispatchers):
+            stats.failed = len(dispatcher.failed)
+        logger.info("Reminder emails: %d sent, %d failed" %
+                    (sum(d.sent for d in dispatchers), sum(len(d.failed) for d in dispatchers)))
+        return counts
+
+    def run_phase(self, phase, dispatchers):
+        """Send reminders of one kind."""
+        if self.workers == 1:
+            count = self.work(phase, 0, dispatchers[0])
+        else:
+            counts = [0] * self.workers
+            errors = [None] * self.workers
+
+            def work(i):
+                try:
+                    counts[i] = self.work(phase, i, dispatchers[i])
+                except Exception as e:
+                    errors[i] = e
+                finally:
+                    django.db.connection.close()
+
+            threads = [threading.Thread(target=work, args=(i,), name=self.stats[i].name) for i in range(self.workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            for error in errors:
+                if error is not None:
+                    raise error  # in this thread, so that a failed run doesn't look finished
+            count = sum(counts)
+        logger.info("Sent %s: %d" % (phase, count))
+        return count
+
+    def work(self, phase, worker, dispatcher):
+        """Internal.
+
+        Reminds the purchases of the `worker`."""
+        count = 0
+        last_pk = None
+        residues = self.partitions * self.workers
+        qs = phase.due(self.today).order_by('pk')
+        if residues > 1:
+            qs = qs.annotate(residue=Mod('pk', residues)).filter(residue=self.partition * self.workers + worker)
+        while True:
+            chunk = qs if last_pk is None else qs.filter(pk__gt=last_pk)
+            pks = list(chunk.values_list('pk', flat=True)[:self.chunk_size])
+            if not pks:
+                break
+            last_pk = pks[-1]
+            reminded = self.remind_chunk(phase, pks, dispatcher)
+            count += reminded
+            self.stats[worker].processed += reminded
+            self.report()
+        return count
+
+    def report(self):
+        """Internal.
+
+        Log progress each `report_interval` seconds."""
+        if not self.report_interval:
+            return
+        with self._report_lock:
+            if time.monotonic() - self._last_report < self.report_interval:
+                return
+            self._last_report = time.monotonic()
+        for stats in self.stats:
+            logger.info(str(stats))
+
+    def claim(self, phase, pks):
+        """Mark the purchases as reminded.
+
+        Returns:
+            Primary keys of purchases which were not reminded concurrently."""
+        db = SubscriptionPurchase.objects.db
+        with transaction.atomic(using=db):
+            qs = SubscriptionPurchase.objects.filter(pk__in=pks, reminders_sent__lt=phase.level)
+            if django.db.connections[db].features.has_select_for_update_skip_locked:
+                qs = qs.select_for_update(skip_locked=True)
+            pks = list(qs.values_list('pk', flat=True))
+            # `reminders_sent` is in the parent table, so one UPDATE serves the whole chunk
+            Purchase.objects.filter(pk__in=pks).update(reminders_sent=phase.level)
+        return pks
+
+    def remind_chunk(self, phase, pks, dispatcher):
+        """Internal."""
+        if not self.outbox:
+            count = self.do_remind_chunk(phase, pks, dispatcher)
+            dispatcher.flush()  # send before claiming the next chunk
+            return count
+        # the emails are queued in the transaction which claims the purchases
+        with transaction.atomic(using=SubscriptionPurchase.objects.db):
+            count = self.do_remind_chunk(phase, pks, dispatcher)
+            dispatcher.flush()
+        return count
+
+    def do_remind_chunk(self, phase, pks, dispatcher):
+        """Internal."""
+        pks = self.claim(phase, pks)
+        purchases = SubscriptionPurchase.objects.filter(pk__in=pks, payment__isnull=False).\
+            select_related('item__product', 'payment').\
+            only('due_payment_date', 'payment_deadline', 'item__product__name', 'payment__email')
+        subject = email_renderer().subject(REMINDER_SUBJECT)
+        for purchase in purchases:
+            url = settings.PAYMENTS_HOST + reverse(settings.PROLONG_PAYMENT_VIEW, args=[purchase.pk])
+            if self.skeletons:
+                purchase.send_rendered_email(phase.template,
+                                             subject % purchase.item.product.name,
+                                             phase.shared_data(purchase),
+                                             dispatcher=dispatcher,
+                                             recipient_data={'url': url})
+            else:
+                purchase.send_rendered_email(phase.template,
+                                             subject % purchase.item.product.name,
+                                             phase.data(purchase, url),
+                                             dispatcher=dispatcher)
+        return len(pks)
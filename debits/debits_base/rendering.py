@@ -0,0 +1,120 @@
+import re
+import threading
+import uuid
+from collections import OrderedDict
+
+import html2text
+from django.template.loader import get_template
+from django.utils import translation
+from django.utils.html import escape
+
+
+class EmailRenderer(object):
+    """Renders notification emails to HTML and plain text, caching everything that does not
+    depend on the recipient.
+
+    * compiled templates (by name);
+    * translated subjects (by message and language);
+    * skeletons: a template rendered and converted by :mod:`html2text` with markers in place of
+      per-recipient fields (such as the payment URL), by template, language and shared fields
+      (such as the product name). Rendering a message from a skeleton is a string substitution.
+
+    A skeleton is converted to text without wrapping lines, the lines are wrapped after the substitution.
+    A value substituted into a skeleton must not be changed by :mod:`html2text` (it is checked),
+    otherwise the message is rendered in full, so the result is always the same.
+
+    Use :func:`email_renderer` instead of creating this object."""
+
+    SAFE_VALUE = re.compile(r'^[A-Za-z0-9_:/?=&%.\-~+,#@;!$]*$')
+    """Values which :mod:`html2text` leaves as is (except of unescaping ``&amp;``)."""
+
+    def __init__(self, max_skeletons=1000):
+        self.max_skeletons = max_skeletons
+        self._templates = {}
+        self._subjects = {}
+        self._skeletons = OrderedDict()
+        self._lock = threading.Lock()
+        self.skeleton_hits = 0
+        self.skeleton_misses = 0
+        self._wrapper = html2text.HTML2Text()  # used only to wrap lines
+
+    def template(self, template_name):
+        """The compiled template."""
+        template = self._templates.get(template_name)
+        if template is None:
+            template = get_template(template_name)
+            self._templates[template_name] = template
+        return template
+
+    def subject(self, message):
+        """The translation of `message` (marked by :func:`django.utils.translation.ugettext_noop`)
+        into the current language."""
+        key = (message, translation.get_language())
+        subject = self._subjects.get(key)
+        if subject is None:
+            subject = translation.ugettext(message)
+            self._subjects[key] = subject
+        return subject
+
+    def render(self, template_name, data):
+        """Render an email.
+
+        Returns:
+            A pair (HTML, plain text)."""
+        html = self.template(template_name).render(data)
+        return html, html2text.html2text(html)
+
+    def render_skeleton(self, template_name, shared, recipient):
+        """Render an email using a memoized skeleton.
+
+        Args:
+            shared: template variables common for many recipients (must be hashable).
+            recipient: template variables of this recipient (strings or numbers).
+
+        Returns:
+            A pair (HTML, plain text), the same as of :meth:`render` with both dicts merged."""
+        values = {name: str(value) for name, value in recipient.items()}
+        if not all(self.SAFE_VALUE.match(value) for value in values.values()):
+            return self.render(template_name, dict(shared, **recipient))
+        html, text, markers = self._skeleton(template_name, shared, sorted(values))
+        for name, marker in markers.items():
+            html = html.replace(marker, escape(values[name]))
+            text = text.replace(marker, values[name])
+        # wrap lines as html2text would do with the real values
+        return html, self._wrapper.optwrap(text)
+
+    def _skeleton(self, template_name, shared, names):
+        """Internal.
+
+        Returns:
+            A tuple (HTML, plain text with unwrapped lines, markers)."""
+        key = (template_name, translation.get_language(), tuple(sorted(shared.items())), tuple(names))
+        with self._lock:
+            if key in self._skeletons:
+                self._skeletons.move_to_end(key)
+                self.skeleton_hits += 1
+                return self._skeletons[key]
+            self.skeleton_misses += 1
+        token = uuid.uuid4().hex[:8]
+        markers = {name: 'PAYEE%dX%s' % (i, token) for i, name in enumerate(names)}
+        html = self.template(template_name).render(dict(shared, **markers))
+        skeleton = (html, html2text.HTML2Text(bodywidth=0).handle(html), markers)
+        with self._lock:
+            self._skeletons[key] = skeleton
+            if len(self._skeletons) > self.max_skeletons:
+                self._skeletons.popitem(last=False)
+        return skeleton
+
+
+_renderer = None
+_renderer_lock = threading.Lock()
+
+
+def email_renderer():
+    """The process-wide :class:`EmailRenderer`."""
+    global _renderer
+    if _renderer is None:
+        with _renderer_lock:
+            if _renderer is None:
+                _renderer = EmailRenderer()
+    return _renderer
@@ -0,0 +1,512 @@
+import datetime
+import hashlib
+import hmac
+import time
+from collections import OrderedDict, namedtuple
+
+import html2text
+import django.db
+from django.conf import settings
+from django.core import mail
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+from django.http import QueryDict
+from django.template.loader import render_to_string
+from django.test.utils import override_settings
+
+from debits.debits_base.activity import activity_cache
+from debits.debits_base.base import Period
+from debits.debits_base.models import Product, SimpleItem, SimplePurchase, AggregatePurchase, SimplePaymentStatus, \
+    supports_recursive_cte, PaymentProcessor, BaseTransaction, SimpleTransaction, SubscriptionTransaction, \
+    SubscriptionItem, Purchase, SubscriptionPurchase, ProlongPurchase, Payment
+from debits.debits_base.codec import TransactionCodec
+from debits.debits_base.processors import PAYMENT_PROCESSOR_PAYPAL
+from debits.debits_base.reminders import ReminderEngine
+from debits.debits_base.rendering import EmailRenderer
+from debits.debits_test.business import create_organization
+from debits.debits_test.callbacks import MyPayPalIPN
+from debits.debits_test.ipn_generator import IPNGenerator, form_items
+from debits.debits_test.models import PricingPlan
+from debits.debits_test.processors import MyPayPalForm
+from debits.paypal import projection
+from debits.paypal.models import PayPalProcessorInfo
+
+
+BENCHMARKS = OrderedDict()
+"""Benchmarks run by ``manage.py benchmark`` by name."""
+
+
+def benchmark(name):
+    """Register a benchmark function.
+
+    The function takes the number of iterations and a seeded :class:`random.Random`
+    (for synthetic data) and returns a list of :class:`Measurement`."""
+    def register(function):
+        BENCHMARKS[name] = function
+        return function
+    return register
+
+
+class Rollback(Exception):
+    """Internal."""
+    pass
+
+
+def in_rollback(function):
+    """Run `function` in a transaction rolled back afterwards (to not leave benchmark data in the DB).
+
+    Returns:
+        The return value of `function`."""
+    result = []
+    try:
+        with transaction.atomic():
+            result.append(function())
+            raise Rollback
+    except Rollback:
+        pass
+    return result[0]
+
+
+def percentile(durations, p):
+    """Internal.
+
+    Args:
+        durations: a sorted list."""
+    return durations[int(round(p / 100 * (len(durations) - 1)))] if durations else 0.0
+
+
+class Measurement(object):
+    """Timings of a benchmarked operation.
+
+    Args:
+        durations: seconds taken by every call.
+        items: operations done by every call (for batch operations).
+        queries: DB queries done by all calls."""
+
+    def __init__(self, label, durations, items=1, queries=0):
+        self.label = label
+        self.calls = len(durations)
+        self.items = items
+        total = sum(durations)
+        self.ops = self.calls * items / total if total > 0 else 0.0
+        """Operations per second."""
+        durations = sorted(durations)
+        self.p50 = percentile(durations, 50)
+        """Median seconds per call."""
+        self.p99 = percentile(durations, 99)
+        """99th percentile of seconds per call."""
+        self.queries = queries / (self.calls * items) if self.calls else 0.0
+        """DB queries per operation."""
+
+    def as_dict(self):
+        return {'label': self.label, 'calls': self.calls, 'items': self.items, 'ops': self.ops,
+                'p50': self.p50, 'p99': self.p99, 'queries': self.queries}
+
+
+def measure(label, function, n, setup=None, items=1):
+    """Call `function` `n` times, timing every call and counting its DB queries.
+
+    Args:
+        setup: a function which takes the iteration number and returns the arguments of `function`
+            (not timed). By default `function` gets the iteration number.
+        items: operations done by every call.
+
+    Returns:
+        :class:`Measurement`."""
+    durations = []
+    queries = [0]
+
+    def count(execute, sql, params, many, context):
+        queries[0] += 1
+        return execute(sql, params, many, context)
+
+    for i in range(n):
+        args = setup(i) if setup is not None else (i,)
+        with django.db.connection.execute_wrapper(count):
+            start = time.perf_counter()
+            function(*args)
+            durations.append(time.perf_counter() - start)
+    return Measurement(label, durations, items=items, queries=queries[0])
+
+
+@benchmark('render')
+def render_benchmark(n, random):
+    """Reminder emails rendered per second."""
+    template_name = 'debits/email/before-due-remind.html'
+    shared = {'product': "Pro plan", 'days_before': 10}
+
+    def url(i):
+        return 'https://payments.example.com/transaction-prolong-payment/%d' % i
+
+    def uncached(i):
+        html = render_to_string(template_name, dict(shared, url=url(i)))
+        html2text.html2text(html)
+
+    renderer = EmailRenderer()
+
+    def cached_template(i):
+        renderer.render(template_name, dict(shared, url=url(i)))
+
+    def skeleton(i):
+        renderer.render_skeleton(template_name, shared, {'url': url(i)})
+
+    return [measure("render_to_string + html2text", uncached, n),
+            measure("cached template + html2text", cached_template, n),
+            measure("skeleton", skeleton, n)]
+
+
+def make_tree(item, depth, width):
+    """Internal.
+
+    Creates a chain of `depth` aggregate purchases with a paid root and `width` leaves under the lowest one.
+
+    Returns:
+        PKs of the leaves."""
+    parent = AggregatePurchase.objects.create(item=item, status=SimplePaymentStatus.PAID)
+    for i in range(depth - 1):
+        parent = AggregatePurchase.objects.create(item=item, parent=parent)
+    # no bulk_create() for multi-table inheritance
+    return [SimplePurchase.objects.create(item=item, parent=parent).pk for i in range(width)]
+
+
+def paid_loop(pk):
+    """Internal.
+
+    Paid status by one query per level (as before :meth:`SimplePurchase.paid_many`)."""
+    cur = SimplePurchase.objects.only('status', 'parent').get(pk=pk)
+    while True:
+        if cur.status == SimplePaymentStatus.PAID:
+            return True
+        if cur.parent_id is None:
+            return False
+        cur = SimplePurchase.objects.only('status', 'parent').get(pk=cur.parent_id)
+
+
+@benchmark('paid')
+def paid_benchmark(n, random):
+    """Purchases in aggregate purchase trees whose paid status is resolved per second."""
+    def run():
+        product = Product.objects.create(name="Benchmark")
+        item = SimpleItem.objects.create(product=product, price=1)
+        results = []
+        for label, depth, width in (("deep", 30, 1), ("wide", 2, 500)):
+            leaves = make_tree(item, depth, width)
+            batches = max(1, n // len(leaves))
+
+            def loop(i):
+                for pk in leaves:
+                    paid_loop(pk)
+
+            def cte(i):
+                SimplePurchase.paid_many(leaves)
+
+            def levels(i):
+                SimplePurchase.paid_many_levels(leaves)
+
+            results.append(measure("%s tree: query per level" % label, loop, max(1, batches // 10), items=len(leaves)))
+            if supports_recursive_cte(django.db.connection):
+                results.append(measure("%s tree: recursive CTE" % label, cte, batches, items=len(leaves)))
+            results.append(measure("%s tree: query per level for all" % label, levels, batches, items=len(leaves)))
+        return results
+    return in_rollback(run)
+
+
+@benchmark('codec')
+def codec_benchmark(n, random):
+    """Transaction secrets ("custom") encoded and decoded per second."""
+    secret = settings.SECRET_KEY.encode()
+    codec = TransactionCodec([('2', 'new secret'), ('1', settings.SECRET_KEY)], settings.PAYMENTS_REALM)
+    customs = codec.encode_many(range(n))
+
+    def encode_uncached(i):
+        # as before TransactionCodec (but with SHA-256): a new HMAC for every call
+        settings.PAYMENTS_REALM + ' ' + str(i) + ' ' + \
+            hmac.new(secret, ('payid ' + str(i)).encode(), hashlib.sha256).hexdigest()
+
+    def encode(i):
+        codec.encode(i)
+
+    def decode(i):
+        codec.decode(customs[i])
+
+    def round_trip(i):
+        BaseTransaction.pk_from_custom(BaseTransaction.custom_from_pk(i))
+
+    return [measure("encode with a new HMAC", encode_uncached, n),
+            measure("encode", encode, n),
+            measure("decode", decode, n),
+            measure("decode_many", lambda i: codec.decode_many(customs), 1, items=n),
+            measure("custom_from_pk + pk_from_custom", round_trip, n)]
+
+
+def paypal_processor():
+    """Internal."""
+    return PaymentProcessor.objects.get_or_create(pk=PAYMENT_PROCESSOR_PAYPAL,
+                                                  defaults={'name': "PayPal",
+                                                            'url': 'http://www.paypal.com/',
+                                                            'klass_app_label': 'paypal',
+                                                            'klass_model': 'PayPalProcessorInfo'})[0]
+
+
+def make_plan():
+    """Internal."""
+    product = Product.objects.create(name="Benchmark")
+    return PricingPlan.objects.create(product=product, name="Benchmark plan", price=10, currency='USD',
+                                      period_unit=Period.UNIT_MONTHS, period_count=1)
+
+
+def insert_rows(model, rows):
+    """Internal.
+
+    Insert rows (dicts by column) into the table of `model` only
+    (:meth:`~django.db.models.query.QuerySet.bulk_create` does not support multi-table inheritance)."""
+    connection = django.db.connection
+    columns = list(rows[0])
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (connection.ops.quote_name(model._meta.db_table),
+                                               ', '.join(connection.ops.quote_name(c) for c in columns),
+                                               ', '.join(['%s'] * len(columns)))
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, [[row[c] for c in columns] for row in rows])
+
+
+def make_subscriptions(count, random, today):
+    """Internal.
+
+    Creates `count` paid subscriptions with random due dates around `today` by a few bulk queries.
+
+    Returns:
+        The :class:`~debits.debits_base.models.SubscriptionItem` of the subscriptions."""
+    processor = paypal_processor()
+    product = Product.objects.create(name="Benchmark")
+    item = SubscriptionItem.objects.create(product=product, price=10, currency='USD',
+                                           payment_period_unit=Period.UNIT_MONTHS, payment_period_count=1,
+                                           trial_period_unit=Period.UNIT_MONTHS, trial_period_count=0)
+    Purchase.objects.bulk_create([Purchase(item=item) for i in range(count)], batch_size=500)
+    pks = list(Purchase.objects.filter(item=item).order_by('pk').values_list('pk', flat=True))
+    BaseTransaction.objects.bulk_create([BaseTransaction(processor=processor, purchase_id=pk) for pk in pks],
+                                        batch_size=500)
+    transactions = BaseTransaction.objects.filter(purchase__item=item).order_by('pk').values_list('pk', flat=True)
+    Payment.objects.bulk_create([Payment(transaction_id=pk, email='user%d@example.com' % pk) for pk in transactions],
+                                batch_size=500)
+    Purchase.objects.filter(item=item).update(
+        payment=Subquery(Payment.objects.filter(transaction__purchase=OuterRef('pk')).values('pk')[:1]))
+    rows = []
+    for pk in pks:
+        due = today + datetime.timedelta(days=random.randint(-20, 40))
+        rows.append({SubscriptionPurchase._meta.pk.column: pk,
+                     'due_payment_date': due,
+                     'payment_deadline': due + datetime.timedelta(days=10),
+                     'trial': random.random() < 0.3,
+                     'subinvoice': 1})
+    insert_rows(SubscriptionPurchase, rows)
+    return item
+
+
+REMINDER_SIZES = (10000, 100000)
+"""Default numbers of subscriptions of the reminders benchmark."""
+
+
+@benchmark('reminders')
+def reminders_benchmark(n, random, sizes=REMINDER_SIZES):
+    """Subscriptions scanned for payment reminders per second, for every number of subscriptions in `sizes`
+    (`n` is not used, as the cost per subscription depends on the table size)."""
+    def run(size):
+        today = datetime.date.today()
+        item = make_subscriptions(size, random, today)
+        with override_settings(PAYMENTS_EMAIL_SKELETONS=True):
+            engine = ReminderEngine(today=today)
+        results = [measure("send reminders (%d)" % size, lambda i: engine.run(), 1, items=size)]
+        results.append(measure("nothing due (rerun, %d)" % size, lambda i: engine.run(), 1, items=size))
+        Purchase.objects.filter(item=item).update(reminders_sent=0)
+        with override_settings(PAYMENTS_EMAIL_SKELETONS=False):
+            engine = ReminderEngine(today=today)
+        results.append(measure("send reminders (full templates, %d)" % size, lambda i: engine.run(), 1, items=size))
+        return results
+
+    results = []
+    # the dummy backend does not keep the messages in memory
+    with override_settings(EMAIL_BACKEND='django.core.mail.backends.dummy.EmailBackend',
+                           PAYMENTS_EMAIL_OUTBOX=False,
+                           PAYMENTS_DAYS_BEFORE_DUE_REMIND=10,
+                           PAYMENTS_DAYS_BEFORE_TRIAL_END_REMIND=10):
+        for size in sizes:
+            results.extend(in_rollback(lambda: run(size)))
+    return results
+
+
+@benchmark('activity')
+def activity_benchmark(n, random):
+    """Subscription activity checks per second."""
+    def run():
+        today = datetime.date.today()
+        item = make_subscriptions(size, random, today)
+        purchases = list(SubscriptionPurchase.objects.filter(item=item))
+        pks = [purchase.pk for purchase in purchases]
+        cache = activity_cache()
+
+        def random_pk(i):
+            return (pks[random.randrange(len(pks))],)
+
+        def invalidated(i):
+            pk = pks[random.randrange(len(pks))]
+            cache.invalidate(pk)
+            return (pk,)
+
+        def shared(i):
+            pk = pks[random.randrange(len(pks))]
+            cache.clear()  # only in this process
+            return (pk,)
+
+        def warm_up():
+            for pk in pks:
+                quick_is_active(pk)
+
+        quick_is_active = SubscriptionPurchase.quick_is_active
+        results = [measure("is_active (loaded purchase)", lambda i: purchases[i % len(purchases)].is_active(), n),
+                   measure("quick_is_active (not cached)", quick_is_active, n, setup=invalidated)]
+        if cache.alias is not None:
+            warm_up()
+            results.append(measure("quick_is_active (Django cache)", quick_is_active, n, setup=shared))
+        warm_up()
+        results.append(measure("quick_is_active (in-process cache)", quick_is_active, n, setup=random_pk))
+        results.append(measure("is_active_many", lambda i: SubscriptionPurchase.objects.is_active_many(pks),
+                               max(1, n // len(pks)), items=len(pks)))
+        return results
+
+    size = min(n, 1000)
+    alias = activity_cache().alias
+    locmem = 'django.core.cache.backends.locmem.LocMemCache'
+    if alias is None or settings.CACHES.get(alias, {}).get('BACKEND') != locmem:
+        return in_rollback(run)
+    # LocMemCache keeps 300 entries by default, too few for two keys per subscription
+    caches = dict(settings.CACHES, **{alias: {'BACKEND': locmem,
+                                              'LOCATION': 'debits-benchmark',
+                                              'OPTIONS': {'MAX_ENTRIES': 4 * size}}})
+    with override_settings(CACHES=caches):
+        return in_rollback(run)
+
+
+PeriodValue = namedtuple('PeriodValue', ('unit', 'count'))
+"""Internal.
+
+A value with the attributes of a :class:`~debits.debits_base.base.Period` field."""
+
+
+@benchmark('offset_date')
+def offset_date_benchmark(n, random):
+    """Next payment dates calculated per second."""
+    start = datetime.date(2000, 1, 1)
+    cases = []
+    for i in range(n):
+        period = PeriodValue(random.choice((Period.UNIT_DAYS, Period.UNIT_WEEKS, Period.UNIT_MONTHS, Period.UNIT_YEARS)),
+                             random.randint(1, 12))
+        cases.append((start + datetime.timedelta(days=random.randrange(10000)), period))
+
+    # catch-up of subscriptions lapsed up to 10 years ago
+    lapsed = [(date, period, date + datetime.timedelta(days=random.randrange(3653))) for date, period in cases]
+
+    return [measure("offset_date", lambda date, period: PayPalProcessorInfo.offset_date(date, period), n,
+                    setup=lambda i: cases[i]),
+            measure("next_offset_date (lapsed)",
+                    lambda date, period, after: PayPalProcessorInfo.next_offset_date(date, period, after), n,
+                    setup=lambda i: lapsed[i])]
+
+
+@benchmark('projection')
+def projection_benchmark(n, random):
+    """Subscriptions projected per second (`n` is the number of subscriptions)."""
+    if projection.np is None:  # NumPy is not installed
+        return []
+
+    def run():
+        today = datetime.date.today()
+        item = make_subscriptions(n, random, today)
+        queryset = SubscriptionPurchase.objects.filter(item=item)
+        return [measure("project %d months" % months, lambda i: projection.project(months, today, queryset), 1,
+                        items=n)
+                for months in (12, 36)]
+
+    return in_rollback(run)
+
+
+@benchmark('form')
+def form_benchmark(n, random):
+    """PayPal payment forms prepared per second."""
+    def run():
+        processor = paypal_processor()
+        plan = make_plan()
+        form = MyPayPalForm(None)
+        purchase = create_organization("Benchmark", plan.pk, 0).purchase
+        item = SimpleItem.objects.create(product=plan.product, currency='USD', price=10)
+        prolong = ProlongPurchase.objects.create(item=item, prolonged=purchase,
+                                                 period_unit=Period.UNIT_MONTHS, period_count=1)
+
+        # a new transaction for every form, as in a request
+        return [measure("subscription", lambda t: form.amend_hash_new_purchase(t, {}), n,
+                        setup=lambda i: (SubscriptionTransaction.objects.create(processor=processor,
+                                                                                purchase=purchase),)),
+                measure("one-time", lambda t: form.amend_hash_new_purchase(t, {}), n,
+                        setup=lambda i: (SimpleTransaction.objects.create(processor=processor, purchase=prolong),))]
+    return in_rollback(run)
+
+
+@benchmark('ipn')
+def ipn_benchmark(n, random):
+    """Verified PayPal IPNs processed per second by `txn_type` (`n / 10` of each kind).
+
+    The verification postback to PayPal is not included."""
+    count = max(1, n // 10)
+    view = MyPayPalIPN()
+    generator = IPNGenerator(seed=random.random())
+
+    def post(ipn):
+        return QueryDict(IPNGenerator.encode(ipn)),
+
+    def run():
+        processor = paypal_processor()
+        plan = make_plan()
+        product = plan.product
+
+        def subscription(recurring):
+            purchase = create_organization("Benchmark", plan.pk, 0).purchase
+            transaction = SubscriptionTransaction.objects.create(processor=processor, purchase=purchase)
+            return generator.sequence(form_items(transaction), payments=1, cancel=True, recurring=recurring)
+
+        def prolong():
+            purchase = create_organization("Benchmark", plan.pk, 0).purchase
+            item = SimpleItem.objects.create(product=product, currency='USD', price=plan.price)
+            prolong = ProlongPurchase.objects.create(item=item, prolonged=purchase,
+                                                     period_unit=Period.UNIT_MONTHS, period_count=1)
+            transaction = SimpleTransaction.objects.create(processor=processor, purchase=prolong)
+            return generator.sequence(form_items(transaction), refund=True)
+
+        def nth(make, index, before=0):
+            """Setup: make a sequence, process its IPNs before `index` (`before` of them), return the IPN `index`."""
+            def setup(i):
+                ipns = make()
+                for ipn in ipns[index - before:index]:
+                    view.verified_post(post(ipn)[0])
+                return post(ipns[index])
+            return setup
+
+        results = []
+        for recurring, kinds in ((False, ('subscr_signup', 'subscr_payment', 'subscr_cancel')),
+                                 (True, ('recurring_payment_profile_created', 'recurring_payment',
+                                         'recurring_payment_profile_cancel'))):
+            def make(recurring=recurring):
+                return subscription(recurring)
+            results.append(measure(kinds[0], view.verified_post, count, setup=nth(make, 0)))
+            results.append(measure(kinds[1], view.verified_post, count, setup=nth(make, 1)))
+            results.append(measure(kinds[2], view.verified_post, count, setup=nth(make, 2, before=1)))
+        results.append(measure('web_accept', view.verified_post, count, setup=nth(prolong, 0)))
+        results.append(measure('refund', view.verified_post, count, setup=nth(prolong, 1, before=1)))
+        return results
+
+    with override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+                           PAYMENTS_EMAIL_OUTBOX=False):
+        mail.outbox = []
+        try:
+            results = in_rollback(run)
+        finally:
+            mail.outbox = []
+    return results
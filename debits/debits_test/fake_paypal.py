@@ -0,0 +1,238 @@
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+import requests
+
+from debits.debits_base.base import logger
+from debits.debits_test.ipn_generator import IPNGenerator
+
+
+class FakePayPal(object):
+    """A local stand-in for PayPal for integration and load tests.
+
+    It implements IPN verification (``/cgi-bin/webscr`` with ``cmd=_notify-validate``),
+    OAuth tokens (``/v1/oauth2/token``), billing agreement cancel and sale refund.
+    A payment form posted to ``/cgi-bin/webscr`` is "paid" at once: IPNs generated by
+    :class:`~debits.debits_test.ipn_generator.IPNGenerator` are posted to its ``notify_url``
+    and the browser is redirected to its ``return`` URL.
+
+    To use it, set ``PAYPAL_WEB_HOST`` and ``PAYPAL_API_HOST`` settings to :attr:`url`.
+
+    Args:
+        latency: seconds added to every response.
+        jitter: up to this number of random seconds is added to every response.
+        error_rate: the probability of HTTP 500 for verification and API requests.
+        throttle_rate: the probability of HTTP 429 for API requests.
+        invalid_rate: the probability to answer ``INVALID`` to a verification request.
+        ipn_delay: seconds before posting IPNs of a paid form.
+        payments: the number of payments of a subscription paid by a form."""
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0,
+                 invalid_rate=0.0, ipn_delay=0.0, payments=1, token_ttl=32400, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.invalid_rate = invalid_rate
+        self.ipn_delay = ipn_delay
+        self.payments = payments
+        self.token_ttl = token_ttl
+        self.random = random.Random(seed)
+        self.generator = IPNGenerator(seed=seed)
+        self.stats = Counter()
+        """Numbers of requests by endpoint and of injected failures."""
+        self.tokens = set()
+        self.canceled = set()
+        """Canceled billing agreements."""
+        self.refunded = set()
+        """Refunded sales."""
+        self._lock = threading.Lock()
+        self._session = requests.Session()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                code, content_type, content, headers = fake.handle(self.path, self.headers, body)
+                self.send_response(code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(content)))
+                for header, value in headers.items():
+                    self.send_header(header, value)
+                self.end_headers()
+                self.wfile.write(content)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        """The base URL of the server."""
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def start(self):
+        """Serve in a background thread."""
+        self._thread = threading.Thread(target=self.server.serve_forever, name="Fake PayPal", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def count(self, what):
+        """Internal."""
+        with self._lock:
+            self.stats[what] += 1
+
+    def chance(self, probability):
+        """Internal."""
+        if not probability:
+            return False
+        with self._lock:
+            return self.random.random() < probability
+
+    def handle(self, path, headers, body):
+        """Internal.
+
+        Returns:
+            A tuple (HTTP code, content type, content, dict of additional headers)."""
+        delay = self.latency
+        if self.jitter:
+            with self._lock:
+                delay += self.random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+        if path == '/cgi-bin/webscr':
+            if body.startswith(b'cmd=_notify-validate'):
+                return self.verify(body)
+            return self.checkout(body)
+        if path == '/v1/oauth2/token':
+            return self.token()
+        parts = path.strip('/').split('/')
+        if len(parts) == 5 and parts[:3] == ['v1', 'payments', 'billing-agreements'] and parts[4] == 'cancel':
+            return self.api(headers, self.cancel_agreement, parts[3])
+        if len(parts) == 5 and parts[:3] == ['v1', 'payments', 'sale'] and parts[4] == 'refund':
+            return self.api(headers, self.refund, parts[3])
+        self.count('not found')
+        return 404, 'application/json', b'{"name": "NOT_FOUND", "message": "Not found"}', {}
+
+    def verify(self, body):
+        """Internal."""
+        self.count('verify')
+        if self.chance(self.error_rate):
+            self.count('injected 500')
+            return 500, 'text/plain', b'Internal Server Error', {}
+        if self.chance(self.invalid_rate):
+            self.count('injected INVALID')
+            return 200, 'text/plain', b'INVALID', {}
+        return 200, 'text/plain', b'VERIFIED', {}
+
+    def token(self):
+        """Internal."""
+        self.count('token')
+        token = uuid.uuid4().hex
+        with self._lock:
+            self.tokens.add(token)
+        content = json.dumps({'scope': 'https://uri.paypal.com/services/subscriptions',
+                              'access_token': token,
+                              'token_type': 'Bearer',
+                              'expires_in': self.token_ttl})
+        return 200, 'application/json', content.encode(), {}
+
+    def api(self, headers, method, id):
+        """Internal.
+
+        Authorization and error injection for API requests."""
+        authorization = headers.get('Authorization', '')
+        with self._lock:
+            authorized = authorization.startswith('Bearer ') and authorization[7:] in self.tokens
+        if not authorized:
+            self.count('unauthorized')
+            return 401, 'application/json', b'{"error": "invalid_token"}', {}
+        if self.chance(self.error_rate):
+            self.count('injected 500')
+            return 500, 'application/json', b'{"name": "INTERNAL_SERVICE_ERROR"}', {}
+        if self.chance(self.throttle_rate):
+            self.count('injected 429')
+            return 429, 'application/json', b'{"name": "RATE_LIMIT_REACHED", "message": "Too many requests"}', \
+                {'Retry-After': '1'}
+        return method(id)
+
+    def cancel_agreement(self, id):
+        """Internal."""
+        self.count('cancel')
+        with self._lock:
+            canceled = id in self.canceled
+            self.canceled.add(id)
+        if canceled:
+            content = {'name': 'STATUS_INVALID',
+                       'message': "Invalid profile status for cancel action; profile should be active or suspended"}
+            return 400, 'application/json', json.dumps(content).encode(), {}
+        return 204, 'application/json', b'', {}
+
+    def refund(self, id):
+        """Internal."""
+        self.count('refund')
+        with self._lock:
+            refunded = id in self.refunded
+            self.refunded.add(id)
+        if refunded:
+            content = {'name': 'TRANSACTION_REFUSED',
+                       'message': "The requested transaction has already been fully refunded."}
+            return 400, 'application/json', json.dumps(content).encode(), {}
+        content = {'id': uuid.uuid4().hex[:17].upper(), 'state': 'completed', 'sale_id': id}
+        return 201, 'application/json', json.dumps(content).encode(), {}
+
+    def checkout(self, body):
+        """Internal.
+
+        "Pay" a form: post its IPNs to ``notify_url`` and redirect the browser back."""
+        self.count('checkout')
+        items = dict(parse_qsl(body.decode('utf-8')))
+        with self._lock:
+            ipns = self.generator.sequence(items, payments=self.payments)
+        if items.get('notify_url'):
+            threading.Thread(target=self.notify, args=(items['notify_url'], ipns), daemon=True).start()
+        if items.get('return'):
+            return 302, 'text/plain', b'', {'Location': items['return']}
+        return 200, 'text/html', b'<html><body><p>Payment completed.</p></body></html>', {}
+
+    def notify(self, url, ipns):
+        """Internal.
+
+        Post IPNs one by one, retrying failures like PayPal does (but without waiting for hours)."""
+        if self.ipn_delay:
+            time.sleep(self.ipn_delay)
+        for ipn in ipns:
+            for attempt in range(3):
+                try:
+                    r = self._session.post(url, data=IPNGenerator.encode(ipn),
+                                           headers={'Content-Type': 'application/x-www-form-urlencoded'})
+                    if r.status_code == 200:
+                        self.count('ipn sent')
+                        break
+                except requests.RequestException:
+                    logger.exception("Fake PayPal: cannot post IPN to %s" % url)
+                self.count('ipn retried')
+                time.sleep(0.1 * 2 ** attempt)
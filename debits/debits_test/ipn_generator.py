@@ -0,0 +1,246 @@
+import datetime
+import random
+import string
+from decimal import Decimal
+from urllib.parse import urlencode
+
+from django.conf import settings
+
+from debits.debits_test.processors import MyPayPalForm
+
+
+UNIT_NAMES = {'D': 'Days', 'W': 'Weeks', 'M': 'Months', 'Y': 'Years'}
+
+SINGLE_CYCLES = {'D': 'Daily', 'W': 'Weekly', 'M': 'Monthly', 'Y': 'Yearly'}
+
+
+def form_items(transaction):
+    """The fields of the PayPal form for a transaction (what PayPal receives when the user pays).
+
+    Args:
+        transaction: :class:`~debits.debits_base.models.SimpleTransaction` or
+            :class:`~debits.debits_base.models.SubscriptionTransaction`."""
+    items = MyPayPalForm(None).amend_hash_new_purchase(transaction, {})
+    del items['arcamens_action']
+    return items
+
+
+def money(value):
+    """Internal."""
+    return str(Decimal(str(value)).quantize(Decimal('0.01')))
+
+
+def payment_cycle(count, unit):
+    """PayPal description of a payment period, such as ``'Monthly'`` or ``'every 3 Months'``."""
+    return SINGLE_CYCLES[unit] if count == 1 else 'every %d %s' % (count, UNIT_NAMES[unit])
+
+
+class IPNGenerator(object):
+    """Generates IPNs as PayPal would send them for a payment form (see :func:`form_items`).
+
+    IPNs are dicts of strings. Identifiers (transaction IDs, subscription IDs, payers) are random
+    but reproducible with the same `seed`.
+
+    Example::
+
+        generator = IPNGenerator(seed=1)
+        for ipn in generator.sequence(form_items(transaction), payments=3, cancel=True):
+            client.post(url, IPNGenerator.encode(ipn), content_type='application/x-www-form-urlencoded')"""
+
+    def __init__(self, seed=None, receiver_email=None, receiver_id=None):
+        self.random = random.Random(seed)
+        self.receiver_email = receiver_email or settings.PAYPAL_EMAIL
+        self.receiver_id = receiver_id or settings.PAYPAL_ID
+
+    def ident(self, length, prefix=''):
+        """Internal."""
+        return prefix + ''.join(self.random.choice(string.ascii_uppercase + string.digits) for i in range(length))
+
+    def payer(self):
+        """A random payer (fields common for all IPNs of a payer)."""
+        name = self.ident(6).lower()
+        return {'payer_email': name + '@example.com',
+                'payer_id': self.ident(13),
+                'first_name': name.capitalize(),
+                'last_name': 'Buyer',
+                'payer_status': 'verified',
+                'residence_country': 'US'}
+
+    @staticmethod
+    def date(when=None):
+        """PayPal date format."""
+        return (when or datetime.datetime.utcnow()).strftime('%H:%M:%S %b %d, %Y GMT')
+
+    def common(self, items, payer):
+        """Internal."""
+        ipn = dict(payer,
+                   receiver_email=self.receiver_email,
+                   receiver_id=self.receiver_id,
+                   business=self.receiver_email,
+                   charset='utf-8',
+                   notify_version='3.9',
+                   test_ipn='1',
+                   verify_sign=self.ident(56),
+                   ipn_track_id=self.ident(13).lower(),
+                   mc_currency=items.get('currency_code', 'USD'))
+        for var in ('custom', 'invoice'):
+            if var in items:
+                ipn[var] = str(items[var])
+        return ipn
+
+    def web_accept(self, items, payer):
+        """A one-time payment (for ``_xclick`` forms)."""
+        amount = Decimal(str(items['amount'])) * int(items.get('quantity', 1))
+        shipping = Decimal(str(items.get('shipping', 0)))
+        tax = Decimal(str(items.get('tax', 0)))
+        return dict(self.common(items, payer),
+                    txn_type='web_accept',
+                    txn_id=self.ident(17),
+                    payment_status='Completed',
+                    payment_type='instant',
+                    payment_date=self.date(),
+                    item_name=str(items['item_name']),
+                    quantity=str(items.get('quantity', 1)),
+                    mc_gross=money(amount + shipping + tax),
+                    mc_fee=money((amount + shipping + tax) * Decimal('0.029') + Decimal('0.30')),
+                    shipping=money(shipping),
+                    tax=money(tax))
+
+    def cart(self, items, payer):
+        """A payment for a cart (for ``_xclick`` forms with ``upload``)."""
+        ipn = dict(self.common(items, payer),
+                   txn_type='cart',
+                   txn_id=self.ident(17),
+                   payment_status='Completed',
+                   payment_type='instant',
+                   payment_date=self.date())
+        total = shipping = tax = Decimal(0)
+        i = 1
+        while 'item_name_%d' % i in items:
+            item_shipping = Decimal(str(items.get('shipping_%d' % i, 0)))
+            item_tax = Decimal(str(items.get('tax_%d' % i, 0)))
+            gross = Decimal(str(items['amount_%d' % i])) * int(items.get('quantity_%d' % i, 1)) + item_shipping
+            ipn['item_name%d' % i] = str(items['item_name_%d' % i])
+            ipn['quantity%d' % i] = str(items.get('quantity_%d' % i, 1))
+            ipn['mc_gross_%d' % i] = money(gross)
+            total += gross + item_tax
+            shipping += item_shipping
+            tax += item_tax
+            i += 1
+        ipn.update(num_cart_items=str(i - 1), mc_gross=money(total), shipping=money(shipping), tax=money(tax))
+        return ipn
+
+    def signup(self, items, payer, recurring=False):
+        """The start of a subscription (for ``_xclick-subscriptions`` forms).
+
+        Args:
+            recurring: generate ``recurring_payment_profile_created`` (as for Express Checkout)
+                instead of ``subscr_signup``."""
+        ipn = self.common(items, payer)
+        amount = money(items['a3'])
+        if recurring:
+            cycle = payment_cycle(int(items['p3']), items['t3'])
+            ipn.update(txn_type='recurring_payment_profile_created',
+                       recurring_payment_id=self.ident(13, 'I-'),
+                       profile_status='Active',
+                       product_name=str(items['item_name']),
+                       time_created=self.date(),
+                       amount=amount,
+                       amount_per_cycle=amount,
+                       payment_cycle=cycle,
+                       period3=cycle,
+                       mc_amount3=amount,
+                       currency_code=ipn['mc_currency'],
+                       period_type=' Regular')
+        else:
+            ipn.update(txn_type='subscr_signup',
+                       subscr_id=self.ident(13, 'I-'),
+                       subscr_date=self.date(),
+                       item_name=str(items['item_name']),
+                       recurring='1',
+                       reattempt='1',
+                       amount3=amount,
+                       mc_amount3=amount,
+                       period3='%s %s' % (items['p3'], items['t3']))
+            if 'p1' in items:
+                ipn.update(period1='%s %s' % (items['p1'], items['t1']),
+                           amount1=money(items['a1']),
+                           mc_amount1=money(items['a1']))
+        return ipn
+
+    def payment(self, signup):
+        """A subscription payment after `signup` IPN."""
+        ipn = {var: value for var, value in signup.items()
+               if var not in ('verify_sign', 'ipn_track_id', 'subscr_date', 'time_created')}
+        ipn.update(txn_id=self.ident(17),
+                   payment_status='Completed',
+                   payment_type='instant',
+                   payment_date=self.date(),
+                   verify_sign=self.ident(56),
+                   ipn_track_id=self.ident(13).lower(),
+                   mc_gross=signup['mc_amount3'],
+                   mc_fee=money(Decimal(signup['mc_amount3']) * Decimal('0.029') + Decimal('0.30')))
+        ipn['txn_type'] = 'recurring_payment' if 'recurring_payment_id' in signup else 'subscr_payment'
+        return ipn
+
+    def cancel(self, signup):
+        """Cancellation of the subscription started by `signup` IPN."""
+        ipn = {var: signup[var] for var in ('receiver_email', 'receiver_id', 'business', 'charset', 'notify_version',
+                                            'test_ipn', 'payer_email', 'payer_id', 'first_name', 'last_name',
+                                            'mc_currency')}
+        ipn.update(verify_sign=self.ident(56), ipn_track_id=self.ident(13).lower())
+        if 'recurring_payment_id' in signup:
+            ipn.update(txn_type='recurring_payment_profile_cancel',
+                       recurring_payment_id=signup['recurring_payment_id'],
+                       profile_status='Cancelled',
+                       custom=signup.get('custom', ''))
+        else:
+            # PayPal does not send `custom` with subscription cancellations
+            ipn.update(txn_type='subscr_cancel', subscr_id=signup['subscr_id'], subscr_date=self.date())
+        return ipn
+
+    def refund(self, payment):
+        """Full refund of `payment` IPN."""
+        ipn = {var: value for var, value in payment.items()
+               if var not in ('txn_type', 'payment_type', 'verify_sign', 'ipn_track_id')}
+        ipn.update(txn_id=self.ident(17),
+                   parent_txn_id=payment['txn_id'],
+                   payment_status='Refunded',
+                   reason_code='refund',
+                   payment_date=self.date(),
+                   verify_sign=self.ident(56),
+                   ipn_track_id=self.ident(13).lower(),
+                   mc_gross='-' + payment['mc_gross'],
+                   mc_fee='-' + payment['mc_fee'])
+        return ipn
+
+    def sequence(self, items, payments=1, cancel=False, refund=False, recurring=False, duplicates=0.0):
+        """All IPNs of a payment form in the order PayPal sends them.
+
+        Args:
+            items: the form fields (see :func:`form_items`).
+            payments: the number of payments of a subscription.
+            cancel: end a subscription with a cancellation.
+            refund: refund the last payment.
+            recurring: see :meth:`signup`.
+            duplicates: the probability to repeat every IPN (PayPal resends them)."""
+        payer = self.payer()
+        if items['cmd'] == '_xclick-subscriptions':
+            signup = self.signup(items, payer, recurring=recurring)
+            ipns = [signup] + [self.payment(signup) for i in range(payments)]
+            if refund and payments:
+                ipns.append(self.refund(ipns[-1]))
+            if cancel:
+                ipns.append(self.cancel(signup))
+        else:
+            ipns = [self.cart(items, payer) if items.get('upload') else self.web_accept(items, payer)]
+            if refund:
+                ipns.append(self.refund(ipns[-1]))
+        if duplicates:
+            ipns = [repeat for ipn in ipns for repeat in ([ipn, ipn] if self.random.random() < duplicates else [ipn])]
+        return ipns
+
+    @staticmethod
+    def encode(ipn, charset='utf-8'):
+        """The HTTP body of an IPN."""
+        return urlencode(ipn, encoding=charset).encode('ascii')
@@ -0,0 +1,360 @@
+import collections
+import logging
+import queue
+import threading
+import time
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+import django.db
+import requests
+from django.core.wsgi import get_wsgi_application
+from django.db.backends.signals import connection_created
+
+from debits.debits_base.base import logger
+from debits.debits_base.models import SubscriptionTransaction
+from debits.debits_test.benchmarks import make_plan, paypal_processor, percentile
+from debits.debits_test.business import create_organization
+from debits.debits_test.ipn_generator import IPNGenerator, form_items
+from debits.paypal.models import ProcessedIPN
+
+
+class LockMonitor(object):
+    """DB lock waits during a load test.
+
+    In this process, it times ``SELECT ... FOR UPDATE`` statements and counts lock errors
+    (such as "database is locked" or deadlocks) of all DB connections, so it sees the IPN handlers
+    only if the server runs in this process. On PostgreSQL and MySQL, it also samples each `interval`
+    seconds the number of sessions waiting for a lock (of any process)."""
+
+    SAMPLE_SQL = {
+        'postgresql': "SELECT count(*) FROM pg_stat_activity "
+                      "WHERE wait_event_type = 'Lock' AND datname = current_database()",
+        'mysql': "SELECT count(*) FROM information_schema.innodb_trx WHERE trx_state = 'LOCK WAIT'",
+    }
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.for_update = []
+        """Seconds taken by ``SELECT ... FOR UPDATE`` statements."""
+        self.lock_errors = 0
+        self.samples = []
+        """Numbers of sessions waiting for a lock."""
+        self._lock = threading.Lock()
+        self._active = False
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def start(self):
+        self._active = True
+        connection_created.connect(self.install)
+        self.install(None, django.db.connection)
+        sql = self.SAMPLE_SQL.get(django.db.connection.vendor)
+        if sql is not None:
+            self._stop.clear()
+            self._sampler = threading.Thread(target=self.sample, args=(sql,), name="Lock sampler", daemon=True)
+            self._sampler.start()
+
+    def stop(self):
+        self._active = False
+        connection_created.disconnect(self.install)
+        if self._sampler is not None:
+            self._stop.set()
+            self._sampler.join()
+            self._sampler = None
+
+    def install(self, sender, connection, **kwargs):
+        """Internal."""
+        if self.wrapper not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self.wrapper)
+
+    def wrapper(self, execute, sql, params, many, context):
+        """Internal."""
+        if not self._active:
+            return execute(sql, params, many, context)
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        except django.db.OperationalError as e:
+            message = str(e).lower()
+            if 'lock' in message:  # "database is locked", "deadlock detected", "lock wait timeout exceeded"
+                with self._lock:
+                    self.lock_errors += 1
+            raise
+        finally:
+            if 'FOR UPDATE' in sql:
+                with self._lock:
+                    self.for_update.append(time.perf_counter() - start)
+
+    def sample(self, sql):
+        """Internal."""
+        try:
+            with django.db.connection.cursor() as cursor:
+                while not self._stop.wait(self.interval):
+                    cursor.execute(sql)
+                    self.samples.append(cursor.fetchone()[0])
+        finally:
+            django.db.connection.close()
+
+    def stats(self):
+        """Returns:
+            A dict with `for_update` (count), `for_update_p50`, `for_update_p99`, `for_update_total` (seconds),
+            `lock_errors`, `waiting_max` and `waiting_mean` (sampled sessions, `None` if not sampled)."""
+        for_update = sorted(self.for_update)
+        return {'for_update': len(for_update),
+                'for_update_p50': percentile(for_update, 50),
+                'for_update_p99': percentile(for_update, 99),
+                'for_update_total': sum(for_update),
+                'lock_errors': self.lock_errors,
+                'waiting_max': max(self.samples) if self.samples else None,
+                'waiting_mean': sum(self.samples) / len(self.samples) if self.samples else None}
+
+
+class ErrorCounter(logging.Handler):
+    """Counts errors logged (with exceptions) by :data:`~debits.debits_base.base.logger` in threads other than
+    the load workers, that is IPN handlers of a server in this process (they answer 200 even if they fail)."""
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):  # called under the lock of the handler
+        if record.exc_info and not record.threadName.startswith(IPNLoad.THREAD_PREFIX):
+            self.count += 1
+
+    def start(self):
+        logger.addHandler(self)
+
+    def stop(self):
+        logger.removeHandler(self)
+
+
+class LoadReport(object):
+    """Results of :meth:`IPNLoad.run`."""
+
+    def __init__(self, concurrency, elapsed, latencies, errors, duplicates_sent, processed, duplicates_dropped, locks,
+                 handler_errors=None):
+        self.concurrency = concurrency
+        self.elapsed = elapsed
+        self.latencies = {txn_type: sorted(values) for txn_type, values in latencies.items()}
+        """End-to-end seconds (from the scheduled arrival to the response) by `txn_type`."""
+        self.errors = errors
+        """Failed requests (connection errors or HTTP status other than 200)."""
+        self.duplicates_sent = duplicates_sent
+        self.processed = processed
+        """New :class:`~debits.paypal.models.ProcessedIPN` keys (the IPNs which were processed)."""
+        self.handler_errors = handler_errors
+        """Exceptions of the IPN handlers (see :class:`ErrorCounter`), `None` if the server is not in this process."""
+        self.duplicates_dropped = duplicates_dropped
+        self.locks = locks
+        """:meth:`LockMonitor.stats`."""
+
+    @property
+    def all_latencies(self):
+        return sorted(value for values in self.latencies.values() for value in values)
+
+    @property
+    def sent(self):
+        return sum(len(values) for values in self.latencies.values())
+
+    @property
+    def unprocessed(self):
+        """Distinct IPNs sent but not processed: failed in the handler (which still answers 200)
+        or not yet processed from the inbox."""
+        return max(0, self.sent - self.duplicates_sent - self.processed)
+
+    def as_dict(self):
+        latencies = self.all_latencies
+        return {'concurrency': self.concurrency,
+                'elapsed': self.elapsed,
+                'sent': self.sent,
+                'throughput': self.sent / self.elapsed if self.elapsed else 0.0,
+                'p50': percentile(latencies, 50),
+                'p90': percentile(latencies, 90),
+                'p99': percentile(latencies, 99),
+                'max': latencies[-1] if latencies else 0.0,
+                'error_rate': self.errors / self.sent if self.sent else 0.0,
+                'duplicate_rate': self.duplicates_sent / self.sent if self.sent else 0.0,
+                'processed': self.processed,
+                'unprocessed': self.unprocessed,
+                'unprocessed_rate': self.unprocessed / (self.sent - self.duplicates_sent)
+                if self.sent > self.duplicates_sent else 0.0,
+                'handler_errors': self.handler_errors,
+                'duplicates_dropped': self.duplicates_dropped,
+                'by_txn_type': {txn_type: {'count': len(values),
+                                           'p50': percentile(values, 50),
+                                           'p99': percentile(values, 99)}
+                                for txn_type, values in self.latencies.items()},
+                'locks': self.locks}
+
+    def __str__(self):
+        d = self.as_dict()
+        lines = ["Concurrency %(concurrency)d: %(sent)d IPNs in %(elapsed).1fs (%(throughput).1f/s)" % d,
+                 "Latency ms: p50 %.1f, p90 %.1f, p99 %.1f, max %.1f" %
+                 (d['p50'] * 1000, d['p90'] * 1000, d['p99'] * 1000, d['max'] * 1000),
+                 "Errors: %.2f%%, duplicates sent: %.2f%%, processed: %d, duplicates dropped: %d" %
+                 (d['error_rate'] * 100, d['duplicate_rate'] * 100, d['processed'], d['duplicates_dropped']),
+                 "Not processed: %d (%.2f%%)%s" %
+                 (d['unprocessed'], d['unprocessed_rate'] * 100,
+                  "" if d['handler_errors'] is None else ", handler exceptions: %d" % d['handler_errors'])]
+        for txn_type, stats in sorted(d['by_txn_type'].items()):
+            lines.append("    %-36s %6d  p50 %8.1f ms  p99 %8.1f ms" %
+                         (txn_type, stats['count'], stats['p50'] * 1000, stats['p99'] * 1000))
+        locks = d['locks']
+        line = "Lock waits: %d SELECT FOR UPDATE (p50 %.1f ms, p99 %.1f ms, total %.2fs), %d lock errors" % \
+               (locks['for_update'], locks['for_update_p50'] * 1000, locks['for_update_p99'] * 1000,
+                locks['for_update_total'], locks['lock_errors'])
+        if locks['waiting_max'] is not None:
+            line += ", waiting sessions max %d mean %.2f" % (locks['waiting_max'], locks['waiting_mean'])
+        lines.append(line)
+        return '\n'.join(lines)
+
+
+class IPNLoad(object):
+    """Posts realistic IPN streams (see :class:`~debits.debits_test.ipn_generator.IPNGenerator`)
+    to the PayPal IPN view at `url`.
+
+    Every IPN is posted by one of `concurrency` threads. If `rate` is given, IPNs arrive at random
+    (Poisson) moments `rate` per second on average, and the latency counts from the arrival,
+    so that a server which falls behind is not hidden by the waiting workers.
+    Otherwise the workers post as fast as they can.
+
+    The server must verify IPNs at a fake PayPal (see :class:`~debits.debits_test.fake_paypal.FakePayPal`).
+    Transactions for the IPNs are created in the DB (so use a test DB).
+
+    The IPN view answers 200 even if its handler fails, so failures are seen as IPNs which were not processed
+    (and, if the server runs in this process, as exceptions logged by the handlers)."""
+
+    THREAD_PREFIX = "IPN load"
+
+    def __init__(self, url, concurrency=8, rate=None, seed=None, timeout=30.0):
+        self.url = url
+        self.concurrency = concurrency
+        self.rate = rate
+        self.timeout = timeout
+        self.generator = IPNGenerator(seed=seed)
+        self.random = self.generator.random
+
+    def prepare(self, subscriptions, payments=1, cancel=True, recurring=False, duplicates=0.0):
+        """Create `subscriptions` transactions and their IPN streams.
+
+        Streams are interleaved: the first IPNs of all subscriptions go first, then the second ones, etc.
+
+        Returns:
+            A list of pairs (IPN, is a duplicate)."""
+        processor = paypal_processor()
+        plan = make_plan()
+        streams = []
+        for i in range(subscriptions):
+            purchase = create_organization("Load %d" % i, plan.pk, 0).purchase
+            transaction = SubscriptionTransaction.objects.create(processor=processor, purchase=purchase)
+            ipns = self.generator.sequence(form_items(transaction), payments=payments, cancel=cancel,
+                                           recurring=recurring, duplicates=duplicates)
+            streams.append([(ipn, k > 0 and ipn is ipns[k - 1]) for k, ipn in enumerate(ipns)])
+        events = []
+        for k in range(max(len(stream) for stream in streams) if streams else 0):
+            events.extend(stream[k] for stream in streams if k < len(stream))
+        return events
+
+    def run(self, events, settle=1.0, in_process=False):
+        """Post the IPNs.
+
+        Args:
+            events: see :meth:`prepare`.
+            settle: seconds to wait after the last response before counting processed IPNs
+                (more if IPNs are processed from the inbox).
+            in_process: the server runs in this process (see :func:`serve`), so count exceptions of its handlers.
+
+        Returns:
+            :class:`LoadReport`."""
+        processed_before = ProcessedIPN.objects.count()
+        dropped_before = ProcessedIPN.duplicates_dropped()
+        monitor = LockMonitor()
+        tasks = queue.Queue(maxsize=self.concurrency * 4)
+        latencies = collections.defaultdict(list)
+        errors = [0]
+        lock = threading.Lock()
+
+        def work():
+            session = requests.Session()
+            while True:
+                task = tasks.get()
+                if task is None:
+                    break
+                arrival, ipn = task
+                if arrival is None:
+                    arrival = time.perf_counter()
+                try:
+                    r = session.post(self.url, data=IPNGenerator.encode(ipn), timeout=self.timeout,
+                                     headers={'Content-Type': 'application/x-www-form-urlencoded; charset=utf-8'})
+                    failed = r.status_code != 200
+                except requests.RequestException:
+                    logger.exception("Posting an IPN failed")
+                    failed = True
+                latency = time.perf_counter() - arrival
+                with lock:
+                    latencies[ipn['txn_type']].append(latency)
+                    if failed:
+                        errors[0] += 1
+            session.close()
+
+        threads = [threading.Thread(target=work, name="%s %d" % (self.THREAD_PREFIX, i))
+                   for i in range(self.concurrency)]
+        handler_errors = ErrorCounter() if in_process else None
+        if handler_errors is not None:
+            handler_errors.start()
+        monitor.start()
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        try:
+            arrival = started
+            for ipn, duplicate in events:
+                if self.rate:
+                    arrival += self.random.expovariate(self.rate)
+                    delay = arrival - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    tasks.put((arrival, ipn))
+                else:
+                    tasks.put((None, ipn))
+        finally:
+            for thread in threads:
+                tasks.put(None)
+            for thread in threads:
+                thread.join()
+        elapsed = time.perf_counter() - started
+        time.sleep(settle)
+        monitor.stop()
+        if handler_errors is not None:
+            handler_errors.stop()
+        return LoadReport(self.concurrency, elapsed, latencies, errors[0],
+                          sum(1 for ipn, duplicate in events if duplicate),
+                          ProcessedIPN.objects.count() - processed_before,
+                          ProcessedIPN.duplicates_dropped() - dropped_before,
+                          monitor.stats(),
+                          handler_errors.count if handler_errors is not None else None)
+
+
+class QuietHandler(WSGIRequestHandler):
+    """Internal."""
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    """Internal."""
+    daemon_threads = True
+
+
+def serve(host='127.0.0.1', port=0):
+    """Serve this Django project in background threads of this process
+    (so that :class:`LockMonitor` sees the IPN handlers).
+
+    Returns:
+        The server (stop it with `shutdown()`) and its base URL."""
+    server = make_server(host, port, get_wsgi_application(), server_class=ThreadingWSGIServer,
+                         handler_class=QuietHandler)
+    threading.Thread(target=server.serve_forever, name="Load test server", daemon=True).start()
+    return server, 'http://%s:%d' % server.server_address[:2]
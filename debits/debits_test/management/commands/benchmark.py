@@ -0,0 +1,61 @@
+import datetime
+import json
+import platform
+import random
+
+import django
+import django.db
+from django.core.management.base import BaseCommand, CommandError
+
+from debits.debits_test.benchmarks import BENCHMARKS, REMINDER_SIZES
+
+
+class Command(BaseCommand):
+    help = "Run performance benchmarks."
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', help="Benchmarks to run (all by default): %s." % ', '.join(BENCHMARKS))
+        parser.add_argument('-n', type=int, default=1000, help="The number of iterations.")
+        parser.add_argument('--seed', type=int, default=0, help="Random seed for synthetic data.")
+        parser.add_argument('--reminder-sizes', default=','.join(map(str, REMINDER_SIZES)),
+                            help="Comma-separated numbers of subscriptions for the reminders benchmark.")
+        parser.add_argument('--json', help="Save results to this JSON file.")
+        parser.add_argument('--compare', help="Compare with results saved by --json.")
+
+    def handle(self, *args, **options):
+        names = options['names'] or list(BENCHMARKS)
+        for name in names:
+            if name not in BENCHMARKS:
+                raise CommandError("No benchmark %s" % name)
+        try:
+            reminder_sizes = [int(size) for size in options['reminder_sizes'].split(',')]
+        except ValueError:
+            raise CommandError("Wrong --reminder-sizes: %s" % options['reminder_sizes'])
+        baseline = {}
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)['results']
+        results = {}
+        for name in names:
+            self.stdout.write("%s:" % name)
+            self.stdout.write("    %-40s %12s %10s %10s %9s" % ("", "ops/s", "p50 ms", "p99 ms", "queries"))
+            kwargs = {'sizes': reminder_sizes} if name == 'reminders' else {}
+            measurements = BENCHMARKS[name](options['n'], random.Random(options['seed']), **kwargs)
+            results[name] = [m.as_dict() for m in measurements]
+            old = {r['label']: r for r in baseline.get(name, [])}
+            for m in measurements:
+                line = "    %-40s %12.1f %10.3f %10.3f %9.2f" % \
+                       (m.label, m.ops, m.p50 * 1000, m.p99 * 1000, m.queries)
+                if m.label in old and old[m.label]['ops'] > 0:
+                    line += "  %+6.1f%%" % ((m.ops / old[m.label]['ops'] - 1) * 100)
+                self.stdout.write(line)
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump({'meta': {'date': datetime.datetime.utcnow().isoformat(),
+                                    'n': options['n'],
+                                    'seed': options['seed'],
+                                    'reminder_sizes': reminder_sizes,
+                                    'python': platform.python_version(),
+                                    'django': django.get_version(),
+                                    'db': django.db.connection.vendor},
+                           'results': results}, f, indent=2)
@@ -0,0 +1,44 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from debits.debits_test.fake_paypal import FakePayPal
+
+
+class Command(BaseCommand):
+    help = "Run a local stand-in for PayPal (set PAYPAL_WEB_HOST and PAYPAL_API_HOST settings to its URL)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8001)
+        parser.add_argument('--latency', type=float, default=0.0, help="Seconds added to every response.")
+        parser.add_argument('--jitter', type=float, default=0.0, help="Random seconds (up to) added to every response.")
+        parser.add_argument('--error-rate', type=float, default=0.0,
+                            help="Probability of HTTP 500 for verification and API requests.")
+        parser.add_argument('--throttle-rate', type=float, default=0.0, help="Probability of HTTP 429 for API requests.")
+        parser.add_argument('--invalid-rate', type=float, default=0.0,
+                            help="Probability of INVALID answer to IPN verification.")
+        parser.add_argument('--ipn-delay', type=float, default=1.0, help="Seconds before posting IPNs of a paid form.")
+        parser.add_argument('--payments', type=int, default=1, help="Payments of a subscription paid by a form.")
+        parser.add_argument('--seed', type=int, default=None, help="Random seed.")
+
+    def handle(self, *args, **options):
+        fake = FakePayPal(host=options['host'],
+                          port=options['port'],
+                          latency=options['latency'],
+                          jitter=options['jitter'],
+                          error_rate=options['error_rate'],
+                          throttle_rate=options['throttle_rate'],
+                          invalid_rate=options['invalid_rate'],
+                          ipn_delay=options['ipn_delay'],
+                          payments=options['payments'],
+                          seed=options['seed'])
+        with fake:
+            self.stdout.write("Fake PayPal at %s (PAYPAL_WEB_HOST = PAYPAL_API_HOST = '%s')" % (fake.url, fake.url))
+            try:
+                while True:
+                    time.sleep(60)
+                    self.stdout.write(str(dict(fake.stats)))
+            except KeyboardInterrupt:
+                pass
+        self.stdout.write(str(dict(fake.stats)))
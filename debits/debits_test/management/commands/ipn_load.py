@@ -0,0 +1,91 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+from django.urls import reverse
+
+from debits.debits_test.fake_paypal import FakePayPal
+from debits.debits_test.ipn_load import IPNLoad, serve
+
+
+class Command(BaseCommand):
+    help = "Post concurrent IPN streams to the PayPal IPN view and report latencies, errors and DB lock waits. " \
+           "It creates transactions in the DB, so use a test DB."
+
+    def add_arguments(self, parser):
+        target = parser.add_mutually_exclusive_group(required=True)
+        target.add_argument('--url',
+                            help="The IPN URL of a running server (which verifies IPNs at a fake PayPal, "
+                                 "see fake_paypal command and PAYPAL_WEB_HOST setting). "
+                                 "'-' for IPN_HOST setting and the paypal-ipn URL.")
+        target.add_argument('--serve', action='store_true',
+                            help="Serve the project and a fake PayPal in this process "
+                                 "(so that SELECT FOR UPDATE statements of the IPN handlers are timed).")
+        parser.add_argument('--concurrency', default='8',
+                            help="The number of concurrent requests, or a comma-separated list of them "
+                                 "to run once for each (such as 1,2,4,8,16).")
+        parser.add_argument('--rate', type=float, default=0.0,
+                            help="Average IPN arrivals per second, 0 to post as fast as possible.")
+        parser.add_argument('--subscriptions', type=int, default=100, help="Subscriptions (IPN streams) per run.")
+        parser.add_argument('--payments', type=int, default=1, help="Payments per subscription.")
+        parser.add_argument('--no-cancel', action='store_true', help="Do not end subscriptions with a cancellation.")
+        parser.add_argument('--recurring', action='store_true',
+                            help="Send recurring_payment_* IPNs (as for Express Checkout) instead of subscr_*.")
+        parser.add_argument('--duplicates', type=float, default=0.05,
+                            help="Probability to repeat an IPN (as PayPal does).")
+        parser.add_argument('--verify-latency', type=float, default=0.05,
+                            help="Seconds of IPN verification by the fake PayPal of --serve.")
+        parser.add_argument('--settle', type=float, default=1.0,
+                            help="Seconds to wait for processing to finish before counting processed IPNs.")
+        parser.add_argument('--seed', type=int, default=None, help="Random seed.")
+        parser.add_argument('--json', help="Save reports to this JSON file.")
+
+    def handle(self, *args, **options):
+        try:
+            levels = [int(level) for level in options['concurrency'].split(',')]
+        except ValueError:
+            raise CommandError("Wrong --concurrency: %s" % options['concurrency'])
+        if options['serve']:
+            fake = FakePayPal(latency=options['verify_latency'], seed=options['seed']).start()
+            server, base = serve()
+            try:
+                with override_settings(PAYPAL_WEB_HOST=fake.url, PAYPAL_API_HOST=fake.url):
+                    reports = self.run(base + reverse('paypal-ipn'), levels, options, in_process=True)
+            finally:
+                server.shutdown()
+                server.server_close()
+                fake.stop()
+        else:
+            url = settings.IPN_HOST + reverse('paypal-ipn') if options['url'] == '-' else options['url']
+            reports = self.run(url, levels, options)
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump([report.as_dict() for report in reports], f, indent=2)
+
+    def run(self, url, levels, options, in_process=False):
+        """Internal."""
+        reports = []
+        for i, concurrency in enumerate(levels):
+            # another seed for each run, as repeated IPN keys would be dropped as duplicates
+            seed = None if options['seed'] is None else options['seed'] + i
+            load = IPNLoad(url, concurrency=concurrency, rate=options['rate'] or None, seed=seed)
+            events = load.prepare(options['subscriptions'],
+                                  payments=options['payments'],
+                                  cancel=not options['no_cancel'],
+                                  recurring=options['recurring'],
+                                  duplicates=options['duplicates'])
+            report = load.run(events, settle=options['settle'], in_process=in_process)
+            self.stdout.write(str(report))
+            reports.append(report)
+        if len(reports) > 1:
+            self.stdout.write("%11s %10s %9s %9s %8s %13s %13s %11s" %
+                              ("concurrency", "IPN/s", "p50 ms", "p99 ms", "errors", "unprocessed",
+                               "FOR UPDATE s", "lock errors"))
+            for report in reports:
+                d = report.as_dict()
+                self.stdout.write("%11d %10.1f %9.1f %9.1f %7.2f%% %12.2f%% %13.2f %11d" %
+                                  (d['concurrency'], d['throughput'], d['p50'] * 1000, d['p99'] * 1000,
+                                   d['error_rate'] * 100, d['unprocessed_rate'] * 100,
+                                   d['locks']['for_update_total'], d['locks']['lock_errors']))
+        return reports
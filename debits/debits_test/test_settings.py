@@ -75,12 +75,41 @@ USE_TZ = True
 PROLONG_PAYMENT_VIEW = 'transaction-prolong-payment'
 PAYMENTS_DAYS_BEFORE_DUE_REMIND = 10
 PAYMENTS_DAYS_BEFORE_TRIAL_END_REMIND = 10
+# PAYMENTS_REMINDERS_CHUNK_SIZE = 1000
+# PAYMENTS_EMAIL_SKELETONS = False  # True if templates don't use `transaction`
+# PAYMENTS_MAIL_MESSAGES_PER_CONNECTION = 100
+# PAYMENTS_MAIL_CONNECTIONS = 1
+# PAYMENTS_EMAIL_OUTBOX = True  # then run `manage.py send_outbox`
+# PAYMENTS_EMAIL_MAX_ATTEMPTS = 8
+# PAYMENTS_CANCEL_QUEUE = True  # cancel subscriptions (unsubscribe and upgrade) by `manage.py process_cancellations`
+# PAYMENTS_CANCEL_MAX_ATTEMPTS = 8
+# PAYMENTS_ACTIVITY_CACHE_SIZE = 10000
+# PAYMENTS_ACTIVITY_CACHE_TTL = 60
+# PAYMENTS_ACTIVITY_CACHE_ALIAS = 'default'
+# PAYMENTS_ACTIVITY_SHARED_TTL = 3600
+# PAYMENTS_ENTITLEMENT_KEYS = [('2', 'new secret'), ('1', 'old secret')]  # the first one signs
+# PAYMENTS_ENTITLEMENT_TTL = 300
+# PAYMENTS_TRANSACTION_KEYS = [('2', 'new secret'), ('1', SECRET_KEY)]  # the first one encodes
+# PAYMENTS_LEGACY_CUSTOM = True  # accept MD5 secrets of old transactions
 #PAYPAL_EMAIL = 'XXX'
 #PAYPAL_ID = 'XXX' #PayPal account ID
 # https://developer.paypal.com/developer/applications
 #PAYPAL_CLIENT_ID = 'XXX'
 #PAYPAL_SECRET = 'XXX'
 PAYPAL_DEBUG = True
+#PAYPAL_IPN_INBOX = True  # store IPNs and process them by `manage.py process_ipn_inbox`
+#PAYPAL_IPN_MAX_ATTEMPTS = 8
+#PAYPAL_WEB_HOST = 'http://127.0.0.1:8001'  # `manage.py fake_paypal` instead of the PayPal site
+#PAYPAL_API_HOST = 'http://127.0.0.1:8001'  # `manage.py fake_paypal` instead of the PayPal API
+#PAYPAL_HTTP_POOL_SIZE = 10  # keep-alive connections to PayPal per process
+#PAYPAL_HTTP_CONNECT_TIMEOUT = 5
+#PAYPAL_HTTP_READ_TIMEOUT = 30
+#PAYPAL_HTTP_RETRIES = 2  # retries on connection errors
+#PAYPAL_TOKEN_REFRESH_MARGIN = 300  # seconds before expiry to refresh the OAuth token
+#PAYPAL_TOKEN_CACHE_ALIAS = 'default'  # share the OAuth token among processes
+#PAYPAL_WEBHOOK_ID = 'XXX'  # for REST webhooks
+#PAYPAL_CERT_CACHE_DIR = '/var/cache/debits/paypal-certs'  # private (mode 0700), memory only if not set
+#PAYPAL_CERT_CACHE_TTL = 24*3600
 PAYMENTS_REALM = 'testapp1'
 
 try:
@@ -0,0 +1,408 @@
+import base64
+import datetime
+import json
+import os
+import random
+import tempfile
+from collections import Counter, namedtuple
+from decimal import Decimal
+from unittest import mock, skipIf
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.x509.oid import NameOID
+from django.http import QueryDict
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+from debits.debits_base.base import Period
+from debits.debits_base.models import CancellationJob, OutgoingEmail, Purchase, SimpleItem, ProlongPurchase, \
+    SimpleTransaction, SubscriptionItem, SubscriptionPurchase, SubscriptionTransaction
+from debits.debits_base.queue import QueueStatus, process_batch, WorkerStats
+from debits.debits_base.processors import PAYMENT_PROCESSOR_PAYPAL
+from debits.debits_test.business import create_organization
+from debits.debits_test.callbacks import MyPayPalIPN
+from debits.debits_test.fake_paypal import FakePayPal
+from debits.debits_test.ipn_generator import IPNGenerator, form_items
+from debits.debits_test.models import PricingPlan
+from debits.paypal import projection, webhooks
+from debits.paypal.bulk import BulkRunner, BulkStatus, Checkpoint
+from debits.paypal.models import PayPalAPI, PayPalProcessorInfo
+
+PAYPAL_SETTINGS = dict(PAYMENTS_HOST='http://localhost:8000',
+                       IPN_HOST='http://localhost:8000',
+                       FROM_EMAIL='billing@example.com',
+                       PAYPAL_EMAIL='seller@example.com',
+                       PAYPAL_ID='SELLER',
+                       PAYMENTS_EMAIL_OUTBOX=False)
+"""Settings usually set in ``local_settings``."""
+
+
+@override_settings(**PAYPAL_SETTINGS)
+class IPNQueriesTest(TestCase):
+    """DB queries of every PayPal IPN `txn_type` (after the verification postback).
+
+    The counts include savepoints (the test runs in a transaction)."""
+
+    fixtures = ['processors', 'products', 'pricingplans']
+
+    def setUp(self):
+        self.view = MyPayPalIPN()
+        self.generator = IPNGenerator(seed=1)
+        self.plan = PricingPlan.objects.get(pk=1)
+
+    def subscription(self, recurring=False):
+        purchase = create_organization("Test", self.plan.pk, 0).purchase
+        transaction = SubscriptionTransaction.objects.create(processor_id=PAYMENT_PROCESSOR_PAYPAL, purchase=purchase)
+        return self.generator.sequence(form_items(transaction), payments=1, cancel=True, recurring=recurring)
+
+    def prolong(self):
+        purchase = create_organization("Test", self.plan.pk, 0).purchase
+        item = SimpleItem.objects.create(product=self.plan.product, currency='USD', price=self.plan.price)
+        prolong = ProlongPurchase.objects.create(item=item, prolonged=purchase,
+                                                 period_unit=Period.UNIT_MONTHS, period_count=1)
+        transaction = SimpleTransaction.objects.create(processor_id=PAYMENT_PROCESSOR_PAYPAL, purchase=prolong)
+        return self.generator.sequence(form_items(transaction), refund=True)
+
+    def post(self, ipn):
+        self.view.verified_post(QueryDict(IPNGenerator.encode(ipn)))
+
+    def assertIPNQueries(self, ipns, counts):
+        """Process `ipns` checking that the IPN `i` does `counts[i]` queries."""
+        for ipn, count in zip(ipns, counts):
+            with self.subTest(ipn.get('txn_type') or ipn['payment_status']), self.assertNumQueries(count):
+                self.post(ipn)
+
+    def test_subscription(self):
+        self.assertIPNQueries(self.subscription(), [17, 18, 9])
+
+    def test_recurring(self):
+        self.assertIPNQueries(self.subscription(recurring=True), [17, 18, 9])
+
+    def test_regular_payment_and_refund(self):
+        self.assertIPNQueries(self.prolong(), [24, 18])
+
+
+def self_signed_certificate():
+    """A private key and its PEM certificate, valid for a day."""
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'messageverificationcerts.paypal.com')])
+    now = datetime.datetime.utcnow()
+    cert = x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key()).\
+        serial_number(x509.random_serial_number()).\
+        not_valid_before(now - datetime.timedelta(hours=1)).not_valid_after(now + datetime.timedelta(days=1)).\
+        sign(key, hashes.SHA256(), default_backend())
+    return key, cert.public_bytes(serialization.Encoding.PEM)
+
+
+@override_settings(PAYPAL_WEBHOOK_ID='WH-TEST', **PAYPAL_SETTINGS)
+class WebhookTest(TestCase):
+    """PayPal webhooks signed with a locally generated certificate (cached, so nothing is downloaded)."""
+
+    fixtures = ['processors', 'products', 'pricingplans']
+
+    CERT_URL = 'https://api.paypal.com/v1/notifications/certs/CERT-TEST'
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.key, cls.pem = self_signed_certificate()
+
+    def setUp(self):
+        self.saved_cache = webhooks._cache
+        webhooks._cache = webhooks.CertificateCache()
+        webhooks._cache.put(self.CERT_URL, self.pem)
+        self.purchase = create_organization("Test", 1, 0).purchase
+        self.purchase.subscription_reference = 'I-TEST'
+        self.purchase.save()
+
+    def tearDown(self):
+        webhooks._cache = self.saved_cache
+
+    def post(self, event, cert_url=CERT_URL, body=None):
+        """Post `event` signed with the test key (`body` replaces the signed body)."""
+        signed = json.dumps(event).encode()
+        message = webhooks.expected_message('TID', '2020-01-01T00:00:00Z', 'WH-TEST', signed)
+        signature = self.key.sign(message.encode(), padding.PKCS1v15(), hashes.SHA256())
+        return self.client.post(reverse('paypal-webhook'), body or signed, content_type='application/json',
+                                HTTP_PAYPAL_TRANSMISSION_ID='TID',
+                                HTTP_PAYPAL_TRANSMISSION_TIME='2020-01-01T00:00:00Z',
+                                HTTP_PAYPAL_TRANSMISSION_SIG=base64.b64encode(signature).decode(),
+                                HTTP_PAYPAL_CERT_URL=cert_url,
+                                HTTP_PAYPAL_AUTH_ALGO='SHA256withRSA')
+
+    def cancelled(self):
+        return {'event_type': 'BILLING.SUBSCRIPTION.CANCELLED', 'resource': {'id': 'I-TEST'}}
+
+    def test_signed(self):
+        self.assertEqual(self.post(self.cancelled()).status_code, 200)
+        self.purchase.refresh_from_db()
+        self.assertIsNone(self.purchase.subscription_reference)
+
+    def test_tampered(self):
+        body = json.dumps({'event_type': 'BILLING.SUBSCRIPTION.SUSPENDED', 'resource': {'id': 'I-TEST'}}).encode()
+        self.assertEqual(self.post(self.cancelled(), body=body).status_code, 400)
+        self.purchase.refresh_from_db()
+        self.assertEqual(self.purchase.subscription_reference, 'I-TEST')
+
+    def test_foreign_certificate_url(self):
+        url = 'https://example.com/cert.pem'
+        with tempfile.TemporaryDirectory() as directory:
+            os.chmod(directory, 0o700)
+            # even a certificate already on disk (say, planted) is not used for this URL
+            cache = webhooks.CertificateCache(directory)
+            with open(cache._path(url), 'wb') as f:
+                f.write(self.pem)
+            webhooks._cache = cache
+            self.assertEqual(self.post(self.cancelled(), cert_url=url).status_code, 400)
+        self.purchase.refresh_from_db()
+        self.assertEqual(self.purchase.subscription_reference, 'I-TEST')
+
+    def test_public_cache_directory(self):
+        with tempfile.TemporaryDirectory() as directory:
+            os.chmod(directory, 0o777)
+            with self.assertRaises(webhooks.CertificateError):
+                webhooks.CertificateCache(directory).get(self.CERT_URL)
+
+    def test_private_cache_directory(self):
+        with tempfile.TemporaryDirectory() as parent:
+            directory = os.path.join(parent, 'certs')
+            cache = webhooks.CertificateCache(directory)
+            cache._check_directory()
+            self.assertEqual(os.stat(directory).st_mode & 0o777, 0o700)
+
+    @override_settings(PAYPAL_WEBHOOK_ID=None)
+    def test_no_webhook_id(self):
+        self.assertEqual(self.post(self.cancelled()).status_code, 503)
+
+
+class QueueTest(TestCase):
+    """:class:`~debits.debits_base.queue.QueueItem` settings."""
+
+    def fail_once(self):
+        email = OutgoingEmail.objects.create(subject="S", from_email='a@example.com', to='b@example.com', text="T")
+        with mock.patch.object(OutgoingEmail, 'process', side_effect=RuntimeError("SMTP down")):
+            process_batch(OutgoingEmail, WorkerStats("Test"), 10)
+        email.refresh_from_db()
+        return email
+
+    def test_max_attempts_default(self):
+        self.assertEqual(self.fail_once().status, QueueStatus.PENDING)
+
+    @override_settings(PAYMENTS_EMAIL_MAX_ATTEMPTS=1)
+    def test_max_attempts_setting(self):
+        self.assertEqual(self.fail_once().status, QueueStatus.DEAD)
+
+
+@override_settings(PAYPAL_CLIENT_ID='CLIENT', PAYPAL_SECRET='SECRET', **PAYPAL_SETTINGS)
+class CancellationTest(TestCase):
+    """Canceling subscriptions at a :class:`~debits.debits_test.fake_paypal.FakePayPal`."""
+
+    fixtures = ['processors', 'products', 'pricingplans']
+
+    def setUp(self):
+        self.fake = FakePayPal().start()
+        self.addCleanup(self.fake.stop)
+        settings = override_settings(PAYPAL_API_HOST=self.fake.url)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.organization = create_organization("Test", 1, 0)
+        SubscriptionPurchase.objects.filter(pk=self.organization.purchase.pk).\
+            update(subscription_reference='I-OLD', processor_id=PAYMENT_PROCESSOR_PAYPAL)
+        self.old = SubscriptionPurchase.objects.get(pk=self.organization.purchase.pk)
+
+    def process_jobs(self):
+        process_batch(CancellationJob, WorkerStats("Test"), 10)
+
+    def test_upgrade_server_error(self):
+        new = create_organization("New", 2, 0).purchase
+        Purchase.objects.filter(pk=new.pk).update(old_subscription=self.old)
+        new = Purchase.objects.get(pk=new.pk)
+        self.fake.error_rate = 1.0
+        new.upgrade_subscription()  # not rolled back: canceling is queued
+        self.assertIsNone(Purchase.objects.get(pk=new.pk).old_subscription)
+        job = CancellationJob.objects.get(subscription_reference='I-OLD')
+        self.assertEqual((job.status, job.is_upgrade), (QueueStatus.PENDING, True))
+        self.fake.error_rate = 0.0
+        self.process_jobs()
+        job.refresh_from_db()
+        self.assertEqual(job.state(), {'status': 'done', 'message': None})
+        self.assertEqual(self.fake.canceled, {'I-OLD'})
+
+    def test_unsubscribe(self):
+        response = self.client.post(reverse('unsubscribe-organization', args=[self.organization.pk]))
+        self.assertEqual(response.json(), {'status': 'done', 'message': None})
+        self.assertEqual(self.fake.canceled, {'I-OLD'})
+
+    @override_settings(PAYMENTS_CANCEL_QUEUE=True)
+    def test_unsubscribe_queued(self):
+        url = reverse('unsubscribe-organization', args=[self.organization.pk])
+        self.assertEqual(self.client.post(url).json()['status'], 'pending')
+        self.assertEqual(self.client.post(url).json()['status'], 'pending')  # the same job
+        self.assertEqual(self.fake.canceled, set())
+        self.process_jobs()
+        status = self.client.get(reverse('unsubscribe-status', args=[self.organization.pk])).json()
+        self.assertEqual(status, {'status': 'done', 'message': None})
+        self.assertEqual(self.fake.canceled, {'I-OLD'})
+
+
+@override_settings(PAYPAL_CLIENT_ID='CLIENT', PAYPAL_SECRET='SECRET', **PAYPAL_SETTINGS)
+class BulkTest(TestCase):
+    """:class:`~debits.paypal.bulk.BulkRunner` against a :class:`~debits.debits_test.fake_paypal.FakePayPal`."""
+
+    def setUp(self):
+        self.fake = FakePayPal(seed=1).start()
+        self.addCleanup(self.fake.stop)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.checkpoint_path = os.path.join(directory.name, 'checkpoint.jsonl')
+
+    def run_bulk(self, ids, action='cancel'):
+        """Returns:
+            Statuses by ID."""
+        checkpoint = Checkpoint(self.checkpoint_path)
+        try:
+            runner = BulkRunner(action, PayPalAPI(server=self.fake.url), workers=3, attempts=2, backoff=0,
+                                checkpoint=checkpoint)
+            results = runner.run((id, {}) for id in ids)
+        finally:
+            checkpoint.close()
+        self.assertEqual(sorted(result['id'] for result in results), sorted(ids))
+        return {result['id']: result['status'] for result in results}
+
+    def test_refusal(self):
+        self.fake.canceled.add('I-1')
+        self.assertEqual(self.run_bulk(['I-1', 'I-2']), {'I-1': BulkStatus.REFUSED, 'I-2': BulkStatus.OK})
+
+    def test_temporary_failures_and_rerun(self):
+        self.fake.error_rate = 1.0
+        self.assertEqual(self.run_bulk(['I-1', 'I-2']), {'I-1': BulkStatus.ERROR, 'I-2': BulkStatus.ERROR})
+        self.fake.error_rate, self.fake.throttle_rate = 0.0, 1.0
+        self.assertEqual(self.run_bulk(['I-1']), {'I-1': BulkStatus.ERROR})
+        self.assertEqual(self.fake.stats['injected 500'], 4)
+        self.assertEqual(self.fake.stats['injected 429'], 2)
+        self.fake.throttle_rate = 0.0
+        self.assertEqual(self.run_bulk(['I-1', 'I-2']), {'I-1': BulkStatus.OK, 'I-2': BulkStatus.OK})
+        # finished operations are skipped
+        self.assertEqual(self.run_bulk(['I-1', 'I-2', 'I-3']),
+                         {'I-1': BulkStatus.SKIPPED, 'I-2': BulkStatus.SKIPPED, 'I-3': BulkStatus.OK})
+        self.assertEqual(self.fake.stats['cancel'], 3)
+
+    def test_unexpected_error(self):
+        with mock.patch.object(PayPalAPI, 'cancel_agreement', side_effect=KeyError('message')):
+            self.assertEqual(self.run_bulk(['I-1', 'I-2']), {'I-1': BulkStatus.ERROR, 'I-2': BulkStatus.ERROR})
+        with open(self.checkpoint_path) as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+
+Offset = namedtuple('Offset', ('unit', 'count'))
+"""A value with the attributes of a :class:`~debits.debits_base.base.Period` field."""
+
+
+def random_start(rng):
+    """A random date, often at the end of a month or on Feb 29."""
+    kind = rng.random()
+    year = rng.randint(1990, 2030)
+    if kind < 0.2:
+        return datetime.date(rng.choice([1992, 1996, 2000, 2004, 2024]), 2, 29)
+    if kind < 0.6:
+        month = rng.randint(1, 12)
+        day = rng.randint(28, 31)
+        while True:
+            try:
+                return datetime.date(year, month, day)
+            except ValueError:
+                day -= 1
+    return datetime.date(year, 1, 1) + datetime.timedelta(days=rng.randrange(365))
+
+
+class OffsetDateTest(SimpleTestCase):
+    """:meth:`~debits.paypal.models.PayPalProcessorInfo.next_offset_date` gives the same dates
+    as repeated :meth:`~debits.paypal.models.PayPalProcessorInfo.offset_date`."""
+
+    @staticmethod
+    def loop(date, offset, after):
+        while date <= after:
+            date = PayPalProcessorInfo.offset_date(date, offset)
+        return date
+
+    def test_random(self):
+        rng = random.Random(24)
+        for i in range(3000):
+            unit = rng.choice((Period.UNIT_DAYS, Period.UNIT_WEEKS, Period.UNIT_MONTHS, Period.UNIT_YEARS))
+            offset = Offset(unit, rng.choice((1, 1, 2, 3, 5, 6, 7, 12, 13)))
+            date = random_start(rng)
+            # up to 40 years lapsed for months and years, 10 for days and weeks (the loop is slow)
+            years = 40 if unit in (Period.UNIT_MONTHS, Period.UNIT_YEARS) else 10
+            after = date + datetime.timedelta(days=rng.randint(-30, years * 366))
+            with self.subTest(date=date, offset=offset, after=after):
+                self.assertEqual(PayPalProcessorInfo.next_offset_date(date, offset, after),
+                                 self.loop(date, offset, after))
+
+
+@skipIf(projection.np is None, "NumPy is not installed")
+class ProjectionTest(TestCase):
+    """:func:`~debits.paypal.projection.project` gives the same charges as stepping every subscription
+    by :meth:`~debits.paypal.models.PayPalProcessorInfo.offset_date`."""
+
+    periods = [Offset(Period.UNIT_DAYS, 1), Offset(Period.UNIT_DAYS, 10), Offset(Period.UNIT_WEEKS, 2),
+               Offset(Period.UNIT_MONTHS, 1), Offset(Period.UNIT_MONTHS, 2), Offset(Period.UNIT_MONTHS, 5),
+               Offset(Period.UNIT_MONTHS, 12), Offset(Period.UNIT_YEARS, 1), Offset(Period.UNIT_YEARS, 3),
+               Offset(Period.UNIT_MONTHS, 0)]
+
+    def setUp(self):
+        rng = random.Random(25)
+        self.start = datetime.date(2023, 11, 15)
+        items = [SubscriptionItem.objects.create(price=Decimal(rng.randint(100, 9999)) / 100,
+                                                 currency=currency,
+                                                 payment_period_unit=period.unit,
+                                                 payment_period_count=period.count)
+                 for period in self.periods for currency in ('USD', 'EUR')]
+        for i in range(300):
+            due = random_start(rng)
+            while not 2000 <= due.year <= 2027:  # lapsed for years, but not too long for the loop below
+                due = random_start(rng)
+            SubscriptionPurchase.objects.create(item=rng.choice(items), due_payment_date=due,
+                                                shipping=Decimal(rng.randint(0, 500)) / 100,
+                                                tax=Decimal(rng.randint(0, 500)) / 100)
+        self.queryset = SubscriptionPurchase.objects.filter(item__in=items)
+
+    def expected(self, months):
+        end = datetime.date(self.start.year + (self.start.month + months - 1) // 12,
+                            (self.start.month + months - 1) % 12 + 1, self.start.day)
+        charges = []
+        for purchase in self.queryset.select_related('item__subscriptionitem'):
+            item = purchase.item.subscriptionitem
+            period = Offset(item.payment_period_unit, item.payment_period_count)
+            if period.count == 0:
+                continue
+            date = purchase.due_payment_date
+            while date < self.start:
+                date = PayPalProcessorInfo.offset_date(date, period)
+            while date < end:
+                charges.append((purchase.pk, date, item.currency,
+                                int((item.price + purchase.shipping + purchase.tax) * 100)))
+                date = PayPalProcessorInfo.offset_date(date, period)
+        return charges
+
+    def test_project(self):
+        for months in (1, 12, 40):
+            with self.subTest(months=months):
+                result = projection.project(months, self.start, self.queryset, batch_size=70)
+                expected = self.expected(months)
+                actual = [(int(purchase), date.item(), str(currency), int(cents))
+                          for purchase, date, currency, cents in zip(result.purchase, result.date,
+                                                                     result.currency, result.cents)]
+                self.assertEqual(sorted(actual), sorted(expected))
+
+                totals = result.by_day_and_currency()
+                cents, count = Counter(), Counter()
+                for purchase, date, currency, amount in expected:
+                    cents[date, currency] += amount
+                    count[date, currency] += 1
+                self.assertEqual([(date.item(), str(currency), int(amount), int(n))
+                                  for date, currency, amount, n in zip(totals['date'], totals['currency'],
+                                                                       totals['cents'], totals['count'])],
+                                 [key + (cents[key], count[key]) for key in sorted(cents)])
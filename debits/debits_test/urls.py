@@ -1,4 +1,5 @@
 from django.conf.urls import url
+from debits.paypal.webhooks import PayPalWebhook
 from .callbacks import MyPayPalIPN
 from . import views
 
@@ -9,5 +10,7 @@ urlpatterns = [
     url(r'^transaction-prolong-payment/([0-9]+)$', views.transaction_payment_view, name='transaction-prolong-payment'),
     url(r'^organization-prolong-payment/([0-9]+)$', views.organization_payment_view, name='organization-prolong-payment'),
     url(r'^unsubscribe-organization/([0-9]+)$', views.unsubscribe_organization_view, name='unsubscribe-organization'),
-    url(r'^paypal/ipn$', MyPayPalIPN.as_view(), name='paypal-ipn')
+    url(r'^unsubscribe-status/([0-9]+)$', views.unsubscribe_status_view, name='unsubscribe-status'),
+    url(r'^paypal/ipn$', MyPayPalIPN.as_view(), name='paypal-ipn'),
+    url(r'^paypal/webhook$', PayPalWebhook.as_view(), name='paypal-webhook'),
 ]
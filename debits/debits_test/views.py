@@ -1,6 +1,6 @@
 import datetime
 
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
 from django.shortcuts import render, reverse
 from django.utils.translation import ugettext_lazy as _
 from .models import Organization, MyPurchase, PricingPlan
@@ -189,14 +189,16 @@ def purchase_view(request):
         return do_upgrade(hash, form, processor, purchase, organization)
 
 
-# TODO: purchase argument is not used
 def do_unsubscribe(purchase):
+    """Cancel the subscription (see :meth:`~debits.debits_base.models.SubscriptionPurchase.cancel_at_processor`)
+    and return its state (the page polls :func:`unsubscribe_status_view` while it is pending)."""
     try:
-        purchase.force_cancel()
+        job = purchase.cancel_at_processor()
     except CannotCancelSubscription as e:
-        return HttpResponse(e)
-    else:
-        return HttpResponse('')  # empty string means success
+        return JsonResponse({'status': 'failed', 'message': str(e)})
+    if job is None:
+        return JsonResponse({'status': 'done', 'message': None})
+    return JsonResponse(job.state())
 
 
 def unsubscribe_organization_view(request, organization_pk):
@@ -208,6 +210,15 @@ def unsubscribe_organization_view(request, organization_pk):
     # return HttpResponseRedirect(reverse('organization-prolong-payment', args=[organization.pk]))
 
 
+def unsubscribe_status_view(request, organization_pk):
+    """Django view polled while the subscription is being canceled."""
+    organization = Organization.objects.get(pk=int(organization_pk))  # in real code should use user login information
+    job = organization.purchase.subscriptionpurchase.cancellations.order_by('-pk').first()
+    if job is None:
+        return JsonResponse({'status': 'done', 'message': None})
+    return JsonResponse(job.state())
+
+
 def list_organizations_view(request):
     """Django view to list all the organizations."""
     list = [{'id': o.id, 'name': o.name} for o in Organization.objects.all()]
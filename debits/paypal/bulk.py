@@ -0,0 +1,230 @@
+import csv
+import json
+import os
+import threading
+import time
+
+import requests
+
+from debits.debits_base.base import logger
+from debits.debits_base.models import CannotCancelSubscription, CannotRefund, ProcessorUnavailable
+
+
+class TokenBucket(object):
+    """Rate limit shared by threads: on average `rate` operations per second, with bursts of up to `burst`."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        """Wait until an operation is allowed."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class BulkStatus(object):
+    """Outcomes of an operation of :class:`BulkRunner`."""
+    OK = 'ok'
+    REFUSED = 'refused'
+    """PayPal refused (for example, the agreement is already canceled). Not retried."""
+    ERROR = 'error'
+    """Temporary failures (network, server errors, rate limiting) persisted after all attempts,
+    or an unexpected error (not retried)."""
+    SKIPPED = 'skipped'
+    """Finished by an earlier run (see :class:`Checkpoint`)."""
+
+    FINISHED = (OK, REFUSED)
+
+
+class Checkpoint(object):
+    """Results of a bulk run appended to a JSON lines file as soon as they are known,
+    so that a rerun (after a crash or an interrupt) skips finished work and retries only errors."""
+
+    def __init__(self, path):
+        self.path = path
+        self.results = {}
+        """Recorded results by ID (the last one of each ID)."""
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        result = json.loads(line)
+                    except ValueError:  # the last line of a killed run may be cut
+                        continue
+                    self.results[result['id']] = result
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+
+    def finished(self, id):
+        result = self.results.get(id)
+        return result is not None and result['status'] in BulkStatus.FINISHED
+
+    def record(self, result):
+        with self._lock:
+            self._file.write(json.dumps(result) + '\n')
+            self._file.flush()
+            self.results[result['id']] = result
+
+    def close(self):
+        self._file.close()
+
+
+def cancel(api, id):
+    """Internal."""
+    api.cancel_agreement(id)
+
+
+def refund(api, id, amount=None, currency='USD'):
+    """Internal."""
+    api.refund(id, amount, currency)
+
+
+ACTIONS = {'cancel': (cancel, CannotCancelSubscription),
+           'refund': (refund, CannotRefund)}
+"""Bulk actions: a function and the exception which means that PayPal refused."""
+
+
+class BulkRunner(object):
+    """Cancels PayPal agreements or refunds PayPal sales in bulk.
+
+    Operations run in `workers` threads (sharing the pooled HTTP session and the OAuth token of
+    :class:`~debits.paypal.models.PayPalAPI`) and all together no faster than `rate` per second
+    (`None` for no limit), so that PayPal does not throttle us. Temporary failures are retried
+    up to `attempts` times with exponential backoff.
+
+    Args:
+        action: a key of :data:`ACTIONS`.
+        api: :class:`~debits.paypal.models.PayPalAPI`.
+        checkpoint: :class:`Checkpoint` or `None`."""
+
+    def __init__(self, action, api, workers=8, rate=None, burst=None, attempts=3, backoff=1.0,
+                 checkpoint=None, report_interval=None):
+        self.function, self.refusal = ACTIONS[action]
+        self.api = api
+        self.workers = workers
+        self.bucket = TokenBucket(rate, burst or workers) if rate else None
+        self.attempts = attempts
+        self.backoff = backoff
+        self.checkpoint = checkpoint
+        self.report_interval = report_interval
+        self.elapsed = 0.0
+        """Seconds taken by the last :meth:`run`."""
+        self.counts = dict.fromkeys((BulkStatus.OK, BulkStatus.REFUSED, BulkStatus.ERROR, BulkStatus.SKIPPED), 0)
+        self._lock = threading.Lock()
+
+    def run(self, tasks):
+        """Do the operations.
+
+        Args:
+            tasks: an iterable of pairs (ID, dict of additional arguments, such as `amount` of a refund).
+                It is consumed lazily, so it may be a huge generator.
+
+        Returns:
+            A list of results: dicts with `id`, `status` (see :class:`BulkStatus`), `attempts`, `seconds`
+            and `message`."""
+        tasks = iter(tasks)
+        results = []
+        started = time.monotonic()
+        last_report = [started]
+
+        def work():
+            while True:
+                with self._lock:
+                    try:
+                        id, kwargs = next(tasks)
+                    except StopIteration:
+                        return
+                if self.checkpoint is not None and self.checkpoint.finished(id):
+                    result = dict(self.checkpoint.results[id], status=BulkStatus.SKIPPED)
+                else:
+                    result = self.run_one(id, kwargs)
+                    if self.checkpoint is not None:
+                        self.checkpoint.record(result)
+                with self._lock:
+                    results.append(result)
+                    self.counts[result['status']] += 1
+                    if self.report_interval and time.monotonic() - last_report[0] >= self.report_interval:
+                        last_report[0] = time.monotonic()
+                        logger.info(self.summary(last_report[0] - started))
+
+        threads = [threading.Thread(target=work, name="Bulk worker %d" % i) for i in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.monotonic() - started
+        logger.info(self.summary(self.elapsed))
+        return results
+
+    def run_one(self, id, kwargs):
+        """Internal.
+
+        Returns:
+            The result (see :meth:`run`)."""
+        started = time.monotonic()
+        status, message = BulkStatus.ERROR, None
+        for attempt in range(1, self.attempts + 1):
+            if self.bucket is not None:
+                self.bucket.take()
+            try:
+                self.function(self.api, id, **kwargs)
+            except self.refusal as e:
+                status, message = BulkStatus.REFUSED, str(e)
+                break
+            except (ProcessorUnavailable, requests.RequestException) as e:
+                message = str(e)
+                if attempt < self.attempts:
+                    time.sleep(self.backoff * 2 ** (attempt - 1))
+            except Exception as e:  # not to lose the ID with the worker thread
+                logger.exception("Bulk %s of %s failed" % (self.function.__name__, id))
+                status, message = BulkStatus.ERROR, "%s: %s" % (type(e).__name__, e)
+                break
+            else:
+                status, message = BulkStatus.OK, None
+                break
+        return {'id': id, 'status': status, 'attempts': attempt,
+                'seconds': round(time.monotonic() - started, 3), 'message': message}
+
+    def summary(self, elapsed):
+        """Internal."""
+        done = self.counts[BulkStatus.OK] + self.counts[BulkStatus.REFUSED] + self.counts[BulkStatus.ERROR]
+        return "%d ok, %d refused, %d errors, %d skipped in %.1fs (%.2f/s)" % \
+               (self.counts[BulkStatus.OK], self.counts[BulkStatus.REFUSED], self.counts[BulkStatus.ERROR],
+                self.counts[BulkStatus.SKIPPED], elapsed, done / elapsed if elapsed > 0 else 0.0)
+
+
+def read_tasks(f):
+    """Tasks for :meth:`BulkRunner.run` from a text file: an ID per line, optionally followed by
+    the amount and the currency of a refund (separated by whitespace). Empty lines and lines
+    starting with ``#`` are ignored."""
+    for line in f:
+        fields = line.split()
+        if not fields or fields[0].startswith('#'):
+            continue
+        kwargs = {}
+        if len(fields) > 1:
+            kwargs['amount'] = fields[1]
+        if len(fields) > 2:
+            kwargs['currency'] = fields[2]
+        yield fields[0], kwargs
+
+
+def write_report(results, path):
+    """Write results of :meth:`BulkRunner.run` to a CSV file."""
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['id', 'status', 'attempts', 'seconds', 'message'])
+        writer.writeheader()
+        for result in results:
+            writer.writerow(result)
@@ -4,6 +4,7 @@ from django.urls import reverse
 from debits.debits_base.processors import BasePaymentProcessor
 from debits.debits_base.base import Period
 from debits.debits_base.models import BaseTransaction
+from debits.paypal.models import PayPalProcessorInfo
 from django.conf import settings
 
 
@@ -39,10 +40,8 @@ class PayPalForm(BasePaymentProcessor):
         return items
 
     def init_items(self, transaction):
-        debug = settings.PAYPAL_DEBUG
-        url = 'https://www.sandbox.paypal.com' if debug else 'https://www.paypal.com'
         return {'business': settings.PAYPAL_ID,
-                'arcamens_action': url + "/cgi-bin/webscr",
+                'arcamens_action': PayPalProcessorInfo.web_host() + "/cgi-bin/webscr",
                 'cmd': "_xclick-subscriptions" if hasattr(transaction, 'subscriptiontransaction') else "_xclick",
                 'notify_url': self.ipn_url(),
                 'custom': BaseTransaction.custom_from_pk(transaction.pk),
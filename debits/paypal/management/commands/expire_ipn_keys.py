@@ -0,0 +1,21 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from debits.paypal.models import ProcessedIPN
+
+
+class Command(BaseCommand):
+    help = "Delete old keys of processed PayPal IPNs (used to drop repeated IPNs)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=60,
+                            help="Keep keys for this number of days (PayPal retries IPNs for up to 4 days).")
+        parser.add_argument('--batch', type=int, default=1000, help="Delete this number of keys per query.")
+
+    def handle(self, *args, **options):
+        self.stdout.write("%d duplicate IPNs dropped" % ProcessedIPN.duplicates_dropped())
+        before = timezone.now() - datetime.timedelta(days=options['days'])
+        deleted = ProcessedIPN.expire(before, batch_size=options['batch'])
+        self.stdout.write("%d IPN keys expired" % deleted)
@@ -0,0 +1,69 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from debits.debits_base.models import SubscriptionPurchase
+from debits.debits_base.processors import PAYMENT_PROCESSOR_PAYPAL
+from debits.paypal.bulk import BulkRunner, Checkpoint, read_tasks, write_report
+from debits.paypal.models import PayPalAPI
+
+
+class Command(BaseCommand):
+    help = "Cancel PayPal agreements or refund PayPal sales in bulk."
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['cancel', 'refund'])
+        parser.add_argument('--file',
+                            help="Read IDs from this file ('-' for stdin): an ID per line, "
+                                 "for refunds optionally followed by the amount and the currency.")
+        parser.add_argument('--product', type=int,
+                            help="Cancel the PayPal subscriptions of all purchases of the product with this PK.")
+        parser.add_argument('--workers', type=int, default=8, help="The number of concurrent requests.")
+        parser.add_argument('--rate', type=float, default=10.0,
+                            help="Requests per second (all workers together), 0 for no limit.")
+        parser.add_argument('--burst', type=int, default=None,
+                            help="Allowed burst of requests (default: the number of workers).")
+        parser.add_argument('--attempts', type=int, default=3,
+                            help="Attempts of every operation on temporary failures.")
+        parser.add_argument('--checkpoint',
+                            help="Record results in this file and skip operations finished by earlier runs.")
+        parser.add_argument('--report', help="Write results to this CSV file.")
+        parser.add_argument('--server', help="PayPal API base URL (such as of a local fake PayPal).")
+        parser.add_argument('--report-interval', type=float, default=10.0,
+                            help="Log progress each this number of seconds.")
+
+    def handle(self, *args, **options):
+        if (options['file'] is None) == (options['product'] is None):
+            raise CommandError("Specify either --file or --product.")
+        if options['product'] is not None:
+            if options['action'] != 'cancel':
+                raise CommandError("--product is only for cancel.")
+            # loaded at once, as workers cannot share a DB cursor
+            refs = SubscriptionPurchase.objects.filter(item__product_id=options['product'],
+                                                       processor_id=PAYMENT_PROCESSOR_PAYPAL,
+                                                       subscription_reference__isnull=False).\
+                order_by('pk').values_list('subscription_reference', flat=True)
+            tasks = [(ref, {}) for ref in refs]
+            f = None
+        else:
+            f = sys.stdin if options['file'] == '-' else open(options['file'])
+            tasks = read_tasks(f)
+        checkpoint = Checkpoint(options['checkpoint']) if options['checkpoint'] else None
+        runner = BulkRunner(options['action'],
+                            PayPalAPI(server=options['server']),
+                            workers=options['workers'],
+                            rate=options['rate'],
+                            burst=options['burst'],
+                            attempts=options['attempts'],
+                            checkpoint=checkpoint,
+                            report_interval=options['report_interval'])
+        try:
+            results = runner.run(tasks)
+        finally:
+            if checkpoint is not None:
+                checkpoint.close()
+            if f is not None and f is not sys.stdin:
+                f.close()
+        if options['report']:
+            write_report(results, options['report'])
+        self.stdout.write(runner.summary(runner.elapsed))
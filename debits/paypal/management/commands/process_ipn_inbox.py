@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from debits.debits_base.queue import run_workers
+from debits.paypal.models import IPNMessage
+from debits.paypal.session import pool_stats
+
+
+class Command(BaseCommand):
+    help = "Process PayPal IPNs stored in the inbox (see PAYPAL_IPN_INBOX setting)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1, help="The number of worker threads.")
+        parser.add_argument('--batch', type=int, default=10, help="How many IPNs a worker claims at once.")
+        parser.add_argument('--once', action='store_true', help="Exit when the inbox is drained.")
+        parser.add_argument('--idle-sleep', type=float, default=1.0,
+                            help="Seconds to wait when the inbox is empty.")
+        parser.add_argument('--report-interval', type=float, default=60.0,
+                            help="Log throughput of every worker each this number of seconds.")
+
+    def handle(self, *args, **options):
+        stats = run_workers(IPNMessage,
+                            workers=options['workers'],
+                            batch=options['batch'],
+                            once=options['once'],
+                            idle_sleep=options['idle_sleep'],
+                            report_interval=options['report_interval'])
+        for s in stats:
+            self.stdout.write(str(s))
+        self.stdout.write("HTTP pool: %(requests)d requests, %(connections)d connections, reuse ratio %(reuse_ratio).2f"
+                          % pool_stats())
@@ -0,0 +1,35 @@
+# Generated by Django 2.2.28 on 2026-10-17 18:48
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('paypal', '0002_auto_20190507_1600'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IPNMessage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.SmallIntegerField(db_index=True, default=1, verbose_name='Queue status')),
+                ('creation_date', models.DateTimeField(auto_now_add=True)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('next_attempt', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('claim', models.CharField(db_index=True, max_length=32, null=True)),
+                ('claimed_at', models.DateTimeField(null=True)),
+                ('finished', models.DateTimeField(null=True)),
+                ('last_error', models.TextField(null=True)),
+                ('handler', models.CharField(max_length=255)),
+                ('body', models.BinaryField()),
+                ('content_type', models.CharField(max_length=255)),
+                ('charset', models.CharField(max_length=40, null=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
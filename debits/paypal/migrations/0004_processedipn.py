@@ -0,0 +1,26 @@
+# Generated by Django 2.2.28 on 2026-10-17 18:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('paypal', '0003_ipnmessage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProcessedIPN',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('txn_type', models.CharField(max_length=64)),
+                ('key', models.CharField(max_length=255)),
+                ('creation_date', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('duplicates', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('txn_type', 'key')},
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 2.2.28 on 2026-10-17 18:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('paypal', '0004_processedipn'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ipnmessage',
+            name='partition_key',
+            field=models.CharField(max_length=255, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='ipnmessage',
+            index=models.Index(fields=['partition_key', 'status'], name='paypal_ipnm_partiti_6e4305_idx'),
+        ),
+    ]
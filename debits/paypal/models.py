@@ -1,4 +1,7 @@
+import calendar
+import datetime
 import json
+from math import gcd
 
 import requests
 from dateutil.relativedelta import relativedelta
@@ -9,10 +12,15 @@ try:
     from html import escape  # python 3.x
 except ImportError:
     from cgi import escape  # python 2.x
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Q, Sum, Exists, OuterRef
 from django.conf import settings
+from django.utils.module_loading import import_string
 from django.utils.translation import ugettext_lazy as _
-from debits.debits_base.models import logger, CannotCancelSubscription, CannotRefund
+from debits.debits_base.models import logger, CannotCancelSubscription, CannotRefund, ProcessorUnavailable
+from debits.debits_base.queue import QueueItem, QueueStatus
+from debits.paypal.oauth import token_cache
+from debits.paypal.session import pooled_session
 
 
 class PayPalProcessorInfo(models.Model):
@@ -23,6 +31,23 @@ class PayPalProcessorInfo(models.Model):
     def api(self):
         return PayPalAPI()
 
+    @staticmethod
+    def web_host():
+        """Base URL of the PayPal website (payment forms and IPN verification).
+
+        ``PAYPAL_WEB_HOST`` setting (such as a local fake PayPal), by default the sandbox
+        or the live site depending on ``PAYPAL_DEBUG`` setting."""
+        return getattr(settings, 'PAYPAL_WEB_HOST', None) or \
+            ('https://www.sandbox.paypal.com' if settings.PAYPAL_DEBUG else 'https://www.paypal.com')
+
+    @staticmethod
+    def api_host():
+        """Base URL of the PayPal REST API.
+
+        ``PAYPAL_API_HOST`` setting, by default the sandbox or the live API depending on ``PAYPAL_DEBUG`` setting."""
+        return getattr(settings, 'PAYPAL_API_HOST', None) or \
+            ('https://api.sandbox.paypal.com' if settings.PAYPAL_DEBUG else 'https://api.paypal.com')
+
     @staticmethod
     def offset_date(date, offset):
         """Used to calculate the next recurring payment date."""
@@ -32,6 +57,168 @@ class PayPalProcessorInfo(models.Model):
             new_date += relativedelta(days=1)
         return new_date
 
+    @staticmethod
+    def next_offset_date(date, offset, after):
+        """The first date later than `after` of the sequence `date`, ``offset_date(date, offset)``,
+        ``offset_date(offset_date(date, offset), offset)``, ...
+
+        Calculated without stepping through the sequence, so it is fast even for a long lapsed
+        subscription with short periods. `offset` must have a positive count."""
+        if date > after:
+            return date
+        if offset.unit in (Period.UNIT_DAYS, Period.UNIT_WEEKS):
+            step = offset.count * (7 if offset.unit == Period.UNIT_WEEKS else 1)
+            return date + datetime.timedelta(days=((after - date).days // step + 1) * step)
+
+        # Months and years. Step k lands on (month index m0 + k*step, day) until the first month
+        # shorter than day; offset_date() then moves to the 1st of the next month, and the day stays 1.
+        step = offset.count * (12 if offset.unit == Period.UNIT_YEARS else 1)
+        m0 = date.year * 12 + date.month - 1
+        months = after.year * 12 + after.month - 1 - m0
+        # the first step with (m0 + k*step, day) > after, and the first one with (m0 + k*step + 1, 1) > after
+        k_same = max(1, months // step + (0 if months % step == 0 and date.day > after.day else 1))
+        k_first = max(1, -(-months // step))
+
+        def month_date(index, day):
+            return datetime.date(index // 12, index % 12 + 1, day)
+
+        # The month lengths repeat every 12 months (every 400 years for Feb 29).
+        cycle = 12 // gcd(step, 12) if date.day > 29 else 4800 // gcd(step, 4800)
+        if date.day > 28:
+            for k in range(1, min(k_same, cycle) + 1):
+                index = m0 + k * step
+                if calendar.monthrange(index // 12, index % 12 + 1)[1] < date.day:
+                    return month_date(m0 + max(k, k_first) * step + 1, 1)
+        return month_date(m0 + k_same * step, date.day)
+
+
+class IPNMessage(QueueItem):
+    """A raw PayPal IPN stored in the inbox to be processed asynchronously.
+
+    Stored by :class:`~debits.paypal.views.PayPalIPN` if ``PAYPAL_IPN_INBOX`` setting is true
+    and processed by ``manage.py process_ipn_inbox``."""
+
+    class Meta:
+        indexes = [models.Index(fields=['partition_key', 'status'])]
+
+    handler = models.CharField(max_length=255)
+    """Python path of the :class:`~debits.paypal.views.PayPalIPN` subclass which received the IPN."""
+
+    body = models.BinaryField()
+    """The raw HTTP request body (it is sent back to PayPal for verification)."""
+
+    content_type = models.CharField(max_length=255)
+    """HTTP content type of the IPN (without parameters)."""
+
+    charset = models.CharField(max_length=40, null=True)
+    """HTTP charset of the IPN."""
+
+    partition_key = models.CharField(max_length=255, null=True)
+    """IPNs with the same key (such as of the same subscription) are processed one by one in order of arrival.
+
+    IPNs with different keys are processed in parallel."""
+
+    max_attempts_setting = 'PAYPAL_IPN_MAX_ATTEMPTS'
+
+    def __repr__(self):
+        return "<IPNMessage: %s>" % (("pk=%d" % self.pk) if self.pk else "no pk")
+
+    @classmethod
+    def ready(cls, now):
+        """Only the earliest unfinished IPN of every partition is ready."""
+        earlier = cls.objects.filter(partition_key=OuterRef('partition_key'),
+                                     pk__lt=OuterRef('pk'),
+                                     status__in=(QueueStatus.PENDING, QueueStatus.PROCESSING))
+        return super().ready(now).annotate(waits=Exists(earlier)).filter(Q(partition_key__isnull=True) | Q(waits=False))
+
+    def process(self):
+        view = import_string(self.handler)()
+        view.process_message(self)
+
+
+class ProcessedIPN(models.Model):
+    """The key of an already processed IPN.
+
+    PayPal resends an IPN until it receives HTTP 200, and some notifications arrive twice.
+    These keys let :class:`~debits.paypal.views.PayPalIPN` drop repeats before the verification postback."""
+
+    class Meta:
+        unique_together = (('txn_type', 'key'),)
+
+    txn_type = models.CharField(max_length=64)
+    """PayPal `txn_type`."""
+
+    key = models.CharField(max_length=255)
+    """PayPal `txn_id` with `payment_status` or (if there is no `txn_id`) `ipn_track_id`."""
+
+    creation_date = models.DateTimeField(auto_now_add=True, db_index=True)
+    """When the IPN was processed."""
+
+    duplicates = models.PositiveIntegerField(default=0)
+    """How many repeats of this IPN were dropped."""
+
+    def __repr__(self):
+        return "<ProcessedIPN: %s %s>" % (self.txn_type, self.key)
+
+    @staticmethod
+    def key_of(POST):
+        """Internal.
+
+        Returns:
+            `(txn_type, key)` or `None` if the IPN cannot be identified."""
+        txn_type = POST.get('txn_type', '')
+        if POST.get('txn_id'):
+            # The same payment is notified as 'Pending' and later as 'Completed'.
+            return txn_type, POST['txn_id'] + ' ' + POST.get('payment_status', '')
+        if POST.get('ipn_track_id'):
+            return txn_type, POST['ipn_track_id']
+        return None
+
+    @classmethod
+    def drop_duplicate(cls, POST):
+        """Check (and count) if the IPN was already processed."""
+        key = cls.key_of(POST)
+        if key is None:
+            return False
+        return cls.objects.filter(txn_type=key[0], key=key[1]).update(duplicates=F('duplicates') + 1) != 0
+
+    @classmethod
+    def record(cls, POST):
+        """Remember the IPN as processed.
+
+        Call it in the same DB transaction in which the IPN is processed.
+
+        Returns:
+            `False` if the IPN was already processed (possibly, concurrently)."""
+        key = cls.key_of(POST)
+        if key is None:
+            return True
+        try:
+            with transaction.atomic():
+                cls.objects.create(txn_type=key[0], key=key[1])
+        except IntegrityError:
+            cls.objects.filter(txn_type=key[0], key=key[1]).update(duplicates=F('duplicates') + 1)
+            return False
+        return True
+
+    @classmethod
+    def duplicates_dropped(cls):
+        """The total number of dropped repeats (of IPNs which keys are not yet expired)."""
+        return cls.objects.aggregate(total=Sum('duplicates'))['total'] or 0
+
+    @classmethod
+    def expire(cls, before, batch_size=1000):
+        """Delete keys created before `before` datetime, `batch_size` rows per query.
+
+        Returns:
+            The number of deleted keys."""
+        deleted = 0
+        while True:
+            pks = list(cls.objects.filter(creation_date__lt=before).order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                return deleted
+            deleted += cls.objects.filter(pk__in=pks).delete()[0]
+
 
 class PayPalAPI(object):
     """PayPal API.
@@ -41,19 +228,59 @@ class PayPalAPI(object):
     To login into PayPal we use a Bearer from https://api.paypal.com/v1/oauth2/token
     with secret from https://developer.paypal.com/developer/applications"""
 
-    def __init__(self):
-        """Creates a HTTP session to access PayPal API."""
-        debug = settings.PAYPAL_DEBUG
-        self.server = 'https://api.sandbox.paypal.com' if debug else 'https://api.paypal.com'
-        s = requests.Session()
-        s.headers.update({'Accept': 'application/json', 'Accept-Language': 'en_US'})
-        r = s.post(self.server + '/v1/oauth2/token',
-                   data='grant_type=client_credentials',
-                   headers={'content-type': 'application/x-www-form-urlencoded'},
-                   auth=(settings.PAYPAL_CLIENT_ID, settings.PAYPAL_SECRET))
-        token = r.json()["access_token"]
-        s.headers.update({'Authorization': 'Bearer '+token})
-        self.session = s
+    def __init__(self, server=None):
+        """Prepares to access PayPal API.
+
+        No network requests: the HTTP session (see :func:`~debits.paypal.session.pooled_session`)
+        and the OAuth token (see :func:`~debits.paypal.oauth.token_cache`) are shared by the process.
+
+        Args:
+            server: the base URL of the API (such as of a local fake PayPal),
+                by default :meth:`PayPalProcessorInfo.api_host`."""
+        self.server = server or PayPalProcessorInfo.api_host()
+        self.session = pooled_session()
+        self.tokens = token_cache(self.server)
+
+    def request(self, method, path, headers=None, **kwargs):
+        """Internal.
+
+        Sends an authorized request, fetching a new token once if PayPal rejects the cached one.
+
+        Raises :class:`~debits.debits_base.models.ProcessorUnavailable` on network errors."""
+        try:
+            for attempt in range(2):
+                token = self.tokens.get()
+                all_headers = {'Accept': 'application/json',
+                               'Accept-Language': 'en_US',
+                               'Authorization': 'Bearer ' + token}
+                all_headers.update(headers or {})
+                r = self.session.request(method, self.server + path, headers=all_headers, **kwargs)
+                if r.status_code != 401:
+                    return r
+                self.tokens.invalidate(token)
+        except requests.RequestException as e:
+            raise ProcessorUnavailable("PayPal: %s" % e)
+        return r
+
+    @staticmethod
+    def check_temporary_failure(r):
+        """Internal.
+
+        Raise :class:`~debits.debits_base.models.ProcessorUnavailable` for server errors and rate limiting,
+        which are temporary (unlike refusals), so that they are retried."""
+        if r.status_code >= 500 or r.status_code == 429:
+            raise ProcessorUnavailable("PayPal: HTTP %d" % r.status_code)
+
+    @staticmethod
+    def error_message(r):
+        """Internal.
+
+        The message of a PayPal error response (the HTTP status if there is none)."""
+        try:
+            message = r.json().get('message')
+        except (ValueError, AttributeError):  # not a JSON object
+            message = None
+        return message or "PayPal: HTTP %d" % r.status_code
 
     def cancel_agreement(self, agreement_id, is_upgrade=False):
         """Cancels a PayPal recurring payment."""
@@ -61,12 +288,13 @@ class PayPalAPI(object):
         # https://developer.paypal.com/docs/api/#agreement_cancel
         # https://developer.paypal.com/docs/api/payments.billing-agreements#agreement_cancel
         logger.debug("PayPal: now canceling agreement %s" % escape(agreement_id))
-        r = self.session.post(self.server + ('/v1/payments/billing-agreements/%s/cancel' % escape(agreement_id)),
-                              data='{"note": "%s"}' % note,
-                              headers={'content-type': 'application/json'})
+        r = self.request('POST', '/v1/payments/billing-agreements/%s/cancel' % escape(agreement_id),
+                         data='{"note": "%s"}' % note,
+                         headers={'content-type': 'application/json'})
+        self.check_temporary_failure(r)
         if r.status_code < 200 or r.status_code >= 300:  # PayPal returns 204, to be sure
             # Don't include secret information into the message
-            raise CannotCancelSubscription(r.json()["message"])
+            raise CannotCancelSubscription(self.error_message(r))
             # raise RuntimeError(_("Cannot cancel a billing agreement at PayPal. Please contact support:\n" + r.json()["message"]))
 
     def refund(self, transaction_id, sum=None, currency='USD'):
@@ -75,12 +303,13 @@ class PayPalAPI(object):
         data = {}
         if sum is not None:
             data['amount'] = {'total': sum, 'currency': currency}
-        r = self.session.post(self.server + ('/v1/payments/sale/%s/refund' % escape(transaction_id)),
-                              data=json.dumps(data),
-                              headers = {'content-type': 'application/json'})
+        r = self.request('POST', '/v1/payments/sale/%s/refund' % escape(transaction_id),
+                         data=json.dumps(data),
+                         headers={'content-type': 'application/json'})
+        self.check_temporary_failure(r)
         if r.status_code < 200 or r.status_code >= 300:  # PayPal returns 204, to be sure
             # Don't include secret information into the message
-            raise CannotRefund(r.json()["message"])
+            raise CannotRefund(self.error_message(r))
             # raise RuntimeError(_("Cannot cancel a billing agreement at PayPal. Please contact support:\n" + r.json()["message"]))
 
 
@@ -0,0 +1,135 @@
+import hashlib
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+
+from debits.debits_base.base import logger
+from debits.paypal.session import pooled_session
+
+
+class TokenCache(object):
+    """PayPal OAuth access token shared by all threads of a process and optionally
+    (through Django cache `alias`) by all processes.
+
+    The token is refreshed `margin` seconds before it expires. Refreshing is single-flight:
+    when many threads need a new token at once, one fetches it and the others wait for it.
+    With a Django cache, a process which is not the first to need a new token waits up to
+    `wait` seconds for another process to store it before fetching itself.
+
+    Use :func:`token_cache` instead of creating this object."""
+
+    def __init__(self, server, client_id, secret, margin=300, alias=None, wait=5.0):
+        self.server = server
+        self.client_id = client_id
+        self.secret = secret
+        self.margin = margin
+        self.alias = alias
+        self.wait = wait
+        self.key = 'debits:paypal:token:' + hashlib.sha256((server + ' ' + client_id).encode()).hexdigest()
+        self._token = None
+        self._expires = 0.0  # Unix time
+        self._lock = threading.Lock()
+        self.fetches = 0
+        """How many times a token was fetched from PayPal by this process."""
+
+    def get(self):
+        """A valid access token."""
+        token = self._valid(self._token, self._expires)
+        if token is not None:
+            return token
+        with self._lock:  # single-flight among threads
+            token = self._valid(self._token, self._expires)
+            if token is not None:
+                return token
+            token, expires = self._get_shared()
+            self._token, self._expires = token, expires
+            return token
+
+    def invalidate(self, token):
+        """Forget `token` (for example, if PayPal rejected it)."""
+        with self._lock:
+            if self._token == token:
+                self._token = None
+        if self.alias is not None:
+            cache = caches[self.alias]
+            entry = cache.get(self.key)
+            if entry is not None and entry[0] == token:
+                cache.delete(self.key)
+
+    def _valid(self, token, expires):
+        """Internal."""
+        return token if token is not None and expires - self.margin > time.time() else None
+
+    def _get_shared(self):
+        """Internal.
+
+        Returns:
+            A pair (token, expiry Unix time)."""
+        if self.alias is None:
+            return self.fetch()
+        cache = caches[self.alias]
+        entry = cache.get(self.key)
+        if entry is not None and self._valid(*entry):
+            return entry
+        # single-flight among processes: only the holder of the lease fetches
+        lease = self.key + ':lease'
+        owner = uuid.uuid4().hex
+        owned = cache.add(lease, owner, timeout=int(self.wait) + 1)
+        if not owned:
+            deadline = time.monotonic() + self.wait
+            while time.monotonic() < deadline:
+                time.sleep(0.05)
+                entry = cache.get(self.key)
+                if entry is not None and self._valid(*entry):
+                    return entry
+        try:
+            entry = self.fetch()
+            cache.set(self.key, entry, timeout=max(1, int(entry[1] - time.time())))
+        finally:
+            # only our own lease: it may have expired and been taken by another process meanwhile
+            if owned and cache.get(lease) == owner:
+                cache.delete(lease)
+        return entry
+
+    def fetch(self):
+        """Internal.
+
+        Request a new token from PayPal.
+
+        Returns:
+            A pair (token, expiry Unix time)."""
+        logger.debug("PayPal: fetching an OAuth token")
+        r = pooled_session().post(self.server + '/v1/oauth2/token',
+                                  data='grant_type=client_credentials',
+                                  headers={'Accept': 'application/json',
+                                           'content-type': 'application/x-www-form-urlencoded'},
+                                  auth=(self.client_id, self.secret))
+        r.raise_for_status()
+        data = r.json()
+        self.fetches += 1
+        return data['access_token'], time.time() + int(data.get('expires_in', 3600))
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def token_cache(server):
+    """The process-wide :class:`TokenCache` for the PayPal API `server`.
+
+    Configured by settings ``PAYPAL_CLIENT_ID``, ``PAYPAL_SECRET``, ``PAYPAL_TOKEN_REFRESH_MARGIN``
+    (seconds, default 300) and ``PAYPAL_TOKEN_CACHE_ALIAS`` (Django cache to share the token among processes,
+    default `None`: not shared)."""
+    cache = _caches.get(server)
+    if cache is None:
+        with _caches_lock:
+            cache = _caches.get(server)
+            if cache is None:
+                cache = TokenCache(server, settings.PAYPAL_CLIENT_ID, settings.PAYPAL_SECRET,
+                                   margin=getattr(settings, 'PAYPAL_TOKEN_REFRESH_MARGIN', 300),
+                                   alias=getattr(settings, 'PAYPAL_TOKEN_CACHE_ALIAS', None))
+                _caches[server] = cache
+    return cache
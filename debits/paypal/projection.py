@@ -0,0 +1,192 @@
+import datetime
+import itertools
+from math import gcd
+
+from dateutil.relativedelta import relativedelta
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is needed only for projections
+    np = None
+
+from debits.debits_base.base import Period
+from debits.debits_base.models import SubscriptionPurchase
+from debits.debits_base.processors import PAYMENT_PROCESSOR_PAYPAL
+
+
+class Projection(object):
+    """Projected charges as columns (NumPy arrays): the charge `i` is of the purchase `purchase[i]`
+    on `date[i]` (``datetime64[D]``) of `cents[i]` hundredths of `currency[i]`.
+
+    Amounts are integers, as prices have two decimal places."""
+
+    def __init__(self, purchase, date, currency, cents):
+        self.purchase = purchase
+        self.date = date
+        self.currency = currency
+        self.cents = cents
+
+    def __len__(self):
+        return len(self.date)
+
+    def by_day_and_currency(self):
+        """Totals of the charges by day and currency.
+
+        Returns:
+            A dict of columns `date`, `currency`, `cents` and `count` (the number of charges),
+            sorted by date and currency."""
+        currencies, currency_index = np.unique(self.currency, return_inverse=True)
+        if not len(currencies):
+            return {'date': self.date[:0], 'currency': self.currency[:0], 'cents': self.cents[:0],
+                    'count': np.zeros(0, dtype=np.int64)}
+        keys, group = np.unique(self.date.astype(np.int64) * len(currencies) + currency_index, return_inverse=True)
+        cents = np.zeros(len(keys), dtype=np.int64)
+        np.add.at(cents, group, self.cents)
+        return {'date': (keys // len(currencies)).astype('datetime64[D]'),
+                'currency': currencies[keys % len(currencies)],
+                'cents': cents,
+                'count': np.bincount(group, minlength=len(keys))}
+
+
+def days_in_month(months):
+    """Internal.
+
+    Args:
+        months: months since 1970-01 (an array)."""
+    first = months.astype('datetime64[M]')
+    return (((first + 1).astype('datetime64[D]') - first.astype('datetime64[D]'))).astype(np.int64)
+
+
+def day_schedule(due, step, start, end):
+    """Internal.
+
+    Returns:
+        A 2D array: for every row the dates ``due + k * step`` days from the first one not before `start`
+        (dates not before `end` must be ignored)."""
+    lag = (start - due).astype(np.int64)
+    first = due + (np.where(lag > 0, -(-lag // step), 0) * step).astype('timedelta64[D]')
+    columns = int((end - start).astype(np.int64)) // step + 1
+    return first[:, None] + (np.arange(columns) * step).astype('timedelta64[D]')
+
+
+def first_short_step(months, day, step, limit):
+    """Internal.
+
+    For every row, the first step k >= 1 which lands on a month shorter than `day`
+    (see :meth:`~debits.paypal.models.PayPalProcessorInfo.next_offset_date`), `limit + 1` if there is none
+    up to `limit`."""
+    result = limit + 1
+    short_cycle = 12 // gcd(step, 12)  # month lengths repeat every year,
+    leap_cycle = 4800 // gcd(step, 4800)  # or every 400 years for Feb 29
+    cycle = np.where(day > 29, short_cycle, leap_cycle)
+    pending = np.nonzero(day > 28)[0]
+    k, chunk = 1, 48
+    while len(pending):
+        steps = np.arange(k, k + chunk)
+        short = days_in_month(months[pending, None] + steps * step) < day[pending, None]
+        found = short.any(axis=1)
+        result[pending[found]] = k + short[found].argmax(axis=1)
+        k += chunk
+        pending = pending[~found & (np.minimum(limit[pending], cycle[pending]) >= k)]
+    return result
+
+
+def month_schedule(due, step, start, end):
+    """Internal.
+
+    Like :func:`day_schedule` but `step` is in months and a step landing on a month shorter than the day
+    moves to the 1st of the next month, as :meth:`~debits.paypal.models.PayPalProcessorInfo.offset_date` does."""
+    month_start = due.astype('datetime64[M]')
+    months = month_start.astype(np.int64)
+    day = (due - month_start.astype('datetime64[D]')).astype(np.int64) + 1
+    before = start - np.timedelta64(1, 'D')
+    before_months = int(before.astype('datetime64[M]').astype(np.int64))
+    before_day = int((before - before.astype('datetime64[M]').astype('datetime64[D]')).astype(np.int64)) + 1
+
+    # the first step k with (months + k*step, day) > before, and with (months + k*step + 1, 1) > before
+    lag = before_months - months
+    k_same = np.maximum(1, lag // step + np.where((lag % step == 0) & (day > before_day), 0, 1))
+    k_first = np.maximum(1, -(-lag // step))
+    columns = (int(end.astype('datetime64[M]').astype(np.int64)) - before_months) // step + 2
+    short = first_short_step(months, day, step, k_same + columns)
+    k0 = np.where(due > before, 0, np.where(short > k_same, k_same, np.maximum(short, k_first)))
+
+    k = k0[:, None] + np.arange(columns)
+    target = months[:, None] + k * step
+    shifted = k >= short[:, None]
+    return np.where(shifted,
+                    (target + 1).astype('datetime64[M]').astype('datetime64[D]'),
+                    target.astype('datetime64[M]').astype('datetime64[D]') + (day - 1)[:, None])
+
+
+def project_batch(rows, start, end):
+    """Internal.
+
+    Returns:
+        A tuple of lists of parts of the columns (see :class:`Projection`)."""
+    purchase = np.array([row[0] for row in rows], dtype=np.int64)
+    due = np.array([row[1] for row in rows], dtype='datetime64[D]')
+    unit = np.array([row[2] for row in rows], dtype=np.int64)
+    count = np.array([row[3] for row in rows], dtype=np.int64)
+    cents = np.array([int((row[4] + row[5] + row[6]) * 100) for row in rows], dtype=np.int64)
+    currency = np.array([row[7] for row in rows], dtype='U3')
+
+    by_months = (unit == Period.UNIT_MONTHS) | (unit == Period.UNIT_YEARS)
+    step = count * np.select([unit == Period.UNIT_WEEKS, unit == Period.UNIT_YEARS], [7, 12], 1)
+    columns = ([], [], [], [])
+    # rows of the same kind and step at once, so that the schedules have no unused columns
+    for months_kind, step_value in set(zip(by_months[count > 0].tolist(), step[count > 0].tolist())):
+        index = np.nonzero((by_months == months_kind) & (step == step_value) & (count > 0))[0]
+        schedule = (month_schedule if months_kind else day_schedule)(due[index], step_value, start, end)
+        valid = schedule < end
+        rows_index = np.broadcast_to(index[:, None], schedule.shape)[valid]
+        for column, values in zip(columns, (purchase[rows_index], schedule[valid],
+                                            currency[rows_index], cents[rows_index])):
+            column.append(values)
+    return columns
+
+
+def project(months=12, start=None, queryset=None, batch_size=10000):
+    """Project charges of subscriptions for `months` months from `start` (today by default).
+
+    A subscription is charged on its due payment date and then every payment period
+    (as by :meth:`~debits.paypal.models.PayPalProcessorInfo.offset_date`). The charges from `start`
+    (inclusive) to `start` plus `months` (exclusive) are projected; earlier charges of lapsed
+    subscriptions are skipped. Subscriptions with a zero payment period are not projected.
+
+    The subscriptions are read from the DB and projected by `batch_size` at once, with NumPy
+    (an optional dependency).
+
+    Args:
+        queryset: :class:`~debits.debits_base.models.SubscriptionPurchase` objects to project,
+            by default automatic PayPal subscriptions which are not gratis or blocked.
+
+    Returns:
+        :class:`Projection` (the charges are in no particular order)."""
+    if np is None:
+        raise ImportError("Billing projection requires NumPy (pip install numpy).")
+    start = start or datetime.date.today()
+    end = np.datetime64(start + relativedelta(months=months), 'D')
+    start = np.datetime64(start, 'D')
+    if queryset is None:
+        queryset = SubscriptionPurchase.objects.filter(processor_id=PAYMENT_PROCESSOR_PAYPAL,
+                                                       subscription_reference__isnull=False,
+                                                       gratis=False,
+                                                       blocked=False)
+    rows = queryset.order_by('pk').values_list('pk',
+                                               'due_payment_date',
+                                               'item__subscriptionitem__payment_period_unit',
+                                               'item__subscriptionitem__payment_period_count',
+                                               'item__price',
+                                               'shipping',
+                                               'tax',
+                                               'item__currency').iterator(chunk_size=batch_size)
+    columns = ([np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype='datetime64[D]')],
+               [np.zeros(0, dtype='U3')], [np.zeros(0, dtype=np.int64)])
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            break
+        for column, values in zip(columns, project_batch(batch, start, end)):
+            column.extend(values)
+    return Projection(*(np.concatenate(column) for column in columns))
@@ -0,0 +1,100 @@
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from django.conf import settings
+
+
+class PooledSession(object):
+    """A keep-alive HTTP session to PayPal shared by all threads of a process.
+
+    Connections are kept in a pool, so that under sustained load a request costs
+    one round trip instead of a new TCP and TLS handshake.
+    Connection errors are retried (the request was not sent yet), read errors are not
+    (PayPal could have already received it).
+
+    Use :func:`pooled_session` instead of creating this object."""
+
+    def __init__(self, pool_size=10, connect_timeout=5.0, read_timeout=30.0, retries=2):
+        self.timeout = (connect_timeout, read_timeout)
+        retry = Retry(total=retries, connect=retries, read=0, redirect=0, status=0, backoff_factor=0.1)
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._requests = 0
+
+    def request(self, method, url, **kwargs):
+        """Like :meth:`requests.Session.request` but with our timeouts."""
+        kwargs.setdefault('timeout', self.timeout)
+        with self._lock:
+            self._in_flight += 1
+            self._requests += 1
+        try:
+            return self.session.request(method, url, **kwargs)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('POST', url, data=data, **kwargs)
+
+    def stats(self):
+        """Pool statistics for capacity planning.
+
+        Returns:
+            A dict with the numbers of `requests`, `in_flight` requests, new `connections`
+            and `reuse_ratio` (the share of requests which reused a kept-alive connection)."""
+        pools = self.adapter.poolmanager.pools
+        connections = 0
+        sent = 0
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                sent += pool.num_requests
+        return {'requests': self._requests,
+                'in_flight': self._in_flight,
+                'connections': connections,
+                'reuse_ratio': 1.0 - connections / sent if sent else 0.0}
+
+    def close(self):
+        self.session.close()
+
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def pooled_session():
+    """The process-wide :class:`PooledSession`.
+
+    Configured by settings ``PAYPAL_HTTP_POOL_SIZE`` (default 10), ``PAYPAL_HTTP_CONNECT_TIMEOUT``
+    (default 5 seconds), ``PAYPAL_HTTP_READ_TIMEOUT`` (default 30 seconds) and
+    ``PAYPAL_HTTP_RETRIES`` (retries on connection errors, default 2).
+
+    A new session is created after `fork()`, as connections cannot be shared between processes."""
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                _session = PooledSession(pool_size=getattr(settings, 'PAYPAL_HTTP_POOL_SIZE', 10),
+                                         connect_timeout=getattr(settings, 'PAYPAL_HTTP_CONNECT_TIMEOUT', 5.0),
+                                         read_timeout=getattr(settings, 'PAYPAL_HTTP_READ_TIMEOUT', 30.0),
+                                         retries=getattr(settings, 'PAYPAL_HTTP_RETRIES', 2))
+                _session_pid = pid
+    return _session
+
+
+def pool_stats():
+    """Statistics of the process-wide session (see :meth:`PooledSession.stats`)."""
+    return pooled_session().stats()
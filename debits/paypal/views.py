@@ -1,17 +1,18 @@
 import traceback
 from decimal import Decimal
 import datetime
-import requests
+import django.db
 from django.utils import timezone
-from django.http import HttpResponse
+from django.http import HttpRequest, HttpResponse, QueryDict
 from django.utils.decorators import method_decorator
 from django.views import View
+from django.core.exceptions import ObjectDoesNotExist
 from django.views.decorators.csrf import csrf_exempt
 
 from debits.debits_base.processors import PaymentCallback, PAYMENT_PROCESSOR_PAYPAL
 from debits.debits_base.base import logger
-from debits.debits_base.models import BaseTransaction, SimpleTransaction, SubscriptionTransaction, AutomaticPayment, \
-    SubscriptionPurchase
+from debits.debits_base.models import BaseTransaction, SimpleTransaction, AutomaticPayment, \
+    SubscriptionPurchase, BillingContext
 from debits.debits_base.base import Period
 from django.conf import settings
 
@@ -52,7 +53,8 @@ from django.conf import settings
 
 
 # Internal.
-from debits.paypal.models import PayPalAPI, PayPalProcessorInfo
+from debits.paypal.models import PayPalAPI, PayPalProcessorInfo, IPNMessage, ProcessedIPN
+from debits.paypal.session import pooled_session
 
 MONTHS = [
     'Jan', 'Feb', 'Mar', 'Apr',
@@ -95,15 +97,60 @@ class PayPalIPN(PaymentCallback, View):
     # See https://developer.paypal.com/docs/classic/express-checkout/integration-guide/ECRecurringPayments/
     # for all kinds of IPN for recurring payments.
     def post(self, request):
+        if getattr(settings, 'PAYPAL_IPN_INBOX', False):
+            # Acknowledge at once, `manage.py process_ipn_inbox` does the rest.
+            self.store_post(request)
+            return HttpResponse('', content_type="text/plain")
         try:
             self.do_post(request)
         except KeyError as e:
             logger.warning("PayPal IPN var %s is missing" % e)
         except:
-            import traceback
-            traceback.print_exc()
+            logger.exception("Processing a PayPal IPN failed")
         return HttpResponse('', content_type="text/plain")
 
+    def store_post(self, request):
+        return IPNMessage.objects.create(handler=type(self).__module__ + '.' + type(self).__qualname__,
+                                         body=request.body,
+                                         content_type=request.content_type,
+                                         charset=request.content_params.get('charset'),
+                                         partition_key=self.partition_key(request.POST))
+
+    def partition_key(self, POST):
+        """IPNs with the same key are processed in order (see :attr:`~debits.paypal.models.IPNMessage.partition_key`).
+
+        The key is the subscription (for subscription IPNs) or the transaction."""
+        # 'recurring_payment_id' and 'subscr_id' are equivalent
+        for var in ('recurring_payment_id', 'subscr_id'):
+            if POST.get(var):
+                return 'ref ' + POST[var]
+        if POST.get('custom'):
+            return 'custom ' + POST['custom']
+        return None
+
+    def process_message(self, message):
+        """Process an :class:`~debits.paypal.models.IPNMessage` from the inbox.
+
+        Exceptions (other than missing IPN vars) are propagated, so that the message is retried."""
+        try:
+            self.do_post(self.stored_request(message))
+        except KeyError as e:
+            logger.warning("PayPal IPN var %s is missing" % e)
+        except ObjectDoesNotExist:
+            logger.warning("PayPal IPN for a non-existing object")
+
+    @staticmethod
+    def stored_request(message):
+        """A stand-in for the HTTP request of an :class:`~debits.paypal.models.IPNMessage`
+        (with `POST`, `body`, `content_type` and `content_params`)."""
+        request = HttpRequest()
+        request.method = 'POST'
+        request._body = bytes(message.body)
+        request.content_type = message.content_type
+        request.content_params = {'charset': message.charset} if message.charset else {}
+        request.POST = QueryDict(request._body, encoding=message.charset or settings.DEFAULT_CHARSET)
+        return request
+
     def do_post(self, request):
         # 'payment_date', 'time_created' unused
         if request.POST['receiver_email'] == settings.PAYPAL_EMAIL:
@@ -112,23 +159,33 @@ class PayPalIPN(PaymentCallback, View):
             logger.warning("Wrong PayPal email")
 
     def do_do_post(self, POST, request):
-        debug = settings.PAYPAL_DEBUG
-        url = 'https://www.sandbox.paypal.com' if debug else 'https://www.paypal.com'
-        r = requests.post(url + '/cgi-bin/webscr',
-                          'cmd=_notify-validate&' + request.body.decode(
-                              POST.get('charset') or request.content_params['charset']),
-                          headers={
-                              'content-type': request.content_type})  # message must use the same encoding as the original
+        if ProcessedIPN.drop_duplicate(POST):
+            logger.info("Dropped a repeated PayPal IPN")
+            return
+        charset = POST.get('charset') or request.content_params.get('charset') or settings.DEFAULT_CHARSET
+        r = pooled_session().post(PayPalProcessorInfo.web_host() + '/cgi-bin/webscr',
+                                  'cmd=_notify-validate&' + request.body.decode(charset),
+                                  headers={
+                                      'content-type': request.content_type})  # message must use the same encoding as the original
+        r.raise_for_status()  # retry later, if processed from the inbox
         if r.text == 'VERIFIED':
             self.verified_post(POST, request)
         else:
             logger.warning("PayPal verification not passed")
 
-    def verified_post(self, POST, request):
+    def verified_post(self, POST, request=None):
+        """Process a verified IPN.
+
+        Args:
+            request: the HTTP request (see :meth:`stored_request` for IPNs from the inbox)."""
         # print('custom', POST['custom'])  # Don't print sensitive data
         # As of 4 May 2020 in PayPal there is not `custom` in unsubscription notification
         transaction_id = BaseTransaction.pk_from_custom(POST['custom']) if 'custom' in POST else None
-        self.on_transaction_complete(POST, transaction_id)
+        with django.db.transaction.atomic():
+            if not ProcessedIPN.record(POST):
+                logger.info("Dropped a repeated PayPal IPN")
+                return
+            self.on_transaction_complete(POST, transaction_id)
 
     def on_transaction_complete(self, POST, transaction_id):
         # Crazy: Recurring payment and subscription payments are not the same.
@@ -155,7 +212,7 @@ class PayPalIPN(PaymentCallback, View):
 
     def do_appect_refund(self, POST, transaction_id):
         try:
-            transaction = BaseTransaction.objects.get(pk=transaction_id)
+            transaction = BaseTransaction.objects.select_related('purchase__item', 'payment').get(pk=transaction_id)
         except BaseTransaction.DoesNotExist:
             traceback.print_exc()
             return
@@ -174,7 +231,7 @@ class PayPalIPN(PaymentCallback, View):
 
     def do_do_accept_regular_payment(self, POST, transaction_id):
         try:
-            transaction = SimpleTransaction.objects.get(pk=transaction_id)
+            transaction = SimpleTransaction.objects.select_related('purchase__item').get(pk=transaction_id)
         except BaseTransaction.DoesNotExist:
             traceback.print_exc()
             return
@@ -197,13 +254,14 @@ class PayPalIPN(PaymentCallback, View):
     def do_accept_recurring_payment(self, POST, transaction_id):
         # transaction = BaseTransaction.objects.select_for_update().get(pk=transaction_id)  # only inside transaction
         try:
-            transaction = SubscriptionTransaction.objects.get(pk=transaction_id)
+            context = BillingContext.load(transaction_id, for_update=True)
         except BaseTransaction.DoesNotExist:
             traceback.print_exc()
             return
-        if Decimal(POST['amount_per_cycle']) == transaction.purchase.item.price + transaction.purchase.item.shipping + transaction.purchase.item.tax and \
-                        POST['payment_cycle'] in self.pp_payment_cycles(transaction.purchase.item):
-            self.do_do_accept_subscription_or_recurring_payment(transaction, transaction.purchase.item, POST, POST['recurring_payment_id'])
+        purchase = context.purchase
+        if Decimal(POST['amount_per_cycle']) == purchase.item.price + purchase.shipping + purchase.tax and \
+                        POST['payment_cycle'] in self.pp_payment_cycles(context.item):
+            self.do_do_accept_subscription_or_recurring_payment(context, POST, POST['recurring_payment_id'])
         else:
             logger.warning("Wrong recurring payment data")
 
@@ -212,30 +270,31 @@ class PayPalIPN(PaymentCallback, View):
             return
         self.do_accept_subscription_payment(POST, transaction_id)
 
-    def do_do_accept_subscription_or_recurring_payment(self, transaction, purchase, POST, ref):
+    def do_do_accept_subscription_or_recurring_payment(self, context, POST, ref):
+        transaction, purchase = context.transaction, context.purchase
         if self.auto_refund(transaction, purchase, POST):
             return HttpResponse('')
-        purchase.subscriptionpurchase.activate_subscription(ref, POST['payer_email'], PAYMENT_PROCESSOR_PAYPAL)
+        purchase.activate_subscription(ref, POST['payer_email'], PAYMENT_PROCESSOR_PAYPAL)
         # This is already done in activate_subscription():
         payment = AutomaticPayment.objects.create(transaction=transaction,
                                                   email=POST['payer_email'],
                                                   subscription_reference=ref,
                                                   processor_id=PAYMENT_PROCESSOR_PAYPAL)
         purchase.payment = payment
-        self.do_subscription_or_recurring_payment(purchase.subscriptionpurchase)  # calls save()
-        self.on_payment(transaction.payment.automaticpayment)
+        self.do_subscription_or_recurring_payment(purchase)  # calls save()
+        self.on_payment(payment)
 
     def do_accept_subscription_payment(self, POST, transaction_id):
         # transaction = BaseTransaction.objects.select_for_update().get(pk=transaction_id)  # only inside transaction
         try:
-            transaction = SubscriptionTransaction.objects.get(pk=transaction_id)
+            context = BillingContext.load(transaction_id, for_update=True)
         except BaseTransaction.DoesNotExist:
             traceback.print_exc()
             return
-        purchase = transaction.purchase
+        purchase = context.purchase
         if Decimal(POST['mc_gross']) == purchase.item.price + purchase.shipping + purchase.tax and \
                         POST['mc_currency'] == purchase.item.currency:
-            self.do_do_accept_subscription_or_recurring_payment(transaction, purchase, POST, POST['subscr_id'])
+            self.do_do_accept_subscription_or_recurring_payment(context, POST, POST['subscr_id'])
         else:
             logger.warning("Wrong subscription payment data")
 
@@ -243,20 +302,22 @@ class PayPalIPN(PaymentCallback, View):
         # transaction.processor = PaymentProcessor.objects.get(pk=PAYMENT_PROCESSOR_PAYPAL)
         purchase.trial = False
         date = purchase.due_payment_date
-        if purchase.item.subscriptionitem.payment_period.count > 0:  # hack to eliminate infinite loop
-            while date <= datetime.date.today():
-                date = self.advance_item_date(date, purchase)
+        if purchase.item.subscriptionitem.payment_period.count > 0 and date <= datetime.date.today():
+            date = self.advance_item_date(date, purchase)
         purchase.due_payment_date = date
-        purchase.save()
+        # Don't overwrite concurrently changed fields (such as set by activate_subscription())
+        purchase.save(update_fields=['trial', 'due_payment_date', 'payment_deadline', 'reminders_sent', 'payment'])
 
     def advance_item_date(self, date, purchase):
-        date = PayPalProcessorInfo.offset_date(date, purchase.item.subscriptionitem.payment_period)
+        """Move the due payment date of `purchase` from `date` by whole payment periods to after today."""
+        date = PayPalProcessorInfo.next_offset_date(date, purchase.item.subscriptionitem.payment_period,
+                                                    datetime.date.today())
         purchase.set_payment_date(date)
         purchase.reminders_sent = 0
         return date
 
-    def do_subscription_or_recurring_created(self, transaction, POST, ref):
-        purchase = transaction.purchase.subscriptionpurchase
+    def do_subscription_or_recurring_created(self, context, POST, ref):
+        purchase = context.purchase
         purchase.activate_subscription(ref, POST['payer_email'], PAYMENT_PROCESSOR_PAYPAL)
         # transaction.processor = PaymentProcessor.objects.get(pk=PAYMENT_PROCESSOR_PAYPAL)
         SubscriptionPurchase.objects.filter(pk=purchase.pk).update(trial=False)
@@ -268,39 +329,40 @@ class PayPalIPN(PaymentCallback, View):
 
     def do_accept_subscription_signup(self, POST, transaction_id):
         try:
-            transaction = SubscriptionTransaction.objects.get(pk=transaction_id)
+            context = BillingContext.load(transaction_id, for_update=True)
         except BaseTransaction.DoesNotExist:
             traceback.print_exc()
             return
-        purchase = transaction.purchase.subscriptionpurchase
+        purchase, item = context.purchase, context.item
         m = {
             Period.UNIT_DAYS: 'D',
             Period.UNIT_WEEKS: 'W',
             Period.UNIT_MONTHS: 'M',
             Period.UNIT_YEARS: 'Y',
         }
-        period1_right = (purchase.item.subscriptionitem.trial_period.count == 0 and 'period1' not in POST) or \
-                        (purchase.item.subscriptionitem.trial_period.count != 0 and 'period1' in POST and \
-                         POST['period1'] == str(purchase.item.subscriptionitem.trial_period.count)+' '+m[purchase.item.subscriptionitem.trial_period.unit])
+        period1_right = (item.trial_period.count == 0 and 'period1' not in POST) or \
+                        (item.trial_period.count != 0 and 'period1' in POST and \
+                         POST['period1'] == str(item.trial_period.count)+' '+m[item.trial_period.unit])
         if period1_right and 'period2' not in POST and \
-                        Decimal(POST['amount3']) == purchase.item.price and \
-                        POST['period3'] == str(purchase.item.subscriptionitem.payment_period.count)+' '+m[purchase.item.subscriptionitem.payment_period.unit] and \
-                        POST['mc_currency'] == purchase.item.currency:
-            self.do_subscription_or_recurring_created(transaction, POST, POST['subscr_id'])
+                        Decimal(POST['amount3']) == item.price and \
+                        POST['period3'] == str(item.payment_period.count)+' '+m[item.payment_period.unit] and \
+                        POST['mc_currency'] == item.currency:
+            self.do_subscription_or_recurring_created(context, POST, POST['subscr_id'])
         else:
             logger.warning("Wrong subscription signup data")
 
     def accept_recurring_signup(self, POST, transaction_id):
         try:
-            transaction = SubscriptionTransaction.objects.get(pk=transaction_id)
+            context = BillingContext.load(transaction_id, for_update=True)
         except BaseTransaction.DoesNotExist:
             traceback.print_exc()
             return
+        purchase = context.purchase
         if 'period1' not in POST and 'period2' not in POST and \
-                        Decimal(POST['mc_amount3']) == transaction.purchase.item.price + transaction.purchase.shipping + transaction.purchase.tax and \
-                        POST['mc_currency'] == transaction.purchase.item.currency and \
-                        POST['period3'] in self.pp_payment_cycles(transaction):
-            self.do_subscription_or_recurring_created(transaction, POST, POST['recurring_payment_id'])
+                        Decimal(POST['mc_amount3']) == purchase.item.price + purchase.shipping + purchase.tax and \
+                        POST['mc_currency'] == purchase.item.currency and \
+                        POST['period3'] in self.pp_payment_cycles(context.item):
+            self.do_subscription_or_recurring_created(context, POST, POST['recurring_payment_id'])
         else:
             logger.warning("Wrong recurring signup data")
 
@@ -316,10 +378,11 @@ class PayPalIPN(PaymentCallback, View):
         #     return
         # transaction.purchase.subscriptionpurchase.cancel_subscription()
         # self.on_subscription_canceled(POST, transaction.purchase)
-        subscription_reference = getattr(POST, 'recurring_payment_id', POST['subscr_id'])
-        subscriptionpurchase = SubscriptionPurchase.objects.get(subscription_reference=subscription_reference)
+        subscription_reference = POST['recurring_payment_id'] if 'recurring_payment_id' in POST else POST['subscr_id']
+        subscriptionpurchase = SubscriptionPurchase.objects.select_related('item__product', 'payment').\
+            get(subscription_reference=subscription_reference)
         subscriptionpurchase.cancel_subscription()
-        self.on_subscription_canceled(POST, subscriptionpurchase.purchase)
+        self.on_subscription_canceled(POST, subscriptionpurchase)
 
     def auto_refund(self, transaction, purchase, POST):
         # "purchase" is SubscriptionItem
@@ -335,21 +398,22 @@ class PayPalIPN(PaymentCallback, View):
         return False
 
     # Ugh, PayPal
-    def pp_payment_cycles(self, purchase):
+    def pp_payment_cycles(self, item):
+        """PayPal descriptions of the payment period of :class:`~debits.debits_base.models.SubscriptionItem`."""
         first_tmpl = {
             Period.UNIT_DAYS: 'every %d Days',
             Period.UNIT_WEEKS: 'every %d Weeks',
             Period.UNIT_MONTHS: 'every %d Months',
             Period.UNIT_YEARS: 'every %d Years',
-        }[purchase.item.subscriptionitem.payment_period.unit]
-        first = first_tmpl % purchase.item.subscriptionitem.payment_period.count
-        if purchase.item.subscriptionitem.payment_period.count == 1:
+        }[item.payment_period.unit]
+        first = first_tmpl % item.payment_period.count
+        if item.payment_period.count == 1:
             second = {
                 Period.UNIT_DAYS: 'Daily',
                 Period.UNIT_WEEKS: 'Weekly',
                 Period.UNIT_MONTHS: 'Monthly',
                 Period.UNIT_YEARS: 'Yearly',
-            }[purchase.item.subscriptionitem.payment_period.unit]
+            }[item.payment_period.unit]
             return (first, second)
         else:
             return (first,)
@@ -0,0 +1,248 @@
+import base64
+import binascii
+import datetime
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+from urllib.parse import urlparse
+
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseBadRequest
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+
+from debits.debits_base.base import logger
+from debits.debits_base.models import SubscriptionPurchase
+from debits.debits_base.processors import PaymentCallback
+from debits.paypal.session import pooled_session
+
+
+# https://developer.paypal.com/docs/api-basics/notifications/webhooks/notification-messages/#event-headers
+
+
+class CertificateError(Exception):
+    """PayPal signing certificate cannot be used."""
+    pass
+
+
+class CertificateCache(object):
+    """PayPal webhook signing certificates cached in memory and (if `directory` is given) on disk by URL.
+
+    A certificate is downloaded once per `ttl` seconds (and never used after its expiry date),
+    so verifying a webhook needs no network round trip.
+
+    The disk cache is trusted, so `directory` must be private: it is created with mode 0700
+    and refused if it is accessible by other users."""
+
+    def __init__(self, directory=None, ttl=24 * 3600):
+        self.directory = directory
+        self.ttl = ttl
+        self._certs = {}  # url -> (certificate, expiry timestamp)
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        """Get the certificate from `url`.
+
+        Raises :class:`CertificateError` if the URL is not a PayPal HTTPS URL or
+        the certificate is expired."""
+        check_certificate_url(url)  # before the caches, so that nothing cached is used for a wrong URL
+        now = time.time()
+        entry = self._certs.get(url)
+        if entry is None or entry[1] <= now:
+            with self._lock:
+                entry = self._certs.get(url)
+                if entry is None or entry[1] <= now:
+                    pem, fetched = self._load(url, now)
+                    entry = self._store(url, pem, fetched)
+        cert = entry[0]
+        not_before, not_after = validity(cert)
+        if not not_before <= datetime.datetime.now(datetime.timezone.utc) <= not_after:
+            raise CertificateError("PayPal certificate expired")
+        return cert
+
+    def put(self, url, pem):
+        """Cache the certificate (PEM bytes) for `url` without downloading."""
+        with self._lock:
+            self._store(url, pem, time.time())
+
+    def _store(self, url, pem, fetched):
+        cert = x509.load_pem_x509_certificate(pem, default_backend())
+        expiry = min(fetched + self.ttl, validity(cert)[1].timestamp())
+        entry = (cert, expiry)
+        self._certs[url] = entry
+        return entry
+
+    def _path(self, url):
+        return os.path.join(self.directory, hashlib.sha256(url.encode()).hexdigest() + '.pem')
+
+    def _load(self, url, now):
+        """Read the certificate from the disk cache or download it.
+
+        Returns:
+            PEM bytes and the time when it was downloaded."""
+        if self.directory is not None:
+            self._check_directory()
+            path = self._path(url)
+            try:
+                fetched = os.path.getmtime(path)
+                if fetched + self.ttl > now:
+                    with open(path, 'rb') as f:
+                        return f.read(), fetched
+            except OSError:
+                pass
+        r = pooled_session().get(url)
+        r.raise_for_status()
+        pem = r.content
+        if self.directory is not None:
+            tmp = self._path(url) + '.%d.tmp' % os.getpid()
+            with open(tmp, 'wb') as f:
+                f.write(pem)
+            os.replace(tmp, self._path(url))  # atomic, so that other processes never read a partial file
+        return pem, now
+
+    def _check_directory(self):
+        """Create the disk cache directory (private) or check that an existing one is private.
+
+        Otherwise another local user could plant a certificate to sign fake webhooks."""
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        st = os.stat(self.directory)
+        if (hasattr(os, 'getuid') and st.st_uid != os.getuid()) or st.st_mode & 0o077:
+            raise CertificateError("Certificate cache directory %s must be owned by this user "
+                                   "and not accessible by others" % self.directory)
+
+
+def validity(cert):
+    """Internal.
+
+    Returns:
+        The validity period of `cert` as a pair of aware datetimes."""
+    try:
+        return cert.not_valid_before_utc, cert.not_valid_after_utc
+    except AttributeError:  # cryptography < 42
+        return cert.not_valid_before.replace(tzinfo=datetime.timezone.utc), \
+               cert.not_valid_after.replace(tzinfo=datetime.timezone.utc)
+
+
+def check_certificate_url(url):
+    """Raises :class:`CertificateError` unless `url` is HTTPS at a PayPal host.
+
+    Otherwise anybody could sign a fake webhook with their own certificate."""
+    parsed = urlparse(url)
+    host = parsed.hostname or ''
+    if parsed.scheme != 'https' or not (host == 'paypal.com' or host.endswith('.paypal.com')):
+        raise CertificateError("Not a PayPal certificate URL: %s" % url)
+
+
+def expected_message(transmission_id, transmission_time, webhook_id, body):
+    """The string signed by PayPal: `<transmission id>|<time>|<webhook id>|<CRC32 of body>`."""
+    return '%s|%s|%s|%d' % (transmission_id, transmission_time, webhook_id, zlib.crc32(body) & 0xffffffff)
+
+
+def verify_signature(transmission_id, transmission_time, webhook_id, body, signature, cert,
+                     auth_algo='SHA256withRSA'):
+    """Check the webhook signature locally (without calling PayPal).
+
+    Args:
+        body: the raw request body (bytes).
+        signature: base64 encoded `PAYPAL-TRANSMISSION-SIG` header.
+        cert: :class:`cryptography.x509.Certificate` from `PAYPAL-CERT-URL`.
+
+    Returns:
+        `True` if the signature is right."""
+    algorithms = {'SHA256withRSA': hashes.SHA256, 'SHA1withRSA': hashes.SHA1}
+    if auth_algo not in algorithms:
+        return False
+    message = expected_message(transmission_id, transmission_time, webhook_id, body)
+    try:
+        cert.public_key().verify(base64.b64decode(signature), message.encode(), padding.PKCS1v15(),
+                                 algorithms[auth_algo]())
+    except (InvalidSignature, binascii.Error, ValueError):
+        return False
+    return True
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def certificate_cache():
+    """The process-wide :class:`CertificateCache`.
+
+    Configured by settings ``PAYPAL_CERT_CACHE_DIR`` (a private directory, by default `None`: memory only)
+    and ``PAYPAL_CERT_CACHE_TTL`` (default 24 hours)."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = CertificateCache(getattr(settings, 'PAYPAL_CERT_CACHE_DIR', None),
+                                          getattr(settings, 'PAYPAL_CERT_CACHE_TTL', 24 * 3600))
+    return _cache
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class PayPalWebhook(PaymentCallback, View):
+    """Receives PayPal REST webhooks, verifying signatures offline.
+
+    Set ``PAYPAL_WEBHOOK_ID`` setting to the ID of the webhook registered at PayPal.
+
+    All its methods are considered internal."""
+
+    def post(self, request):
+        if not getattr(settings, 'PAYPAL_WEBHOOK_ID', None):
+            # not 2xx, so that PayPal retries after the setting is fixed
+            logger.error("PAYPAL_WEBHOOK_ID setting is missing, cannot verify PayPal webhooks")
+            return HttpResponse('', content_type="text/plain", status=503)
+        try:
+            if not self.verify(request):
+                logger.warning("PayPal webhook signature not verified")
+                return HttpResponseBadRequest('')
+        except (KeyError, CertificateError) as e:
+            logger.warning("Cannot verify PayPal webhook: %s" % e)
+            return HttpResponseBadRequest('')
+        try:
+            self.on_event(json.loads(request.body.decode('utf-8')))
+        except:
+            import traceback
+            traceback.print_exc()
+        return HttpResponse('', content_type="text/plain")
+
+    def verify(self, request):
+        meta = request.META
+        cert = certificate_cache().get(meta['HTTP_PAYPAL_CERT_URL'])
+        return verify_signature(meta['HTTP_PAYPAL_TRANSMISSION_ID'],
+                                meta['HTTP_PAYPAL_TRANSMISSION_TIME'],
+                                settings.PAYPAL_WEBHOOK_ID,
+                                request.body,
+                                meta['HTTP_PAYPAL_TRANSMISSION_SIG'],
+                                cert,
+                                meta.get('HTTP_PAYPAL_AUTH_ALGO', 'SHA256withRSA'))
+
+    def on_event(self, event):
+        type_dispatch = {
+            'BILLING.SUBSCRIPTION.CANCELLED': self.accept_subscription_canceled,
+            'BILLING.SUBSCRIPTION.SUSPENDED': self.accept_subscription_canceled,
+        }
+        handler = type_dispatch.get(event['event_type'])
+        if handler is not None:
+            handler(event)
+        else:
+            logger.debug("Ignored PayPal webhook %s" % event['event_type'])
+
+    def accept_subscription_canceled(self, event):
+        try:
+            purchase = SubscriptionPurchase.objects.select_related('item__product', 'payment').\
+                get(subscription_reference=event['resource']['id'])
+        except SubscriptionPurchase.DoesNotExist:
+            logger.warning("PayPal webhook for an unknown subscription")
+            return
+        purchase.cancel_subscription()
+        self.on_subscription_canceled(event, purchase)
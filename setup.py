@@ -65,6 +65,12 @@ setup(
     # data_files=[("", ["debits/debits_base/fixtures/processors.json"])],
     include_package_data=True,
 
+    # Optional dependencies, for example:
+    # $ pip install django-payee[projection]
+    extras_require={
+        'projection': ['numpy'],
+    },
+
     command_options={
         'build_sphinx': {
             'project': ('setup.py', name),